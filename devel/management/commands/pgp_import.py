@@ -136,6 +136,7 @@ def import_keys(keyring):
     created_ct = updated_ct = 0
     with transaction.atomic():
         finder = UserFinder()
+        finder.preload()
         # we are dependent on parents coming before children; parse_keydata
         # uses an OrderedDict to ensure this is the case.
         for data in keydata.values():
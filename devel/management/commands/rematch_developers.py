@@ -41,6 +41,7 @@ def handle_noargs(self, **options):
             logger.level = logging.DEBUG
 
         finder = UserFinder()
+        finder.preload()
         match_packager(finder)
         match_flagrequest(finder)
 
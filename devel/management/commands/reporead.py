@@ -14,8 +14,11 @@
 """
 
 from base64 import b64decode
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
 from copy import copy
+from functools import wraps
+import hashlib
 import io
 import os
 import re
@@ -24,18 +27,26 @@
 import logging
 from datetime import datetime
 from optparse import make_option
+from timeit import default_timer
 from pytz import utc
 
 from django.core.management.base import BaseCommand, CommandError
 from django.db import connections, router, transaction
+from django.db.models import Q
 from django.db.utils import IntegrityError
 from django.utils.timezone import now
 from django.contrib.auth.models import User
 
 from devel.utils import UserFinder
 from main.models import Arch, Package, PackageFile, Repo
-from packages.models import Depend, Conflict, Provision, Replacement, Update, PackageRelation
-from packages.utils import parse_version
+from main.utils import signature_info
+from packages.fulltext import get_backend, update_search_index
+from packages.models import (Depend, Conflict, Provision, Replacement,
+        PackageGroup, License, Update, PackageRelation, RepoDatabaseState,
+        PackageDigest, ReverseDepend, PackageBase)
+from packages.utils import (defer_maintainers, flush_maintainers,
+        invalidate_details, parse_version, update_package_bases,
+        update_reverse_depends)
 
 
 logging.basicConfig(
@@ -53,6 +64,12 @@ class Command(BaseCommand):
             help='Force a re-import of data for all packages instead of only new ones. Will not touch the \'last updated\' value.'),
         make_option('--filesonly', action='store_true', dest='filesonly', default=False,
             help='Load filelists if they are outdated, but will not add or remove any packages. Will not touch the \'last updated\' value.'),
+        make_option('--stream', action='store_true', dest='stream', default=False,
+            help='Read the package database as a stream, updating each package as soon as it has been parsed. Keeps memory usage bounded by the largest single package.'),
+        make_option('--bulk', action='store_true', dest='bulk', default=False,
+            help='Compare the package database against the web database in memory and apply all changes using batched statements. Cannot be combined with --stream.'),
+        make_option('--plan', action='store_true', dest='plan', default=False,
+            help='Do not change anything; report which packages would be added, updated or removed and how many rows would be written to each table.'),
     )
     help = "Runs a package repository import for the given arch and file."
     args = "<arch> <filename>"
@@ -74,6 +91,19 @@ def handle(self, arch=None, filename=None, **options):
         elif v >= 2:
             logger.level = logging.DEBUG
 
+        if options.get('bulk') and options.get('stream'):
+            raise CommandError('--bulk and --stream cannot be combined.')
+
+        if options.get('plan'):
+            plans = plan_repo(arch, filename, options)
+            if plans is None:
+                self.stdout.write('Package database %s is unchanged, '
+                        'nothing to do.' % filename)
+            for plan in plans or ():
+                for line in plan.report(verbose=v >= 2):
+                    self.stdout.write(line)
+            return
+
         return read_repo(arch, filename, options)
 
 
@@ -84,6 +114,12 @@ class RepoPackage(object):
     number = ( 'csize', 'isize' )
     collections = ( 'depends', 'optdepends', 'makedepends', 'checkdepends',
             'conflicts', 'provides', 'replaces', 'groups', 'license')
+    # relation collections which may carry a ': description' suffix
+    described = ( 'depends', 'optdepends', 'makedepends', 'checkdepends' )
+    # a whole repository worth of these is held in memory at once
+    __slots__ = bare + number + collections + ( 'repo', 'ver', 'rel',
+            'epoch', 'desc', 'pgpsig', 'builddate', 'files', 'pkgid',
+            'members', 'digests', 'unchanged' )
 
     def __init__(self, repo):
         self.repo = repo
@@ -98,20 +134,31 @@ def __init__(self, repo):
             setattr(self, k, ())
         self.builddate = None
         self.files = None
+        # raw desc/depends data waiting to be parsed, and digests of every
+        # member we have read for this package
+        self.pkgid = None
+        self.members = {}
+        self.digests = {}
+        self.unchanged = False
 
     def populate(self, values):
+        kinds = FIELD_KINDS
         for k, v in values.iteritems():
+            kind = kinds.get(k, None)
+            if kind is None:
+                # newer repo-add versions write fields we know nothing about
+                continue
             # ensure we stay under our DB character limit
-            if k in self.bare:
+            if kind is BARE:
                 setattr(self, k, v[0][:254])
-            elif k in self.number:
+            elif kind is NUMBER:
                 setattr(self, k, long(v[0]))
-            elif k in ('desc', 'pgpsig'):
+            elif kind is UNPRUNED:
                 # do NOT prune these values at all
                 setattr(self, k, v[0])
-            elif k == 'version':
+            elif kind is VERSION:
                 self.ver, self.rel, self.epoch = parse_version(v[0])
-            elif k == 'builddate':
+            elif kind is BUILDDATE:
                 try:
                     builddate = datetime.utcfromtimestamp(int(v[0]))
                     self.builddate = builddate.replace(tzinfo=utc)
@@ -119,15 +166,52 @@ def populate(self, values):
                     logger.warning(
                             'Package %s had unparsable build date %s',
                             self.name, v[0])
-            else:
-                # anything left in collections
+            elif kind is COLLECTION:
                 setattr(self, k, tuple(v))
 
+    def parse_members(self):
+        for fname in ('desc', 'depends'):
+            data = self.members.pop(fname, None)
+            if data is None:
+                continue
+            try:
+                self.populate(tokenize_info(data))
+            except UnicodeDecodeError:
+                logger.warn("Could not correctly decode %s/%s, skipping file",
+                        self.pkgid, fname)
+
+    def mark_unchanged(self, name, arch):
+        '''This package is identical to what we imported last time; we only
+        need to know it still exists, so drop all other data.'''
+        self.name = name
+        self.arch = arch
+        self.unchanged = True
+        self.members = {}
+        self.files = None
+
+    def digest_key(self):
+        return tuple(self.digests.get(fname, '')
+                for fname in ('desc', 'depends', 'files'))
+
+    def relations(self, field):
+        '''Split the raw strings of a relation collection (depends,
+        conflicts, etc.) into Relation tuples. This is only done on demand,
+        when the related rows are actually built.'''
+        describe = field in self.described
+        relations = []
+        for value in getattr(self, field):
+            relation = split_relation(value, describe)
+            if relation is None:
+                logger.warning('Package %s had unparsable %s string %s',
+                        self.name, field, value)
+            else:
+                relations.append(relation)
+        return relations
+
     @property
     def files_list(self):
-        data_file = io.TextIOWrapper(io.BytesIO(self.files), encoding='UTF-8')
         try:
-            info = parse_info(data_file)
+            info = tokenize_info(self.files)
         except UnicodeDecodeError:
             logger.warn("Could not correctly decode files list for %s",
                     self.name)
@@ -144,64 +228,206 @@ def full_version(self):
 
 DEPEND_RE = re.compile(r"^(.+?)((>=|<=|=|>|<)(.+))?$")
 
-def create_depend(package, dep_str, deptype='D'):
-    depend = Depend(pkg=package, deptype=deptype)
-    # lop off any description first, don't get confused by epoch
-    parts = dep_str.split(': ', 1)
-    if len(parts) > 1:
-        depend.description = parts[1].strip()
-    match = DEPEND_RE.match(parts[0].strip())
-    if match:
-        depend.name = match.group(1)
-        if match.group(3):
-            depend.comparison = match.group(3)
-        if match.group(4):
-            depend.version = match.group(4)
-    else:
-        logger.warning('Package %s had unparsable depend string %s',
-                package.pkgname, dep_str)
+# a pre-split depends/conflicts/provides/replaces entry; any part that was
+# not present is None
+Relation = namedtuple('Relation',
+        ('name', 'comparison', 'version', 'description'))
+
+def split_relation(value, describe=False):
+    '''Split a single relation string, e.g. 'glibc>=2.19: for foo', into a
+    Relation tuple. Descriptions are only split off if describe is True.
+    Returns None if the string cannot be parsed.'''
+    description = None
+    if describe:
+        # lop off any description first, don't get confused by epoch
+        parts = value.split(': ', 1)
+        if len(parts) > 1:
+            description = parts[1].strip()
+        value = parts[0].strip()
+    if not value:
         return None
+    # the vast majority of entries are a bare name; skip the regex for them
+    if '<' not in value and '>' not in value and '=' not in value:
+        return Relation(value, None, None, description)
+    match = DEPEND_RE.match(value)
+    if not match:
+        return None
+    return Relation(match.group(1), match.group(3), match.group(4),
+            description)
+
+def create_depend(package, relation, deptype='D'):
+    depend = Depend(pkg=package, deptype=deptype, name=relation.name)
+    if relation.description is not None:
+        depend.description = relation.description
+    if relation.comparison:
+        depend.comparison = relation.comparison
+    if relation.version:
+        depend.version = relation.version
     return depend
 
-def create_related(model, package, rel_str, equals_only=False):
-    related = model(pkg=package)
-    match = DEPEND_RE.match(rel_str)
-    if match:
-        related.name = match.group(1)
-        if match.group(3):
-            comp = match.group(3)
-            if not equals_only:
-                related.comparison = comp
-            elif comp != '=':
-                logger.warning(
-                        'Package %s had unexpected comparison operator %s for %s in %s',
-                        package.pkgname, comp, model.__name__, rel_str)
-        if match.group(4):
-            related.version = match.group(4)
-    else:
-        logger.warning('Package %s had unparsable %s string %s',
-                package.pkgname, model.___name__, rel_str)
-        return None
+def create_related(model, package, relation, equals_only=False):
+    related = model(pkg=package, name=relation.name)
+    comp = relation.comparison
+    if comp:
+        if not equals_only:
+            related.comparison = comp
+        elif comp != '=':
+            logger.warning(
+                    'Package %s had unexpected comparison operator %s for %s in %s',
+                    package.pkgname, comp, model.__name__, relation.name)
+    if relation.version:
+        related.version = relation.version
     return related
 
 
-def create_multivalued(dbpkg, repopkg, db_attr, repo_attr):
-    '''Populate the simplest of multivalued attributes. These are those that
-    only deal with a 'name' attribute, such as licenses, groups, etc. The input
-    and output objects and attribute names are specified, and everything is
-    done via getattr().'''
-    collection = getattr(dbpkg, db_attr)
-    collection.all().delete()
-    model = collection.model
-    new_items = []
-    for name in getattr(repopkg, repo_attr):
-        new_items.append(model(pkg=dbpkg, name=name))
-    if new_items:
-        model.objects.bulk_create(new_items)
+def create_multivalued(model, dbpkg, names):
+    '''Create the simplest of multivalued attributes. These are those that
+    only deal with a 'name' attribute, such as licenses, groups, etc.'''
+    return [model(pkg=dbpkg, name=name) for name in names]
 
-finder = UserFinder()
 
-def populate_pkg(dbpkg, repopkg, force=False, timestamp=None):
+def build_related(dbpkg, repopkg):
+    '''Build all of the (unsaved) related objects for a package, returning
+    a list of (model, objects) tuples. Unparsable entries are dropped.'''
+    relations = repopkg.relations
+    deps = [create_depend(dbpkg, y) for y in relations('depends')]
+    deps += [create_depend(dbpkg, y, 'O') for y in relations('optdepends')]
+    deps += [create_depend(dbpkg, y, 'M') for y in relations('makedepends')]
+    deps += [create_depend(dbpkg, y, 'C') for y in relations('checkdepends')]
+    conflicts = [create_related(Conflict, dbpkg, y)
+            for y in relations('conflicts')]
+    provides = [create_related(Provision, dbpkg, y, equals_only=True)
+            for y in relations('provides')]
+    replaces = [create_related(Replacement, dbpkg, y)
+            for y in relations('replaces')]
+    groups = create_multivalued(PackageGroup, dbpkg, repopkg.groups)
+    licenses = create_multivalued(License, dbpkg, repopkg.license)
+
+    return [(Depend, deps), (Conflict, conflicts), (Provision, provides),
+            (Replacement, replaces), (PackageGroup, groups),
+            (License, licenses)]
+
+class LookupCache(object):
+    '''Arch and Repo objects hardly ever change, so look them up once per
+    process instead of several times per import.'''
+    def __init__(self):
+        self.arches = None
+        self.repos = None
+
+    def warm(self):
+        self.arches = {arch.name: arch for arch in Arch.objects.all()}
+        self.repos = {repo.name.lower(): repo for repo in Repo.objects.all()}
+
+    def arch(self, name):
+        if self.arches is None or name not in self.arches:
+            self.warm()
+        try:
+            return self.arches[name]
+        except KeyError:
+            raise Arch.DoesNotExist('Arch %s does not exist' % name)
+
+    def repo(self, name):
+        if self.repos is None or name.lower() not in self.repos:
+            self.warm()
+        try:
+            return self.repos[name.lower()]
+        except KeyError:
+            raise Repo.DoesNotExist('Repo %s does not exist' % name)
+
+    def all_arches(self):
+        if self.arches is None:
+            self.warm()
+        return self.arches.values()
+
+    def agnostic_arches(self):
+        return [arch for arch in self.all_arches() if arch.agnostic]
+
+
+class PhaseTimer(object):
+    '''Accumulates the wall-clock time an import spends in each phase.
+    Phases may nest; time is only ever charged to the innermost one.'''
+    phases = ('decompress', 'parse', 'diff', 'relations', 'files', 'commit')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.totals = defaultdict(float)
+        self.stack = []
+        self.started = self.mark = default_timer()
+
+    def switch(self):
+        current = default_timer()
+        if self.stack:
+            self.totals[self.stack[-1]] += current - self.mark
+        self.mark = current
+
+    @contextmanager
+    def phase(self, name):
+        self.switch()
+        self.stack.append(name)
+        try:
+            yield
+        finally:
+            self.switch()
+            self.stack.pop()
+
+    def report(self, repo_file):
+        total = default_timer() - self.started
+        timings = ['%s %.2fs' % (name, self.totals[name])
+                for name in self.phases]
+        other = total - sum(self.totals.values())
+        logger.info('Phase timings for %s: %s, other %.2fs, total %.2fs',
+                repo_file, ', '.join(timings), other, total)
+
+
+def timed(name):
+    '''Decorator charging all time spent in a function to a phase.'''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer.phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+finder = UserFinder()
+lookups = LookupCache()
+timer = PhaseTimer()
+# pkgbase index entries to refresh once an import is done, see
+# packages.utils.update_package_bases()
+touched_pkgbases = set()
+# architectures of the packages an import changed, whose cached details to
+# throw away once it is done, see packages.utils.invalidate_details()
+touched_arches = set()
+# packages whose reverse dependencies to refresh once an import is committed,
+# see packages.utils.update_reverse_depends()
+touched_depends = set()
+
+
+def touch_package(dbpkg):
+    touched_pkgbases.update(name for name in (dbpkg.pkgbase, dbpkg.pkgname)
+            if name)
+    touched_arches.add(dbpkg.arch_id)
+
+BARE, NUMBER, UNPRUNED, COLLECTION, VERSION, BUILDDATE = (
+        object(), object(), object(), object(), object(), object())
+FIELD_KINDS = dict([(k, BARE) for k in RepoPackage.bare] +
+        [(k, NUMBER) for k in RepoPackage.number] +
+        [(k, COLLECTION) for k in RepoPackage.collections] +
+        [('desc', UNPRUNED), ('pgpsig', UNPRUNED),
+            ('version', VERSION), ('builddate', BUILDDATE)])
+
+
+def warm_caches():
+    '''Load everything an import needs to look up up front; used by
+    long-lived import workers before they accept their first job.'''
+    lookups.warm()
+
+def populate_fields(dbpkg, repopkg, timestamp=None):
+    '''Copy all of the simple attributes from a RepoPackage onto a Package
+    object without saving it.'''
     # we reset the flag date only if the upstream version components change;
     # e.g. epoch or pkgver, but not pkgrel
     if dbpkg.epoch is None or dbpkg.epoch != repopkg.epoch:
@@ -209,10 +435,12 @@ def populate_pkg(dbpkg, repopkg, force=False, timestamp=None):
     elif dbpkg.pkgver is None or dbpkg.pkgver != repopkg.ver:
         dbpkg.flag_date = None
 
+    touch_package(dbpkg)
     if repopkg.base:
         dbpkg.pkgbase = repopkg.base
     else:
         dbpkg.pkgbase = repopkg.name
+    touch_package(dbpkg)
     dbpkg.pkgver = repopkg.ver
     dbpkg.pkgrel = repopkg.rel
     dbpkg.epoch = repopkg.epoch
@@ -226,35 +454,26 @@ def populate_pkg(dbpkg, repopkg, force=False, timestamp=None):
     # attempt to find the corresponding django user for this string
     dbpkg.packager = finder.find(repopkg.packager)
     dbpkg.signature_bytes = b64decode(repopkg.pgpsig.encode('utf-8'))
+    dbpkg.signature_key_id, dbpkg.signature_time = signature_info(
+            dbpkg.signature_bytes)
 
     if timestamp:
         dbpkg.last_update = timestamp
-    dbpkg.save()
-
-    populate_files(dbpkg, repopkg, force=force)
 
-    dbpkg.depends.all().delete()
-    deps = [create_depend(dbpkg, y) for y in repopkg.depends]
-    deps += [create_depend(dbpkg, y, 'O') for y in repopkg.optdepends]
-    deps += [create_depend(dbpkg, y, 'M') for y in repopkg.makedepends]
-    deps += [create_depend(dbpkg, y, 'C') for y in repopkg.checkdepends]
-    Depend.objects.bulk_create(deps)
 
-    dbpkg.conflicts.all().delete()
-    conflicts = [create_related(Conflict, dbpkg, y) for y in repopkg.conflicts]
-    Conflict.objects.bulk_create(conflicts)
-
-    dbpkg.provides.all().delete()
-    provides = [create_related(Provision, dbpkg, y, equals_only=True)
-            for y in repopkg.provides]
-    Provision.objects.bulk_create(provides)
+def populate_pkg(dbpkg, repopkg, force=False, timestamp=None):
+    populate_fields(dbpkg, repopkg, timestamp)
+    dbpkg.save()
 
-    dbpkg.replaces.all().delete()
-    replaces = [create_related(Replacement, dbpkg, y) for y in repopkg.replaces]
-    Replacement.objects.bulk_create(replaces)
+    populate_files(dbpkg, repopkg, force=force)
 
-    create_multivalued(dbpkg, repopkg, 'groups', 'groups')
-    create_multivalued(dbpkg, repopkg, 'licenses', 'license')
+    with timer.phase('relations'):
+        for model, objects in build_related(dbpkg, repopkg):
+            model.objects.filter(pkg=dbpkg).delete()
+            if objects:
+                model.objects.bulk_create(objects)
+        touched_depends.add(dbpkg.id)
+        update_search_index([dbpkg.id])
 
 
 pkg_same_version = lambda pkg, dbpkg: pkg.ver == dbpkg.pkgver \
@@ -267,6 +486,14 @@ def delete_pkg_files(dbpkg):
     cursor.execute('DELETE FROM package_files WHERE pkg_id = %s', [dbpkg.id])
 
 
+def delete_files_bulk(pkg_ids):
+    database = router.db_for_write(Package)
+    cursor = connections[database].cursor()
+    placeholders = ', '.join(['%s'] * len(pkg_ids))
+    cursor.execute('DELETE FROM package_files WHERE pkg_id IN (%s)' %
+            placeholders, pkg_ids)
+
+
 def batched_bulk_create(model, all_objects):
     cutoff = 10000
     length = len(all_objects)
@@ -285,6 +512,119 @@ def chunks():
     return ret
 
 
+def file_rows(files):
+    '''Split a files list into (is_directory, directory, filename) rows.'''
+    rows = []
+    # sort in normal alpha-order that pacman uses, rather than makepkg's
+    # default breadth-first, directory-first ordering
+    for f in sorted(files):
+        if '/' in f:
+            dirname, filename = f.rsplit('/', 1)
+            dirname += '/'
+        else:
+            dirname, filename = '', f
+        if filename == '':
+            filename = None
+        rows.append((filename is None, dirname, filename))
+    return rows
+
+
+def copy_escape(value):
+    '''Escape a value for the PostgreSQL COPY text format.'''
+    if value is None:
+        return u'\\N'
+    if value is True:
+        return u't'
+    if value is False:
+        return u'f'
+    value = unicode(value)
+    for char, escaped in ((u'\\', u'\\\\'), (u'\t', u'\\t'),
+            (u'\n', u'\\n'), (u'\r', u'\\r')):
+        value = value.replace(char, escaped)
+    return value
+
+
+def insert_files(dbpkg, rows):
+    '''Write (is_directory, directory, filename) rows for a package straight
+    into the package_files table, in order, without creating any model
+    instances. PostgreSQL gets a single COPY; everything else a single
+    executemany() INSERT.'''
+    if not rows:
+        return
+    database = router.db_for_write(PackageFile, instance=dbpkg)
+    connection = connections[database]
+    columns = '(pkg_id, is_directory, directory, filename)'
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        pkg_id = unicode(dbpkg.id)
+        data = io.BytesIO()
+        for row in rows:
+            line = u'\t'.join([pkg_id] + [copy_escape(v) for v in row])
+            data.write(line.encode('utf-8'))
+            data.write(b'\n')
+        data.seek(0)
+        # bypass Django's cursor wrapper to get at psycopg2's COPY support
+        cursor.cursor.copy_expert(
+                'COPY package_files %s FROM STDIN' % columns, data)
+    else:
+        sql = 'INSERT INTO package_files %s VALUES (%%s, %%s, %%s, %%s)' % (
+                columns)
+        cursor.executemany(sql, [(dbpkg.id,) + row for row in rows])
+
+
+def stored_files(dbpkg):
+    '''Returns the (id, directory, filename) rows stored for a package.'''
+    database = router.db_for_write(PackageFile, instance=dbpkg)
+    cursor = connections[database].cursor()
+    cursor.execute('SELECT id, directory, filename FROM package_files '
+            'WHERE pkg_id = %s', [dbpkg.id])
+    return cursor.fetchall()
+
+
+def diff_files(existing, rows):
+    '''Compare the stored (id, directory, filename) rows of a package with
+    the wanted (is_directory, directory, filename) rows by path. Returns the
+    ids to delete, the rows to insert and the number of rows left alone.'''
+    wanted = {(directory, filename) for _, directory, filename in rows}
+    stored = set()
+    to_delete = []
+    for file_id, directory, filename in existing:
+        key = (directory, filename)
+        # anything we no longer want, as well as any duplicate rows
+        if key not in wanted or key in stored:
+            to_delete.append(file_id)
+        else:
+            stored.add(key)
+    to_insert = [row for row in rows if (row[1], row[2]) not in stored]
+    return to_delete, to_insert, len(stored)
+
+
+def replace_files(dbpkg, rows):
+    '''Bring the stored file list of a package in line with the given rows.
+    Most updates only touch a handful of paths, so rather than deleting and
+    re-inserting everything we diff against what is stored by (directory,
+    filename) and only delete removed and insert added paths.'''
+    existing = stored_files(dbpkg)
+    if not existing:
+        logger.info("adding %d files for package %s",
+                len(rows), dbpkg.pkgname)
+        insert_files(dbpkg, rows)
+        return
+
+    to_delete, to_insert, unchanged = diff_files(existing, rows)
+    logger.info("updating files for package %s: %d added, %d removed, "
+            "%d unchanged", dbpkg.pkgname, len(to_insert), len(to_delete),
+            unchanged)
+    database = router.db_for_write(PackageFile, instance=dbpkg)
+    cursor = connections[database].cursor()
+    for id_chunk in chunked(to_delete):
+        placeholders = ', '.join(['%s'] * len(id_chunk))
+        cursor.execute('DELETE FROM package_files WHERE id IN (%s)' %
+                placeholders, id_chunk)
+    insert_files(dbpkg, to_insert)
+
+
+@timed('files')
 def populate_files(dbpkg, repopkg, force=False):
     if not force:
         if not pkg_same_version(repopkg, dbpkg):
@@ -303,30 +643,37 @@ def populate_files(dbpkg, repopkg, force=False):
         # we had files data, but it couldn't be parsed, so skip
         if not files:
             return
-        delete_pkg_files(dbpkg)
-        logger.info("adding %d files for package %s",
-                len(files), dbpkg.pkgname)
-        pkg_files = []
-        # sort in normal alpha-order that pacman uses, rather than makepkg's
-        # default breadth-first, directory-first ordering
-        for f in sorted(files):
-            if '/' in f:
-                dirname, filename = f.rsplit('/', 1)
-                dirname += '/'
-            else:
-                dirname, filename = '', f
-            if filename == '':
-                filename = None
-            pkgfile = PackageFile(pkg=dbpkg,
-                    is_directory=(filename is None),
-                    directory=dirname,
-                    filename=filename)
-            pkg_files.append(pkgfile)
-        batched_bulk_create(PackageFile, pkg_files)
+        replace_files(dbpkg, file_rows(files))
         dbpkg.files_last_update = now()
         dbpkg.save()
 
 
+def check_package_ratio(repository, archname, reponame, dbcount, synccount):
+    '''Ensure the package database we are importing is not suspiciously
+    smaller than what we already have in the web database, which usually
+    means we were handed a truncated or otherwise broken file.'''
+    if dbcount:
+        dbpercent = 100.0 * synccount / dbcount
+    else:
+        dbpercent = 0.0
+    logger.info("DB package ratio: %.1f%%", dbpercent)
+
+    # Fewer than 20 packages makes the percentage check unreliable, but it
+    # also means we expect the repo to fluctuate a lot.
+    msg = "Package database %s (%s) has %.1f%% the number of packages " \
+            "the web database"
+    if repository.testing or repository.staging:
+        pass
+    elif dbcount == 0 and synccount == 0:
+        pass
+    elif dbcount > 20 and dbpercent < 50.0:
+        logger.error(msg, reponame, archname, dbpercent)
+        raise Exception(msg % (reponame, archname, dbpercent))
+    elif dbpercent < 75.0:
+        logger.warning(msg, reponame, archname, dbpercent)
+
+
+@timed('diff')
 def update_common(archname, reponame, pkgs, sanity_check=True):
     # If isolation level is repeatable-read, we need to ensure each package
     # update starts a new transaction and re-queries the database as
@@ -335,8 +682,8 @@ def update_common(archname, reponame, pkgs, sanity_check=True):
         # force the transaction dirty, even though we will only do reads
         transaction.set_dirty()
 
-        repository = Repo.objects.get(name__iexact=reponame)
-        architecture = Arch.objects.get(name=archname)
+        repository = lookups.repo(reponame)
+        architecture = lookups.arch(archname)
         # no-arg order_by() removes even the default ordering; we don't need it
         dbpkgs = Package.objects.filter(
                 arch=architecture, repo=repository).order_by()
@@ -344,29 +691,110 @@ def update_common(archname, reponame, pkgs, sanity_check=True):
         logger.info("%d packages in current web DB", len(dbpkgs))
         logger.info("%d packages in new updating DB", len(pkgs))
 
-        if len(dbpkgs):
-            dbpercent = 100.0 * len(pkgs) / len(dbpkgs)
+        if sanity_check:
+            check_package_ratio(repository, archname, reponame,
+                    len(dbpkgs), len(pkgs))
+
+    return dbpkgs
+
+
+def add_package(architecture, repository, pkg):
+    if pkg.unchanged:
+        # we have nothing but a name to go on; the missing digest record will
+        # force a full read of this package on the next import
+        logger.warning("Package %s is unchanged but missing from the web "
+                "database, skipping", pkg.name)
+        return
+    logger.info("Adding package %s", pkg.name)
+    timestamp = now()
+    dbpkg = Package(pkgname=pkg.name, arch=architecture, repo=repository,
+            created=timestamp)
+    try:
+        with transaction.atomic():
+            populate_pkg(dbpkg, pkg, timestamp=timestamp)
+            Update.objects.log_update(None, dbpkg)
+
+            if not Package.objects.filter(
+                    pkgname=pkg.name).exclude(id=dbpkg.id).exists():
+                if not User.objects.filter(
+                        package_relations__pkgbase=dbpkg.pkgbase,
+                        package_relations__type=PackageRelation.MAINTAINER
+                        ).exists():
+                    packager = finder.find(pkg.packager)
+                    if packager:
+                        prel = PackageRelation(pkgbase=dbpkg.pkgbase,
+                                               user=packager,
+                                               type=PackageRelation.MAINTAINER)
+                        with defer_maintainers():
+                            prel.save()
+
+
+    except IntegrityError:
+        if architecture.agnostic:
+            logger.warning("Could not add package %s; "
+                    "not fatal if another thread beat us to it.",
+                    pkg.name)
         else:
-            dbpercent = 0.0
-        logger.info("DB package ratio: %.1f%%", dbpercent)
-
-        # Fewer than 20 packages makes the percentage check unreliable, but it
-        # also means we expect the repo to fluctuate a lot.
-        msg = "Package database %s (%s) has %.1f%% the number of packages " \
-                "the web database"
-        if not sanity_check:
-            pass
-        elif repository.testing or repository.staging:
-            pass
-        elif len(dbpkgs) == 0 and len(pkgs) == 0:
+            logger.exception("Could not add package %s", pkg.name)
+
+
+def remove_package(dbpkg):
+    logger.info("Removing package %s", dbpkg.pkgname)
+    touch_package(dbpkg)
+    pkg_id = dbpkg.id
+    with transaction.atomic():
+        Update.objects.log_update(dbpkg, None)
+        # no race condition here as long as simultaneous threads both
+        # issue deletes; second delete will be a no-op
+        delete_pkg_files(dbpkg)
+        dbpkg.delete()
+        update_search_index([pkg_id])
+
+
+def update_package(dbpkg, pkg, force=False):
+    logger.debug("Checking package %s", pkg.name)
+    if pkg.unchanged:
+        return
+    timestamp = None
+    # for a force, we don't want to update the timestamp.
+    # for a non-force, we don't want to do anything at all.
+    if not force and pkg_same_version(pkg, dbpkg):
+        return
+    elif not force:
+        timestamp = now()
+
+    # The odd select_for_update song and dance here are to ensure
+    # simultaneous updates don't happen on a package, causing
+    # files/depends/all related items to be double-imported.
+    with transaction.atomic():
+        dbpkg = Package.objects.select_for_update().get(id=dbpkg.id)
+        if not force and pkg_same_version(pkg, dbpkg):
+            logger.debug("Package %s was already updated", pkg.name)
+            return
+        logger.info("Updating package %s", pkg.name)
+        prevpkg = copy(dbpkg)
+        populate_pkg(dbpkg, pkg, force=force, timestamp=timestamp)
+        Update.objects.log_update(prevpkg, dbpkg)
+
+
+def update_files(dbpkg, pkg, force=False):
+    if pkg.unchanged:
+        return
+    # The odd select_for_update song and dance here are to ensure
+    # simultaneous updates don't happen on a package, causing
+    # files to be double-imported.
+    with transaction.atomic():
+        if not dbpkg.files_last_update or not dbpkg.last_update:
             pass
-        elif len(dbpkgs) > 20 and dbpercent < 50.0:
-            logger.error(msg, reponame, archname, dbpercent)
-            raise Exception(msg % (reponame, archname, dbpercent))
-        elif dbpercent < 75.0:
-            logger.warning(msg, reponame, archname, dbpercent)
+        elif not force and dbpkg.files_last_update >= dbpkg.last_update:
+            logger.debug("Files for %s are up to date", pkg.name)
+            return
+        dbpkg = Package.objects.select_for_update().get(id=dbpkg.id)
+        logger.debug("Checking files for package %s", pkg.name)
+        populate_files(dbpkg, pkg, force=force)
+        with timer.phase('files'):
+            update_search_index([dbpkg.id])
 
-    return dbpkgs
 
 def db_update(archname, reponame, pkgs, force=False):
     """
@@ -374,8 +802,8 @@ def db_update(archname, reponame, pkgs, force=False):
     """
     logger.info('Updating %s (%s)', reponame, archname)
     dbpkgs = update_common(archname, reponame, pkgs, True)
-    repository = Repo.objects.get(name__iexact=reponame)
-    architecture = Arch.objects.get(name=archname)
+    repository = lookups.repo(reponame)
+    architecture = lookups.arch(archname)
 
     # This makes our inner loop where we find packages by name *way* more
     # efficient by not having to go to the database for each package to
@@ -389,73 +817,16 @@ def db_update(archname, reponame, pkgs, force=False):
     logger.info("%d packages in sync not db", len(in_sync_not_db))
     # packages in syncdb and not in database (add to database)
     for pkg in (pkg for pkg in pkgs if pkg.name in in_sync_not_db):
-        logger.info("Adding package %s", pkg.name)
-        timestamp = now()
-        dbpkg = Package(pkgname=pkg.name, arch=architecture, repo=repository,
-                created=timestamp)
-        try:
-            with transaction.atomic():
-                populate_pkg(dbpkg, pkg, timestamp=timestamp)
-                Update.objects.log_update(None, dbpkg)
-
-                if not Package.objects.filter(
-                        pkgname=pkg.name).exclude(id=dbpkg.id).exists():
-                    if not User.objects.filter(
-                            package_relations__pkgbase=dbpkg.pkgbase,
-                            package_relations__type=PackageRelation.MAINTAINER
-                            ).exists():
-                        packager = finder.find(pkg.packager)
-                        if packager:
-                            prel = PackageRelation(pkgbase=dbpkg.pkgbase,
-                                                   user=packager,
-                                                   type=PackageRelation.MAINTAINER)
-                            prel.save()
-
-
-        except IntegrityError:
-            if architecture.agnostic:
-                logger.warning("Could not add package %s; "
-                        "not fatal if another thread beat us to it.",
-                        pkg.name)
-            else:
-                logger.exception("Could not add package %s", pkg.name)
+        add_package(architecture, repository, pkg)
 
     # packages in database and not in syncdb (remove from database)
     for pkgname in (dbset - syncset):
-        logger.info("Removing package %s", pkgname)
-        dbpkg = dbdict[pkgname]
-        with transaction.atomic():
-            Update.objects.log_update(dbpkg, None)
-            # no race condition here as long as simultaneous threads both
-            # issue deletes; second delete will be a no-op
-            delete_pkg_files(dbpkg)
-            dbpkg.delete()
+        remove_package(dbdict[pkgname])
 
     # packages in both database and in syncdb (update in database)
     pkg_in_both = syncset & dbset
     for pkg in (x for x in pkgs if x.name in pkg_in_both):
-        logger.debug("Checking package %s", pkg.name)
-        dbpkg = dbdict[pkg.name]
-        timestamp = None
-        # for a force, we don't want to update the timestamp.
-        # for a non-force, we don't want to do anything at all.
-        if not force and pkg_same_version(pkg, dbpkg):
-            continue
-        elif not force:
-            timestamp = now()
-
-        # The odd select_for_update song and dance here are to ensure
-        # simultaneous updates don't happen on a package, causing
-        # files/depends/all related items to be double-imported.
-        with transaction.atomic():
-            dbpkg = Package.objects.select_for_update().get(id=dbpkg.id)
-            if not force and pkg_same_version(pkg, dbpkg):
-                logger.debug("Package %s was already updated", pkg.name)
-                continue
-            logger.info("Updating package %s", pkg.name)
-            prevpkg = copy(dbpkg)
-            populate_pkg(dbpkg, pkg, force=force, timestamp=timestamp)
-            Update.objects.log_update(prevpkg, dbpkg)
+        update_package(dbdict[pkg.name], pkg, force=force)
 
     logger.info('Finished updating arch: %s', archname)
 
@@ -470,27 +841,327 @@ def filesonly_update(archname, reponame, pkgs, force=False):
     dbset = set(dbdict.keys())
 
     for pkg in (pkg for pkg in pkgs if pkg.name in dbset):
-        dbpkg = dbdict[pkg.name]
+        update_files(dbdict[pkg.name], pkg, force=force)
 
-        # The odd select_for_update song and dance here are to ensure
-        # simultaneous updates don't happen on a package, causing
-        # files to be double-imported.
-        with transaction.atomic():
-            if not dbpkg.files_last_update or not dbpkg.last_update:
-                pass
-            elif not force and dbpkg.files_last_update >= dbpkg.last_update:
-                logger.debug("Files for %s are up to date", pkg.name)
+    logger.info('Finished updating arch: %s', archname)
+
+
+def chunked(items, size=500):
+    '''Split a list into pieces of at most size items. This keeps IN clauses
+    under database parameter limits (SQLite allows only 999).'''
+    for offset in range(0, len(items), size):
+        yield items[offset:offset + size]
+
+
+PACKAGE_UPDATE_FIELDS = ('flag_date', 'pkgbase', 'pkgver', 'pkgrel', 'epoch',
+        'pkgdesc', 'url', 'filename', 'compressed_size', 'installed_size',
+        'build_date', 'packager_str', 'packager', 'signature_bytes',
+        'signature_key_id', 'signature_time', 'last_update')
+
+
+def bulk_save(model, objects, fields):
+    '''Write the given fields of many existing model instances back to the
+    database using a single UPDATE statement executed for all rows.'''
+    if not objects:
+        return
+    database = router.db_for_write(model)
+    connection = connections[database]
+    qn = connection.ops.quote_name
+    meta = model._meta
+    fields = [meta.get_field(name) for name in fields]
+    sql = 'UPDATE %s SET %s WHERE %s = %%s' % (qn(meta.db_table),
+            ', '.join('%s = %%s' % qn(field.column) for field in fields),
+            qn(meta.pk.column))
+    params = [[field.get_db_prep_save(getattr(obj, field.attname),
+                connection=connection) for field in fields] + [obj.pk]
+            for obj in objects]
+    cursor = connection.cursor()
+    cursor.executemany(sql, params)
+
+
+@timed('relations')
+def bulk_replace_related(pairs):
+    '''Replace all related objects (depends, provides, etc.) of the given
+    (Package, RepoPackage) pairs with a single DELETE and batched INSERTs per
+    related table.'''
+    related = defaultdict(list)
+    for dbpkg, repopkg in pairs:
+        for model, objects in build_related(dbpkg, repopkg):
+            related[model].extend(objects)
+    ids = [dbpkg.id for dbpkg, _ in pairs]
+    for model, objects in related.items():
+        for id_chunk in chunked(ids):
+            model.objects.filter(pkg_id__in=id_chunk).delete()
+        batched_bulk_create(model, objects)
+    touched_depends.update(ids)
+
+
+def bulk_assign_maintainers(dbpkgs):
+    '''Bulk version of the maintainer guessing done when adding a package: if
+    the package name is new to us and its pkgbase has no maintainer yet, the
+    packager becomes the maintainer.'''
+    names = [dbpkg.pkgname for dbpkg in dbpkgs]
+    ids = [dbpkg.id for dbpkg in dbpkgs]
+    pkgbases = list({dbpkg.pkgbase for dbpkg in dbpkgs})
+    known_names = set()
+    for name_chunk in chunked(names):
+        known_names.update(Package.objects.filter(
+                pkgname__in=name_chunk).exclude(id__in=ids).values_list(
+                'pkgname', flat=True).order_by())
+    maintained = set()
+    for base_chunk in chunked(pkgbases):
+        maintained.update(PackageRelation.objects.filter(
+                pkgbase__in=base_chunk,
+                type=PackageRelation.MAINTAINER).values_list(
+                'pkgbase', flat=True).order_by())
+
+    with defer_maintainers():
+        for dbpkg in dbpkgs:
+            if dbpkg.pkgname in known_names or dbpkg.pkgbase in maintained:
+                continue
+            if dbpkg.packager is None:
                 continue
-            dbpkg = Package.objects.select_for_update().get(id=dbpkg.id)
-            logger.debug("Checking files for package %s", pkg.name)
-            populate_files(dbpkg, pkg, force=force)
+            PackageRelation.objects.create(pkgbase=dbpkg.pkgbase,
+                    user=dbpkg.packager, type=PackageRelation.MAINTAINER)
+            maintained.add(dbpkg.pkgbase)
+
+
+def bulk_update(archname, reponame, pkgs, force=False):
+    """
+    Set-based version of db_update(). The parsed packages are compared against
+    the database in memory and all additions, updates, removals and related
+    object replacements are then applied with a handful of batched statements
+    per table inside a single transaction. If this conflicts with a
+    simultaneous import, we fall back to the per-package db_update().
+    """
+    logger.info('Bulk updating %s (%s)', reponame, archname)
+    dbpkgs = update_common(archname, reponame, pkgs, True)
+    repository = lookups.repo(reponame)
+    architecture = lookups.arch(archname)
+
+    dbdict = {dbpkg.pkgname: dbpkg for dbpkg in dbpkgs}
+    syncdict = {pkg.name: pkg for pkg in pkgs}
+
+    to_add = [pkg for pkg in pkgs if pkg.name not in dbdict]
+    to_remove = [dbpkg for name, dbpkg in dbdict.items()
+            if name not in syncdict]
+    to_update = [dbdict[pkg.name] for pkg in pkgs if pkg.name in dbdict and
+            not pkg.unchanged and
+            (force or not pkg_same_version(pkg, dbdict[pkg.name]))]
+    for pkg in (pkg for pkg in to_add if pkg.unchanged):
+        logger.warning("Package %s is unchanged but missing from the web "
+                "database, skipping", pkg.name)
+    to_add = [pkg for pkg in to_add if not pkg.unchanged]
+    logger.info("%d packages to add, %d to update, %d to remove",
+            len(to_add), len(to_update), len(to_remove))
+
+    try:
+        with transaction.atomic():
+            remove_ids = [dbpkg.id for dbpkg in to_remove]
+            for dbpkg in to_remove:
+                logger.info("Removing package %s", dbpkg.pkgname)
+                touch_package(dbpkg)
+                Update.objects.log_update(dbpkg, None)
+            for id_chunk in chunked(remove_ids):
+                delete_files_bulk(id_chunk)
+                Package.objects.filter(id__in=id_chunk).delete()
+            update_search_index(remove_ids)
+
+            # lock and re-read everything we intend to update; this guards
+            # against simultaneous updates the same way update_package() does
+            update_ids = [dbpkg.id for dbpkg in to_update]
+            locked = []
+            for id_chunk in chunked(update_ids):
+                locked.extend(Package.objects.select_for_update().filter(
+                        id__in=id_chunk).order_by())
+            updated = []
+            timestamp = None if force else now()
+            for dbpkg in locked:
+                pkg = syncdict[dbpkg.pkgname]
+                if not force and pkg_same_version(pkg, dbpkg):
+                    logger.debug("Package %s was already updated", pkg.name)
+                    continue
+                logger.info("Updating package %s", pkg.name)
+                prevpkg = copy(dbpkg)
+                populate_fields(dbpkg, pkg, timestamp)
+                Update.objects.log_update(prevpkg, dbpkg)
+                updated.append(dbpkg)
+            bulk_save(Package, updated, PACKAGE_UPDATE_FIELDS)
+
+            timestamp = now()
+            added = []
+            for pkg in to_add:
+                logger.info("Adding package %s", pkg.name)
+                dbpkg = Package(pkgname=pkg.name, arch=architecture,
+                        repo=repository, created=timestamp)
+                populate_fields(dbpkg, pkg, timestamp)
+                added.append(dbpkg)
+            batched_bulk_create(Package, added)
+            # bulk_create() does not give us primary keys, so fetch them
+            new_ids = {}
+            for name_chunk in chunked([dbpkg.pkgname for dbpkg in added]):
+                new_ids.update(Package.objects.filter(arch=architecture,
+                        repo=repository, pkgname__in=name_chunk).values_list(
+                        'pkgname', 'id').order_by())
+            for dbpkg in added:
+                dbpkg.id = new_ids[dbpkg.pkgname]
+                Update.objects.log_update(None, dbpkg)
+            bulk_assign_maintainers(added)
+
+            changed = [(dbpkg, syncdict[dbpkg.pkgname])
+                    for dbpkg in updated + added]
+            bulk_replace_related(changed)
+            for dbpkg, pkg in changed:
+                populate_files(dbpkg, pkg, force=force)
+            with timer.phase('relations'):
+                update_search_index([dbpkg.id for dbpkg, _ in changed])
+    except IntegrityError:
+        logger.warning("Bulk update of %s (%s) failed, falling back to "
+                "per-package updates", reponame, archname)
+        return db_update(archname, reponame, pkgs, force)
 
     logger.info('Finished updating arch: %s', archname)
 
 
+def stream_update(primary_arch, repo_file, force=False, filesonly=False,
+        known=None):
+    """
+    Updates the packages database while the repo db file is still being read.
+    Each package is handed off as soon as all of its members have been parsed
+    and is discarded afterwards, so memory usage is bounded by the largest
+    single package rather than the entire repo. Removals are held back until
+    the whole file has been read and passes the package count sanity checks.
+    Returns the digest records of all packages seen, see digest_records().
+    """
+    reponame = repo_name(repo_file)
+    repository = lookups.repo(reponame)
+    arches = {arch.name: arch for arch in lookups.agnostic_arches()}
+    arches[primary_arch.name] = primary_arch
+
+    dbdicts = {}
+    seen = defaultdict(set)
+    records = []
+
+    @timed('diff')
+    def get_dbdict(arch):
+        if arch.name not in dbdicts:
+            dbpkgs = Package.objects.filter(
+                    arch=arch, repo=repository).order_by()
+            dbdicts[arch.name] = {dbpkg.pkgname: dbpkg for dbpkg in dbpkgs}
+        return dbdicts[arch.name]
+
+    for pkg in iter_repo(repo_file, known):
+        records.extend(digest_records([pkg]))
+        arch = arches.get(pkg.arch, None)
+        if arch is None:
+            raise Exception(
+                    "Package %s in database %s had wrong architecture %s" % (
+                    pkg.name, repo_file, pkg.arch))
+        dbdict = get_dbdict(arch)
+        seen[arch.name].add(pkg.name)
+        dbpkg = dbdict.get(pkg.name, None)
+        if filesonly:
+            if dbpkg is not None:
+                update_files(dbpkg, pkg, force=force)
+        elif dbpkg is None:
+            add_package(arch, repository, pkg)
+        else:
+            update_package(dbpkg, pkg, force=force)
+
+    if filesonly:
+        return records
+
+    for archname in sorted(arches.keys()):
+        dbdict = get_dbdict(arches[archname])
+        syncset = seen[archname]
+        logger.info('Checking removals for %s (%s)', reponame, archname)
+        logger.info("%d packages in current web DB", len(dbdict))
+        logger.info("%d packages in new updating DB", len(syncset))
+        check_package_ratio(repository, archname, reponame,
+                len(dbdict), len(syncset))
+        for pkgname in (set(dbdict.keys()) - syncset):
+            remove_package(dbdict[pkgname])
+
+    return records
+
+
+@timed('diff')
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as repo_file:
+        for block in iter(lambda: repo_file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def digest_records(pkgs):
+    '''Reduce packages to the compact (pkgid, name, arch, digests) tuples we
+    need to remember once an import is complete.'''
+    return [(pkg.pkgid, pkg.name, pkg.arch, pkg.digest_key()) for pkg in pkgs]
+
+
+@timed('diff')
+def load_digests(repository, arch):
+    '''Returns the RepoDatabaseState for a repo db file, and a dict of its
+    PackageDigest objects keyed by pkgid.'''
+    try:
+        state = RepoDatabaseState.objects.get(repo=repository, arch=arch)
+    except RepoDatabaseState.DoesNotExist:
+        return None, {}
+    digests = state.packages.select_related('arch')
+    return state, {digest.pkgid: digest for digest in digests}
+
+
+@timed('commit')
+def save_digests(repository, arch, digest, records):
+    '''Record the digest of a successfully imported repo db file and of each
+    of its packages. Packages that did not make it into the web database are
+    left out so they will be read again next time.'''
+    arches = {a.name: a for a in lookups.all_arches()}
+    existing = set(Package.objects.filter(repo=repository).values_list(
+            'pkgname', 'arch__name').order_by())
+    new = {pkgid: (name, archname, key)
+            for pkgid, name, archname, key in records
+            if (name, archname) in existing}
+
+    with transaction.atomic():
+        state, _ = RepoDatabaseState.objects.get_or_create(
+                repo=repository, arch=arch,
+                defaults={'digest': digest, 'last_import': now()})
+        state.digest = digest
+        state.last_import = now()
+        state.generation += 1
+        state.save()
+
+        stale = []
+        kept = set()
+        for stored in state.packages.select_related('arch'):
+            record = new.get(stored.pkgid, None)
+            if record == (stored.pkgname, stored.arch.name, stored.digests()):
+                kept.add(stored.pkgid)
+            else:
+                stale.append(stored.id)
+        for id_chunk in chunked(stale):
+            PackageDigest.objects.filter(id__in=id_chunk).delete()
+
+        to_create = []
+        for pkgid, (name, archname, key) in new.items():
+            if pkgid in kept:
+                continue
+            desc, depends, files = key
+            to_create.append(PackageDigest(database=state, pkgid=pkgid,
+                    pkgname=name, arch=arches[archname], desc_digest=desc,
+                    depends_digest=depends, files_digest=files))
+        batched_bulk_create(PackageDigest, to_create)
+    logger.info("Recorded digests for %d packages, %d changed",
+            len(new), len(to_create))
+
+
 def parse_info(iofile):
     """
     Parses an Arch repo db information file, and returns variables as a list.
+    This is the straightforward line-by-line reference implementation of the
+    format; imports use tokenize_info() instead.
     """
     store = {}
     blockname = None
@@ -509,12 +1180,92 @@ def parse_info(iofile):
     return store
 
 
-def parse_repo(repopath):
+def tokenize_info(data):
+    """
+    Parses the raw bytes of a repo db desc, depends or files member, returning
+    the same dict as parse_info(). Rather than inspecting every line, the
+    data is split into blank line separated blocks, and each block into its
+    header and values.
+    """
+    text = data.decode('utf-8')
+    if u'\r' in text:
+        text = text.replace(u'\r\n', u'\n').replace(u'\r', u'\n')
+    store = {}
+    values = None
+    strip = unicode.strip
+    for chunk in text.split(u'\n\n'):
+        lines = filter(None, map(strip, chunk.split(u'\n')))
+        if not lines:
+            continue
+        if u'\n%' in chunk:
+            # more than one header in this block, do it the slow way
+            headers = [i for i, line in enumerate(lines)
+                    if line[0] == u'%' and line[-1] == u'%']
+        else:
+            first = lines[0]
+            headers = [0] if first[0] == u'%' and first[-1] == u'%' else []
+        if not headers or headers[0] != 0:
+            if values is None:
+                raise Exception(
+                        "Read package info outside a block: %s" % lines[0])
+            values.extend(lines[:headers[0] if headers else None])
+        for start, end in zip(headers, headers[1:] + [None]):
+            values = lines[start + 1:end]
+            store[lines[start][1:-1].lower()] = values
+    return store
+
+
+def repo_name(repopath):
+    '''Determine the repository name from a repo db file path.'''
+    filename = os.path.split(repopath)[1]
+    m = re.match(r"^(.*)\.(db|files)\.tar(\..*)?$", filename)
+    if m:
+        return m.group(1)
+    logger.error("File does not have the proper extension")
+    raise Exception("File does not have the proper extension")
+
+
+@timed('decompress')
+def read_member(repodb, tarinfo, pkg):
+    '''Read a single member of a repo db tarfile into the given package.
+    Nothing is parsed yet; see finish_package().'''
+    pkgid, fname = os.path.split(tarinfo.name)
+    pkg.pkgid = pkgid
+    if fname in ('desc', 'depends', 'files'):
+        data = repodb.extractfile(tarinfo).read()
+        pkg.digests[fname] = hashlib.sha256(data).hexdigest()
+        if fname == 'files':
+            # don't parse yet for speed and memory consumption reasons
+            pkg.files = data
+        else:
+            pkg.members[fname] = data
+        del data
+
+    logger.debug("Done reading file %s/%s", pkgid, fname)
+
+
+@timed('parse')
+def finish_package(pkg, known=None):
+    '''Called once all members of a package have been read. If the digests
+    of every member match those recorded in the known PackageDigest dict, the
+    package is marked as unchanged and never parsed; otherwise it is parsed
+    as usual.'''
+    digest = known.get(pkg.pkgid, None) if known else None
+    if digest is not None and digest.digests() == pkg.digest_key():
+        pkg.mark_unchanged(digest.pkgname, digest.arch.name)
+    else:
+        pkg.parse_members()
+    return pkg
+
+
+def parse_repo(repopath, known=None):
     """
     Parses an Arch repo db file, and returns a list of RepoPackage objects.
 
     Arguments:
      repopath -- The path of a repository db file.
+     known -- Optional dict of PackageDigest objects keyed by pkgid; packages
+              matching these are not parsed and are marked as unchanged.
 
     """
     logger.info("Starting repo parsing")
@@ -522,50 +1273,76 @@ def parse_repo(repopath):
         logger.error("Could not read file %s", repopath)
 
     logger.info("Reading repo tarfile %s", repopath)
-    filename = os.path.split(repopath)[1]
-    m = re.match(r"^(.*)\.(db|files)\.tar(\..*)?$", filename)
-    if m:
-        reponame = m.group(1)
-    else:
-        logger.error("File does not have the proper extension")
-        raise Exception("File does not have the proper extension")
+    reponame = repo_name(repopath)
 
-    repodb = tarfile.open(repopath, "r")
+    with timer.phase('decompress'):
+        repodb = tarfile.open(repopath, "r")
+        members = repodb.getmembers()
     logger.debug("Starting package parsing")
     newpkg = lambda: RepoPackage(reponame)
     pkgs = defaultdict(newpkg)
-    for tarinfo in repodb.getmembers():
+    for tarinfo in members:
         if tarinfo.isreg():
-            pkgid, fname = os.path.split(tarinfo.name)
-            if fname == 'files':
-                # don't parse yet for speed and memory consumption reasons
-                files_data = repodb.extractfile(tarinfo)
-                pkgs[pkgid].files = files_data.read()
-                del files_data
-            elif fname in ('desc', 'depends'):
-                data_file = repodb.extractfile(tarinfo)
-                data_file = io.TextIOWrapper(io.BytesIO(data_file.read()),
-                        encoding='UTF-8')
-                try:
-                    pkgs[pkgid].populate(parse_info(data_file))
-                except UnicodeDecodeError:
-                    logger.warn("Could not correctly decode %s, skipping file",
-                            tarinfo.name)
-                data_file.close()
-                del data_file
-
-            logger.debug("Done parsing file %s/%s", pkgid, fname)
+            pkgid = os.path.dirname(tarinfo.name)
+            read_member(repodb, tarinfo, pkgs[pkgid])
 
     repodb.close()
+    for pkg in pkgs.itervalues():
+        finish_package(pkg, known)
     logger.info("Finished repo parsing, %d total packages", len(pkgs))
     return (reponame, pkgs.values())
 
+
+def iter_repo(repopath, known=None):
+    """
+    Parses an Arch repo db file as a stream, yielding each RepoPackage object
+    as soon as all of its members have been read. Only one package is held in
+    memory at a time. repo-add writes all members of a package together; a
+    file where this is not the case cannot be streamed.
+
+    Arguments:
+     repopath -- The path of a repository db file.
+     known -- Optional dict of PackageDigest objects, see parse_repo().
+
+    """
+    logger.info("Streaming repo tarfile %s", repopath)
+    reponame = repo_name(repopath)
+
+    repodb = tarfile.open(repopath, "r|*")
+    pkgid = pkg = None
+    done = set()
+    count = 0
+    try:
+        for tarinfo in repodb:
+            if not tarinfo.isreg():
+                continue
+            member_pkgid = os.path.dirname(tarinfo.name)
+            if member_pkgid != pkgid:
+                if pkg is not None:
+                    done.add(pkgid)
+                    count += 1
+                    yield finish_package(pkg, known)
+                if member_pkgid in done:
+                    raise Exception("Members of package %s in %s are not "
+                            "stored together, cannot stream file" % (
+                            member_pkgid, repopath))
+                pkgid = member_pkgid
+                pkg = RepoPackage(reponame)
+            read_member(repodb, tarinfo, pkg)
+        if pkg is not None:
+            count += 1
+            yield finish_package(pkg, known)
+    finally:
+        repodb.close()
+    logger.info("Finished repo streaming, %d total packages", count)
+
+
 def locate_arch(arch):
     "Check if arch is valid."
     if isinstance(arch, Arch):
         return arch
     try:
-        return Arch.objects.get(name=arch)
+        return lookups.arch(arch)
     except Arch.DoesNotExist:
         raise CommandError(
                 'Specified architecture %s is not currently known.' % arch)
@@ -579,23 +1356,14 @@ def read_repo(primary_arch, repo_file, options):
     primary_arch = locate_arch(primary_arch)
     force = options.get('force', False)
     filesonly = options.get('filesonly', False)
-
-    repo, packages = parse_repo(repo_file)
-
-    # group packages by arch -- to handle noarch stuff
-    packages_arches = {}
-    for arch in Arch.objects.filter(agnostic=True):
-        packages_arches[arch.name] = []
-    packages_arches[primary_arch.name] = []
-
-    for package in packages:
-        if package.arch in packages_arches:
-            packages_arches[package.arch].append(package)
-        else:
-            raise Exception(
-                    "Package %s in database %s had wrong architecture %s" % (
-                    package.name, repo_file, package.arch))
-    del packages
+    stream = options.get('stream', False)
+    bulk = options.get('bulk', False)
+    # long-lived import workers reuse their connection between imports
+    keep_connection = options.get('keep_connection', False)
+    timer.reset()
+    touched_pkgbases.clear()
+    touched_depends.clear()
+    touched_arches.clear()
 
     database = router.db_for_write(Package)
     connection = connections[database]
@@ -603,15 +1371,443 @@ def read_repo(primary_arch, repo_file, options):
         cursor = connection.cursor()
         cursor.execute('PRAGMA synchronous = NORMAL')
 
+    # A files-only update neither adds nor removes packages, so it can
+    # neither use nor record the digests of a complete import.
+    digest = None
+    known = None
+    if not filesonly:
+        repository = lookups.repo(repo_name(repo_file))
+        digest = file_digest(repo_file)
+        state, known = load_digests(repository, primary_arch)
+        if force:
+            known = None
+        elif state is not None and state.digest == digest:
+            logger.info('Package database %s is unchanged, skipping.',
+                    repo_file)
+            if not keep_connection:
+                connection.close()
+            return 0
+
+    # refresh the in-memory user indexes so packager matching needs no
+    # queries; this is cheap compared to the import itself
+    finder.preload()
+
+    if stream:
+        logger.info('Starting streaming database updates for %s.', repo_file)
+        records = stream_update(primary_arch, repo_file, force, filesonly,
+                known)
+        with timer.phase('relations'):
+            update_package_bases(touched_pkgbases,
+                    lookups.repo(repo_name(repo_file)),
+                    [primary_arch] + lookups.agnostic_arches())
+        if digest is not None:
+            save_digests(repository, primary_arch, digest, records)
+        logger.info('Finished database updates for %s.', repo_file)
+        with timer.phase('commit'):
+            connection.commit()
+        with timer.phase('relations'):
+            update_reverse_depends(touched_depends)
+        invalidate_details(touched_arches)
+        # announce any maintainers we assigned, now that they are committed
+        flush_maintainers()
+        timer.report(repo_file)
+        if not keep_connection:
+            connection.close()
+        return 0
+
+    repo, packages = parse_repo(repo_file, known)
+    records = digest_records(packages)
+    finder.find_all(pkg.packager for pkg in packages if not pkg.unchanged)
+    packages_arches = group_by_arch(primary_arch, repo_file, packages)
+    del packages
+
     logger.info('Starting database updates for %s.', repo_file)
     for arch in sorted(packages_arches.keys()):
         if filesonly:
             filesonly_update(arch, repo, packages_arches[arch], force)
+        elif bulk:
+            bulk_update(arch, repo, packages_arches[arch], force)
         else:
             db_update(arch, repo, packages_arches[arch], force)
+    with timer.phase('relations'):
+        update_package_bases(touched_pkgbases,
+                lookups.repo(repo_name(repo_file)),
+                [primary_arch] + lookups.agnostic_arches())
+    if digest is not None:
+        save_digests(repository, primary_arch, digest, records)
     logger.info('Finished database updates for %s.', repo_file)
-    connection.commit()
-    connection.close()
+    with timer.phase('commit'):
+        connection.commit()
+    with timer.phase('relations'):
+        update_reverse_depends(touched_depends)
+    invalidate_details(touched_arches)
+    # announce any maintainers we assigned, now that they are committed
+    flush_maintainers()
+    timer.report(repo_file)
+    if not keep_connection:
+        connection.close()
     return 0
 
+
+class ImportPlan(object):
+    '''What an import of one architecture of a repo db would do.'''
+    def __init__(self, archname, reponame):
+        self.archname = archname
+        self.reponame = reponame
+        self.dbcount = 0
+        self.synccount = 0
+        self.add = []
+        self.remove = []
+        self.update = []
+        self.filesonly = []
+        self.unchanged = 0
+        self.skipped = []
+        self.abort = None
+        # (id, pkgname, old pkgbase, new pkgbase, repo id, arch id) of each
+        # package to add, update or remove, see plan_package_bases()
+        self.base_changes = []
+        # table name -> row counts
+        self.inserts = defaultdict(int)
+        self.deletes = defaultdict(int)
+        self.updates = defaultdict(int)
+
+    def report(self, verbose=False):
+        lines = ['%s (%s): %d packages in web DB, %d in package DB' % (
+                self.reponame, self.archname, self.dbcount, self.synccount)]
+        if self.abort:
+            lines.append('  import would abort: %s' % self.abort)
+        lines.append('  %d to add, %d to update, %d to remove, '
+                '%d files-only, %d unchanged' % (len(self.add),
+                    len(self.update), len(self.remove), len(self.filesonly),
+                    self.unchanged))
+        if self.skipped:
+            lines.append('  %d unchanged but missing from the web DB, '
+                    'would be skipped' % len(self.skipped))
+        if verbose:
+            for label, names in (('add', self.add), ('update', self.update),
+                    ('remove', self.remove), ('files-only', self.filesonly),
+                    ('skip', self.skipped)):
+                if names:
+                    lines.append('  %s: %s' % (label, ' '.join(sorted(names))))
+        tables = sorted(set(self.inserts) | set(self.deletes) |
+                set(self.updates))
+        lines.append('  %-28s %10s %10s %10s' % (
+                'table', 'insert', 'update', 'delete'))
+        for table in tables:
+            lines.append('  %-28s %10d %10d %10d' % (table,
+                self.inserts[table], self.updates[table], self.deletes[table]))
+        totals = [sum(counts.values()) for counts in
+                (self.inserts, self.updates, self.deletes)]
+        lines.append('  %-28s %10d %10d %10d' % tuple(['total'] + totals))
+        lines.append('  estimated write volume: %d rows' % sum(totals))
+        return lines
+
+
+RELATED_MODELS = (Depend, Conflict, Provision, Replacement, PackageGroup,
+        License)
+
+
+def files_outdated(dbpkg, pkg, force=False):
+    '''Whether the stored file list of a package would be replaced by a
+    files-only update; mirrors update_files() and populate_files().'''
+    if pkg.unchanged or not pkg.files:
+        return False
+    if force:
+        return True
+    if not pkg_same_version(pkg, dbpkg):
+        return False
+    if not dbpkg.files_last_update or not dbpkg.last_update:
+        return True
+    return dbpkg.files_last_update < dbpkg.last_update
+
+
+def plan_files(plan, dbpkg, pkg):
+    files = pkg.files_list if pkg.files else None
+    if not files:
+        return
+    rows = file_rows(files)
+    table = PackageFile._meta.db_table
+    if dbpkg is None:
+        plan.inserts[table] += len(rows)
+        return
+    to_delete, to_insert, _ = diff_files(stored_files(dbpkg), rows)
+    plan.inserts[table] += len(to_insert)
+    plan.deletes[table] += len(to_delete)
+
+
+def plan_existing_rows(plan, pkg_ids, models):
+    '''Count the rows of the given related models that deleting or
+    replacing the related data of the given packages would delete.'''
+    for model in models:
+        table = model._meta.db_table
+        for id_chunk in chunked(pkg_ids):
+            plan.deletes[table] += model.objects.filter(
+                    pkg_id__in=id_chunk).count()
+
+
+def plan_reverse_depends(plan, changed, update_ids, remove_ids):
+    '''Estimate the ReverseDepend rows update_reverse_depends() would
+    rewrite and the removal of packages would delete. changed holds a (key,
+    name, depend names, provision names) tuple for each package to add or
+    update, keyed by its id, or by its name if it is new. Only the database
+    as it is now is looked at, so packages changed by the import of another
+    architecture are not taken into account.'''
+    table = ReverseDepend._meta.db_table
+    gone_ids = set(update_ids) | set(remove_ids)
+    remove_ids = set(remove_ids)
+    deleted = set()
+    for id_chunk in chunked(sorted(gone_ids)):
+        deleted.update(ReverseDepend.objects.filter(Q(pkg_id__in=id_chunk) |
+            Q(depend__pkg_id__in=id_chunk)).values_list(
+                'id', flat=True).order_by())
+    plan.deletes[table] += len(deleted)
+
+    # the depends of the changed packages, and what will provide them
+    depend_names = {name for _, _, depends, _ in changed for name in depends}
+    providers = defaultdict(set)
+    for name_chunk in chunked(sorted(depend_names)):
+        for pkg_id, name in Package.objects.filter(
+                pkgname__in=name_chunk).values_list(
+                'id', 'pkgname').order_by():
+            if pkg_id not in remove_ids:
+                providers[name].add(pkg_id)
+        for pkg_id, name in Provision.objects.filter(
+                name__in=name_chunk).values_list('pkg_id', 'name').order_by():
+            if pkg_id not in gone_ids:
+                providers[name].add(pkg_id)
+    # other depends pointing at the changed packages
+    targets = defaultdict(set)
+    for key, name, _, provides in changed:
+        for target in set([name]).union(provides):
+            targets[target].add(key)
+            if target in depend_names:
+                providers[target].add(key)
+    for _, _, depends, _ in changed:
+        plan.inserts[table] += sum(len(providers[name]) for name in depends)
+    for name_chunk in chunked(sorted(targets)):
+        for pkg_id, name in Depend.objects.filter(
+                name__in=name_chunk).values_list('pkg_id', 'name').order_by():
+            if pkg_id not in gone_ids:
+                plan.inserts[table] += len(targets[name])
+
+
+def related_names(pkg):
+    '''The names of the depends and provisions a package would get.'''
+    related = dict(build_related(Package(), pkg))
+    return ([depend.name for depend in related[Depend]],
+            [provision.name for provision in related[Provision]])
+
+
+def plan_update(archname, reponame, pkgs, force=False, filesonly=False):
+    """
+    Works out what db_update() or filesonly_update() would do with a list of
+    packages, and how many rows it would write, without changing anything.
+    Returns an ImportPlan.
+    """
+    repository = lookups.repo(reponame)
+    architecture = lookups.arch(archname)
+    dbpkgs = Package.objects.filter(
+            arch=architecture, repo=repository).order_by()
+    dbdict = {dbpkg.pkgname: dbpkg for dbpkg in dbpkgs}
+    dbset = set(dbdict.keys())
+    syncset = {pkg.name for pkg in pkgs}
+
+    plan = ImportPlan(archname, reponame)
+    plan.dbcount = len(dbset)
+    plan.synccount = len(syncset)
+    package_table = Package._meta.db_table
+    update_table = Update._meta.db_table
+    changed = []
+
+    if not filesonly:
+        try:
+            check_package_ratio(repository, archname, reponame,
+                    len(dbset), len(syncset))
+        except Exception as exc:
+            plan.abort = str(exc)
+
+        for pkg in (pkg for pkg in pkgs if pkg.name not in dbset):
+            if pkg.unchanged:
+                plan.skipped.append(pkg.name)
+                continue
+            plan.add.append(pkg.name)
+            plan.inserts[package_table] += 1
+            plan.inserts[update_table] += 1
+            for model, objects in build_related(Package(), pkg):
+                plan.inserts[model._meta.db_table] += len(objects)
+            plan_files(plan, None, pkg)
+            changed.append((pkg.name, pkg.name) + related_names(pkg))
+            plan.base_changes.append((None, pkg.name, None,
+                pkg.base or pkg.name, repository.id, architecture.id))
+
+        plan.remove = sorted(dbset - syncset)
+        for name in plan.remove:
+            dbpkg = dbdict[name]
+            plan.base_changes.append((dbpkg.id, name, dbpkg.pkgbase, None,
+                repository.id, architecture.id))
+        plan.deletes[package_table] += len(plan.remove)
+        plan.inserts[update_table] += len(plan.remove)
+        plan_existing_rows(plan, [dbdict[name].id for name in plan.remove],
+                RELATED_MODELS + (PackageFile,))
+
+    update_ids = []
+    for pkg in (pkg for pkg in pkgs if pkg.name in dbset):
+        dbpkg = dbdict[pkg.name]
+        if pkg.unchanged:
+            plan.unchanged += 1
+        elif not filesonly and (force or not pkg_same_version(pkg, dbpkg)):
+            plan.update.append(pkg.name)
+            plan.updates[package_table] += 1
+            plan.inserts[update_table] += 1
+            update_ids.append(dbpkg.id)
+            for model, objects in build_related(Package(), pkg):
+                plan.inserts[model._meta.db_table] += len(objects)
+            plan_files(plan, dbpkg, pkg)
+            changed.append((dbpkg.id, pkg.name) + related_names(pkg))
+            plan.base_changes.append((dbpkg.id, pkg.name, dbpkg.pkgbase,
+                pkg.base or pkg.name, repository.id, architecture.id))
+        elif files_outdated(dbpkg, pkg, force):
+            plan.filesonly.append(pkg.name)
+            if filesonly:
+                plan.updates[package_table] += 1
+                plan_files(plan, dbpkg, pkg)
+        else:
+            plan.unchanged += 1
+    # file lists are diffed rather than replaced, see plan_files()
+    plan_existing_rows(plan, update_ids, RELATED_MODELS)
+    if not filesonly:
+        remove_ids = [dbdict[name].id for name in plan.remove]
+        plan_reverse_depends(plan, changed, update_ids, remove_ids)
+
+    # every package added, updated or removed is indexed again, see
+    # update_search_index(); this is one row per package
+    if get_backend() is not None:
+        reindexed = len(plan.update)
+        if filesonly:
+            reindexed += len(plan.filesonly)
+        plan.inserts['packages_search'] += len(plan.add) + reindexed
+        plan.deletes['packages_search'] += len(plan.remove) + reindexed
+
+    return plan
+
+
+def plan_package_bases(plan, plans):
+    '''Count the PackageBase rows, and the rows linking them to their
+    packages, that update_package_bases() would rewrite at the end of the
+    import of a whole repo db file, from the changes of all of its
+    architectures; these go on the plan of its primary architecture.'''
+    changes = [change for other in plans for change in other.base_changes]
+    touched = set()
+    for _, pkgname, old_base, new_base, _, _ in changes:
+        touched.update(name for name in (pkgname, old_base, new_base) if name)
+    touched = sorted(touched)
+
+    # only the rows of the repo and arches being imported are rewritten
+    repo = lookups.repo(plan.reponame)
+    arches = [lookups.arch(other.archname) for other in plans]
+    base_table = PackageBase._meta.db_table
+    Membership = PackageBase.packages.through
+    membership_table = Membership._meta.db_table
+    members = {}
+    for name_chunk in chunked(touched):
+        plan.deletes[base_table] += PackageBase.objects.filter(
+                pkgbase__in=name_chunk, repo=repo, arch__in=arches).count()
+        plan.deletes[membership_table] += Membership.objects.filter(
+                packagebase__pkgbase__in=name_chunk,
+                packagebase__repo=repo, packagebase__arch__in=arches).count()
+        members.update((pkg_id, (pkgbase, repo_id, arch_id))
+                for pkg_id, pkgbase, repo_id, arch_id in
+                Package.objects.filter(pkgbase__in=name_chunk, repo=repo,
+                    arch__in=arches).values_list(
+                    'id', 'pkgbase', 'repo_id', 'arch_id').order_by())
+
+    # apply the changes to get the packages of each base after the import
+    for pkg_id, pkgname, _, new_base, repo_id, arch_id in changes:
+        key = pkg_id if pkg_id is not None else (pkgname, arch_id)
+        if new_base is None:
+            members.pop(key, None)
+        else:
+            members[key] = (new_base, repo_id, arch_id)
+    plan.inserts[base_table] += len(set(members.values()))
+    plan.inserts[membership_table] += len(members)
+
+
+def plan_digests(plan, state, stored, records, plans):
+    '''Count the rows save_digests() would write at the end of the import of
+    a whole repo db file; these go on the plan of its primary architecture.
+    Mirrors save_digests().'''
+    state_table = RepoDatabaseState._meta.db_table
+    if state is None:
+        plan.inserts[state_table] += 1
+    else:
+        plan.updates[state_table] += 1
+
+    # skipped packages are left out, as they never make it into the web DB
+    skipped = {(name, other.archname) for other in plans
+            for name in other.skipped}
+    new = {pkgid: (name, archname, key)
+            for pkgid, name, archname, key in records
+            if (name, archname) not in skipped}
+    table = PackageDigest._meta.db_table
+    kept = 0
+    for pkgid, digest in stored.items():
+        if new.get(pkgid, None) == (digest.pkgname, digest.arch.name,
+                digest.digests()):
+            kept += 1
+        else:
+            plan.deletes[table] += 1
+    plan.inserts[table] += len(new) - kept
+
+
+def group_by_arch(primary_arch, repo_file, packages):
+    '''Group packages by architecture name -- to handle noarch stuff.'''
+    packages_arches = {}
+    for arch in lookups.agnostic_arches():
+        packages_arches[arch.name] = []
+    packages_arches[primary_arch.name] = []
+
+    for package in packages:
+        if package.arch in packages_arches:
+            packages_arches[package.arch].append(package)
+        else:
+            raise Exception(
+                    "Package %s in database %s had wrong architecture %s" % (
+                    package.name, repo_file, package.arch))
+    return packages_arches
+
+
+def plan_repo(primary_arch, repo_file, options):
+    """
+    Parses repo.db.tar.gz file and returns an ImportPlan per architecture
+    describing what read_repo() would do with it, or None if the file is
+    unchanged since the last import. Nothing is written to the database.
+    """
+    primary_arch = locate_arch(primary_arch)
+    force = options.get('force', False)
+    filesonly = options.get('filesonly', False)
+
+    state = None
+    stored = {}
+    known = None
+    if not filesonly:
+        repository = lookups.repo(repo_name(repo_file))
+        state, stored = load_digests(repository, primary_arch)
+        if not force:
+            if state is not None and state.digest == file_digest(repo_file):
+                return None
+            known = stored
+
+    repo, packages = parse_repo(repo_file, known)
+    records = digest_records(packages)
+    packages_arches = group_by_arch(primary_arch, repo_file, packages)
+    del packages
+    plans = [plan_update(arch, repo, packages_arches[arch], force, filesonly)
+            for arch in sorted(packages_arches.keys())]
+    if not filesonly:
+        primary = next(plan for plan in plans
+                if plan.archname == primary_arch.name)
+        plan_package_bases(primary, plans)
+        plan_digests(primary, state, stored, records, plans)
+    return plans
+
 # vim: set ts=4 sw=4 et:
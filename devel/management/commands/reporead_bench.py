@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+reporead_bench command
+
+Micro-benchmarks for the repo db parsing paths used by reporead. Every member
+of the given package database is read into memory first, so only parsing is
+timed; each case is run several times and the best time is reported.
+
+Usage: ./manage.py reporead_bench PATH
+ PATH:  full path to a repo.db.tar.gz or repo.files.tar.gz file.
+
+Example:
+  ./manage.py reporead_bench /tmp/core.files.tar.gz
+"""
+
+from datetime import datetime
+import gc
+import io
+import os
+import tarfile
+from optparse import make_option
+from timeit import default_timer
+
+from pytz import utc
+
+from django.core.management.base import BaseCommand, CommandError
+
+from devel.management.commands.reporead import (DEPEND_RE, RepoPackage,
+        parse_info, tokenize_info, split_relation)
+from packages.utils import parse_version
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', action='store', type='int', dest='repeat',
+            default=5, help='Number of times to run each benchmark.'),
+    )
+    help = "Times the repo db parsers used by reporead."
+    args = "<filename>"
+
+    def handle(self, filename=None, **options):
+        if not filename:
+            raise CommandError('Package database file is required.')
+        if not os.path.isfile(filename):
+            raise CommandError('Specified package database file does not exist.')
+        repeat = options['repeat']
+        if repeat < 1:
+            raise CommandError('--repeat must be at least 1.')
+
+        members = read_members(filename)
+        info = [(data,) for fname, data in members if fname != 'files']
+        files = [(data,) for fname, data in members if fname == 'files']
+        relations = collect_relations(info)
+        self.stdout.write('%d desc/depends members, %d files members, '
+                '%d relations\n' % (len(info), len(files), len(relations)))
+
+        cases = (
+            ('desc/depends', info, parse_members_reference,
+                parse_members_tokenizer),
+            ('files', files, parse_info_reference, tokenize_info),
+            ('relations', relations, split_relation_reference,
+                split_relation),
+        )
+        for name, items, reference, current in cases:
+            if not items:
+                continue
+            before = best_time(reference, items, repeat)
+            after = best_time(current, items, repeat)
+            self.stdout.write('%-14s reference %8.4fs  current %8.4fs  '
+                    '%5.1fx\n' % (name, before, after,
+                        before / after if after else 0.0))
+
+
+def read_members(filename):
+    members = []
+    with tarfile.open(filename, 'r') as repodb:
+        for tarinfo in repodb.getmembers():
+            if not tarinfo.isreg():
+                continue
+            fname = os.path.basename(tarinfo.name)
+            if fname in ('desc', 'depends', 'files'):
+                members.append((fname, repodb.extractfile(tarinfo).read()))
+    return members
+
+
+def collect_relations(info):
+    relations = []
+    for data, in info:
+        values = tokenize_info(data)
+        for field in RepoPackage.collections:
+            describe = field in RepoPackage.described
+            relations.extend((value, describe)
+                    for value in values.get(field, ()))
+    return relations
+
+
+def best_time(func, items, repeat):
+    # like timeit, keep the garbage collector from skewing the results
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        best = None
+        for _ in range(repeat):
+            start = default_timer()
+            for args in items:
+                func(*args)
+            elapsed = default_timer() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return best
+
+
+def parse_info_reference(data):
+    data_file = io.TextIOWrapper(io.BytesIO(data), encoding='UTF-8')
+    try:
+        return parse_info(data_file)
+    finally:
+        data_file.close()
+
+
+class ReferencePackage(RepoPackage):
+    '''RepoPackage with the if/elif chain populate() used to have. Without
+    __slots__ of its own, so unknown keys end up as attributes like they used
+    to.'''
+
+    def populate(self, values):
+        for k, v in values.iteritems():
+            # ensure we stay under our DB character limit
+            if k in self.bare:
+                setattr(self, k, v[0][:254])
+            elif k in self.number:
+                setattr(self, k, long(v[0]))
+            elif k in ('desc', 'pgpsig'):
+                # do NOT prune these values at all
+                setattr(self, k, v[0])
+            elif k == 'version':
+                self.ver, self.rel, self.epoch = parse_version(v[0])
+            elif k == 'builddate':
+                try:
+                    builddate = datetime.utcfromtimestamp(int(v[0]))
+                    self.builddate = builddate.replace(tzinfo=utc)
+                except ValueError:
+                    pass
+            else:
+                # anything left in collections
+                setattr(self, k, tuple(v))
+
+
+def parse_members_reference(data):
+    pkg = ReferencePackage('bench')
+    pkg.populate(parse_info_reference(data))
+    return pkg
+
+
+def parse_members_tokenizer(data):
+    pkg = RepoPackage('bench')
+    pkg.populate(tokenize_info(data))
+    return pkg
+
+
+def split_relation_reference(value, describe=False):
+    '''The regex-for-everything relation parsing reporead used to do.'''
+    description = None
+    if describe:
+        parts = value.split(': ', 1)
+        if len(parts) > 1:
+            description = parts[1].strip()
+        value = parts[0].strip()
+    match = DEPEND_RE.match(value)
+    if match:
+        return (match.group(1), match.group(3), match.group(4), description)
+    return None
+
+# vim: set ts=4 sw=4 et:
@@ -12,12 +12,25 @@
 also the default template if none is specified. While 'repo' is not required to
 be present in the path_template, note that 'arch' is so reporead can function
 correctly.
+
+Imports are run by a scheduler with a bounded number of workers; core and
+testing repos are imported first. Sending SIGUSR1 to the process logs the
+current queue depth and per-database import timings.
+
+By default every import runs in a freshly forked process. With --persistent,
+each worker instead keeps a long-lived, pre-warmed import process around that
+is recycled after a number of imports or once it grows too large.
 """
 
+import heapq
+import itertools
 import logging
 import multiprocessing
+from optparse import make_option
 import os
 import pyinotify
+import resource
+import signal
 import sys
 import threading
 import time
@@ -26,7 +39,7 @@
 from django.db import connection, transaction
 
 from main.models import Arch, Repo
-from .reporead import read_repo
+from .reporead import read_repo, repo_name, warm_caches
 
 logging.basicConfig(
     level=logging.WARNING,
@@ -36,6 +49,18 @@
 logger = logging.getLogger()
 
 class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=2,
+            help='Maximum number of imports to run at the same time.'),
+        make_option('--max-load', type='float', dest='max_load', default=None,
+            help='Do not start new imports while the 1-minute load average is above this value.'),
+        make_option('--persistent', action='store_true', dest='persistent', default=False,
+            help='Run imports in long-lived, pre-warmed worker processes instead of forking a new process for each import.'),
+        make_option('--max-jobs', type='int', dest='max_jobs', default=25,
+            help='Recycle a persistent worker process after this many imports.'),
+        make_option('--max-rss', type='int', dest='max_rss', default=512,
+            help='Recycle a persistent worker process once its peak memory usage exceeds this many MiB.'),
+    )
     help = "Watch database files and run an update when necessary."
     args = "[path_template]"
 
@@ -52,6 +77,19 @@ def handle(self, path_template=None, **options):
             path_template = '/srv/ftp/%(repo)s/os/%(arch)s/'
         self.path_template = path_template
 
+        workers = options.get('workers', 2)
+        if workers < 1:
+            raise CommandError('At least one worker is required.')
+        runner = None
+        if options.get('persistent', False):
+            runner = PersistentRunner(
+                    max_jobs=options.get('max_jobs', 25),
+                    max_rss=options.get('max_rss', 512))
+        self.scheduler = ImportScheduler(workers=workers,
+                max_load=options.get('max_load', None), runner=runner)
+        signal.signal(signal.SIGUSR1,
+                lambda signum, frame: self.scheduler.log_stats())
+
         notifier = self.setup_notifier()
         # this thread is done using the database; all future access is done in
         # the spawned read_repo() processes, so close the otherwise completely
@@ -76,6 +114,7 @@ def setup_notifier(self):
         transaction.commit_manually()
         arches = Arch.objects.filter(agnostic=False)
         repos = Repo.objects.all()
+        priorities = {repo.name.lower(): repo_priority(repo) for repo in repos}
         transaction.set_dirty()
         arch_path_map = {arch: None for arch in arches}
         all_paths = set()
@@ -107,18 +146,225 @@ def setup_notifier(self):
         for name in all_paths:
             manager.add_watch(name, mask)
 
-        handler = EventHandler(arch_paths=arch_path_map)
+        handler = EventHandler(arch_paths=arch_path_map,
+                priorities=priorities, scheduler=self.scheduler)
         return pyinotify.Notifier(manager, handler)
 
 
+def repo_priority(repo):
+    '''Import priority of a repo; lower values are imported first.'''
+    if repo.testing or repo.name.lower() == 'core':
+        return 0
+    if repo.staging:
+        return 2
+    return 1
+
+
+class ImportScheduler(object):
+    '''Hands databases that are due for an import to a bounded number of
+    worker threads, each running one import at a time. Waiting databases are
+    ordered by priority, then by the time they became due. A database is never
+    queued twice; events arriving while it waits are coalesced into the
+    pending import. If a maximum load is given, workers hold off starting new
+    imports while the system is busier than that.'''
+    def __init__(self, workers=2, max_load=None, poll_interval=10.0,
+            runner=None):
+        self.max_load = max_load
+        self.runner = runner
+        self.poll_interval = poll_interval
+        self.queue = []
+        self.counter = itertools.count()
+        self.running = 0
+        self.stats = {}
+        self.condition = threading.Condition()
+        self.workers = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work,
+                    name='reporead-worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.workers.append(thread)
+
+    def submit(self, database):
+        with self.condition:
+            # in the same order as _next(), which clears the flag
+            with database.lock:
+                if database.queued:
+                    logger.debug('Database %s already queued', database.path)
+                    return
+                database.queued = True
+                database.queued_at = time.time()
+            entry = (database.priority, database.queued_at,
+                    next(self.counter), database)
+            heapq.heappush(self.queue, entry)
+            logger.info('Queued %s for import (priority %d), %d queued, '
+                    '%d running', database.path, database.priority,
+                    len(self.queue), self.running)
+            self.condition.notify()
+
+    def _overloaded(self):
+        if self.max_load is None:
+            return False
+        return os.getloadavg()[0] > self.max_load
+
+    def _next(self):
+        with self.condition:
+            while True:
+                while not self.queue:
+                    self.condition.wait()
+                if not self._overloaded():
+                    break
+                logger.info('Load average above %.1f, delaying %d queued '
+                        'imports', self.max_load, len(self.queue))
+                self.condition.wait(self.poll_interval)
+            _, _, _, database = heapq.heappop(self.queue)
+            # in one step, so events arriving in between are neither lost
+            # nor start a second import of the same database
+            with database.lock:
+                database.queued = False
+                database.updating = True
+            self.running += 1
+            return database
+
+    def _work(self):
+        # each worker thread gets its own long-lived process, if any
+        worker = None
+        if self.runner is not None:
+            worker = self.runner.worker()
+        while True:
+            database = self._next()
+            waited = time.time() - database.queued_at
+            started = time.time()
+            try:
+                database.update(worker)
+            except Exception:
+                logger.exception('Import of %s failed', database.path)
+            finally:
+                elapsed = time.time() - started
+                with self.condition:
+                    self.running -= 1
+                    self.record(database, waited, elapsed)
+                    logger.info('Imported %s in %.1f seconds (waited %.1f), '
+                            '%d queued, %d running', database.path, elapsed,
+                            waited, len(self.queue), self.running)
+
+    def record(self, database, waited, elapsed):
+        stats = self.stats.setdefault(database.path, {
+            'count': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0,
+            'waited': 0.0})
+        stats['count'] += 1
+        stats['total'] += elapsed
+        stats['max'] = max(stats['max'], elapsed)
+        stats['last'] = elapsed
+        stats['waited'] += waited
+
+    def log_stats(self):
+        with self.condition:
+            logger.warning('%d imports queued, %d running, %d workers',
+                    len(self.queue), self.running, len(self.workers))
+            for path, stats in sorted(self.stats.items()):
+                logger.warning('%s: %d imports, last %.1fs, avg %.1fs, '
+                        'max %.1fs, avg wait %.1fs', path, stats['count'],
+                        stats['last'], stats['total'] / stats['count'],
+                        stats['max'], stats['waited'] / stats['count'])
+
+
+def import_worker(conn, nice, max_jobs, max_rss):
+    '''Main loop of a persistent import process. Jobs are (arch, path) tuples
+    received over conn; each gets a (success, retiring) reply. The process
+    exits after max_jobs imports or once its peak RSS exceeds max_rss MiB, as
+    that is the only way to give the memory back to the system.'''
+    if nice != 0:
+        os.nice(nice)
+    warm_caches()
+    jobs = 0
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        arch, path = job
+        connection.close_if_unusable_or_obsolete()
+        try:
+            read_repo(arch, path, {'stream': True, 'keep_connection': True})
+            success = True
+        except Exception:
+            logger.exception('Import of %s failed', path)
+            success = False
+        jobs += 1
+        # ru_maxrss is reported in KiB on Linux
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        retiring = jobs >= max_jobs or rss > max_rss
+        if retiring:
+            logger.info('Import worker %d retiring after %d jobs, '
+                    'peak RSS %d MiB', os.getpid(), jobs, rss)
+        conn.send((success, retiring))
+        if retiring:
+            break
+    connection.close()
+    conn.close()
+
+
+class PersistentRunner(object):
+    '''Settings for persistent import processes; hands out one
+    PersistentWorker per scheduler thread.'''
+    def __init__(self, max_jobs=25, max_rss=512, nice=3):
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self.nice = nice
+
+    def worker(self):
+        return PersistentWorker(self)
+
+
+class PersistentWorker(object):
+    '''A handle on a long-lived import process, started on first use and
+    replaced whenever the process retires or dies.'''
+    def __init__(self, runner):
+        self.runner = runner
+        self.process = None
+        self.conn = None
+
+    def _start(self):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=import_worker,
+                args=(child_conn, self.runner.nice, self.runner.max_jobs,
+                    self.runner.max_rss))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        logger.info('Started import worker %d', self.process.pid)
+
+    def _stop(self):
+        self.conn.close()
+        self.process.join()
+        self.process = self.conn = None
+
+    def run(self, arch, path):
+        if self.process is None or not self.process.is_alive():
+            self._start()
+        try:
+            self.conn.send((arch, path))
+            success, retiring = self.conn.recv()
+        except (EOFError, IOError):
+            logger.error('Import worker %d died while importing %s',
+                    self.process.pid, path)
+            self._stop()
+            return False
+        if retiring:
+            self._stop()
+        return success
+
+
 class Database(object):
     '''A object representing a pacman database on the filesystem. It stores
     various bits of metadata and state representing the file path, when we last
     updated, how long our delay is before performing the update, whether we are
     updating now, etc.'''
-    def __init__(self, arch, path, delay=60.0, nice=3):
+    def __init__(self, arch, path, scheduler, priority=1, delay=60.0, nice=3):
         self.arch = arch
         self.path = path
+        self.scheduler = scheduler
+        self.priority = priority
         self.delay = delay
         self.nice = nice
         self.mtime = None
@@ -126,14 +372,22 @@ def __init__(self, arch, path, delay=60.0, nice=3):
         self.update_thread = None
         self.updating = False
         self.run_again = False
+        # managed by the scheduler
+        self.queued = False
+        self.queued_at = None
         self.lock = threading.Lock()
 
     def _start_update_countdown(self):
-        self.update_thread = threading.Timer(self.delay, self.update)
+        self.update_thread = threading.Timer(self.delay, self._submit)
         logger.info('Starting %.1f second countdown to update %s',
                 self.delay, self.path)
         self.update_thread.start()
 
+    def _submit(self):
+        with self.lock:
+            self.update_thread = None
+        self.scheduler.submit(self)
+
     def queue_for_update(self, mtime):
         logger.debug('Queueing database %s...', self.path)
         with self.lock:
@@ -142,25 +396,34 @@ def queue_for_update(self, mtime):
                 # store the fact that we will need to run it again
                 self.run_again = True
                 return
+            if self.queued:
+                # the pending import will pick up these changes too
+                return
             if self.update_thread:
                 self.update_thread.cancel()
                 self.update_thread = None
             self._start_update_countdown()
 
-    def update(self):
+    def update(self, worker=None):
         logger.debug('Updating database %s...', self.path)
         with self.lock:
             self.last_import = time.time()
             self.updating = True
 
         try:
+            if worker is not None:
+                # hand off to an already running import process
+                worker.run(self.arch.name, self.path)
+                return
+
             # invoke reporead's primary method. we do this in a separate
-            # process for memory conservation purposes; these processes grow
-            # rather large so it is best to free up the memory ASAP.
+            # process for memory conservation purposes; even when streaming
+            # the database these processes grow, so it is best to free up the
+            # memory ASAP.
             def run():
                 if self.nice != 0:
                     os.nice(self.nice)
-                read_repo(self.arch, self.path, {})
+                read_repo(self.arch, self.path, {'stream': True})
 
             process = multiprocessing.Process(target=run)
             process.start()
@@ -183,6 +446,8 @@ class EventHandler(pyinotify.ProcessEvent):
     def my_init(self, **kwargs):
         self.databases = {}
         self.arch_lookup = {}
+        self.priorities = kwargs['priorities']
+        self.scheduler = kwargs['scheduler']
 
         # we really want a single path to arch mapping, so massage the data
         arch_paths = kwargs['arch_paths']
@@ -207,7 +472,8 @@ def process_default(self, event):
                             'Could not determine arch for %s, skipping update',
                             path)
                     return
-                database = Database(arch, path)
+                priority = self.priorities.get(repo_name(path), 1)
+                database = Database(arch, path, self.scheduler, priority)
                 self.databases[path] = database
             database.queue_for_update(stat.st_mtime)
 
@@ -1,5 +1,4 @@
 from datetime import timedelta
-import pytz
 
 from django.db.models import F
 from django.template.defaultfilters import filesizeformat
@@ -104,42 +103,35 @@ def unneeded_orphans(packages, username):
 
 
 def mismatched_signature(packages, username):
-    filtered = []
+    # signed with a key that is unknown or does not belong to the packager
     packages = packages.select_related(
-            'arch', 'repo', 'packager').filter(signature_bytes__isnull=False)
+            'arch', 'repo', 'packager').filter(
+            signature_key_id__isnull=False).extra(where=['''NOT EXISTS (
+            SELECT 1 FROM devel_developerkey dk
+            WHERE dk.key = packages.signature_key_id
+            AND dk.owner_id = packages.packager_id)'''])
     known_keys = DeveloperKey.objects.select_related(
             'owner').filter(owner__isnull=False)
     known_keys = {dk.key: dk for dk in known_keys}
+    packages = list(packages)
     for package in packages:
-        bad = False
-        sig = package.signature
-        dev_key = known_keys.get(sig.key_id, None)
+        dev_key = known_keys.get(package.signature_key_id, None)
         if dev_key:
             package.sig_by = dev_key.owner
-            if dev_key.owner_id != package.packager_id:
-                bad = True
         else:
-            package.sig_by = sig.key_id
-            bad = True
-
-        if bad:
-            filtered.append(package)
-    return filtered
+            package.sig_by = package.signature_key_id
+    return packages
 
 
 def signature_time(packages, username):
     cutoff = timedelta(hours=24)
-    filtered = []
     packages = packages.select_related(
-            'arch', 'repo', 'packager').filter(signature_bytes__isnull=False)
+            'arch', 'repo', 'packager').filter(
+            signature_time__gt=F('build_date') + cutoff)
+    packages = list(packages)
     for package in packages:
-        sig = package.signature
-        sig_date = sig.creation_time.replace(tzinfo=pytz.utc)
-        package.sig_date = sig_date.date()
-        if sig_date > package.build_date + cutoff:
-            filtered.append(package)
-
-    return filtered
+        package.sig_date = package.signature_time.date()
+    return packages
 
 
 REPORT_OLD = DeveloperReport('old', 'Old',
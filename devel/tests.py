@@ -1,8 +1,45 @@
+from datetime import datetime, timedelta
+import io
+import logging
+import os
+import re
+import shutil
+import struct
+import sys
+import tarfile
+import tempfile
+import threading
+import types
+import unittest
+
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now, utc
 
+from main.models import Arch, Package, PackageFile, Repo
+from main.utils import signature_info
+from packages.models import (Conflict, Depend, License, PackageBase,
+        PackageGroup, PackageRelation, Provision, RepoDatabaseState,
+        ReverseDepend, Update)
+from .management.commands.reporead import (Relation, RepoPackage,
+        parse_info, read_repo, split_relation, tokenize_info)
+try:
+    import pyinotify
+except ImportError:
+    # only the event handler needs pyinotify, the scheduler does not
+    pyinotify = sys.modules['pyinotify'] = types.ModuleType('pyinotify')
+    pyinotify.ProcessEvent = object
+    from .management.commands.reporead_inotify import (Database,
+            ImportScheduler)
+    del sys.modules['pyinotify']
+else:
+    from .management.commands.reporead_inotify import (Database,
+            ImportScheduler)
+from .models import DeveloperKey, UserProfile
+from .reports import mismatched_signature, signature_time
 from .utils import UserFinder
-from .models import UserProfile
 
 class DevelTest(TestCase):
     def test_index(self):
@@ -112,4 +149,350 @@ def test_ambiguous(self):
                 self.finder.find("Tim Two <tim@anotherdomain.com>"))
         self.assertIsNone(self.finder.find("Tim <tim@anotherdomain.com>"))
 
+
+class PreloadedFindUserTest(FindUserTest):
+    '''Run the same lookups against the in-memory indexes.'''
+
+    def setUp(self):
+        super(PreloadedFindUserTest, self).setUp()
+        self.finder.preload()
+
+    def test_no_queries(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(self.user1,
+                    self.finder.find("XXX YYY <user1@example.com>"))
+            self.assertEqual(self.user2,
+                    self.finder.find_by_email("john@awesome.com"))
+            self.assertEqual(self.user3,
+                    self.finder.find_by_username("bjones"))
+
+    def test_find_all(self):
+        found = self.finder.find_all(["Joe User", "Tim <tim@example.com>",
+            "Tim <bogus@example.com>", "Joe User"])
+        self.assertEqual({
+            "Joe User": self.user1,
+            "Tim <tim@example.com>": self.user4,
+            "Tim <bogus@example.com>": None,
+        }, found)
+
+    def test_refresh(self):
+        user6 = User.objects.create(username="newuser", first_name="New",
+                last_name="User", email="new@example.com")
+        self.assertIsNone(self.finder.find_by_username("newuser"))
+        self.finder.preload()
+        self.assertEqual(user6, self.finder.find_by_username("newuser"))
+
+
+class RepoDbParseTest(unittest.TestCase):
+
+    def reference(self, data):
+        return parse_info(io.TextIOWrapper(io.BytesIO(data), encoding='UTF-8'))
+
+    def test_tokenize_info(self):
+        samples = (
+            "%NAME%\nfoo\n\n%VERSION%\n1.0-1\n\n%DEPENDS%\nbar\nbaz>=2\n\n",
+            "%FILES%\nusr/\nusr/bin/\nusr/bin/foo\n",
+            "%A%\na\n\n\n%B%\n  b \n\n c\n%C%\nx\n%D%\n\n",
+            "%A%\r\nx\r\n\r\n%B%\r\ny\r\n",
+            "\n\n%EMPTY%\n\n",
+            "",
+        )
+        for data in samples:
+            self.assertEqual(self.reference(data), tokenize_info(data))
+
+    def test_tokenize_info_invalid(self):
+        with self.assertRaises(Exception):
+            tokenize_info("foo\n")
+        with self.assertRaises(UnicodeDecodeError):
+            tokenize_info("%NAME%\n\xff\n")
+
+    def test_split_relation(self):
+        self.assertEqual(Relation('foo', None, None, None),
+                split_relation('foo'))
+        self.assertEqual(Relation('foo', '>=', '1.0', None),
+                split_relation('foo>=1.0'))
+        self.assertEqual(Relation('foo', '=', '1:2.0-1', None),
+                split_relation('foo=1:2.0-1', describe=True))
+        self.assertEqual(Relation('foo', '<', '2', 'for bar: baz'),
+                split_relation('foo<2: for bar: baz', describe=True))
+        self.assertEqual(Relation('foo: bar', None, None, None),
+                split_relation('foo: bar'))
+        self.assertIsNone(split_relation(''))
+
+    def test_populate_unknown(self):
+        pkg = RepoPackage('core')
+        pkg.populate(tokenize_info("%NAME%\nfoo\n\n%FOO%\nbar\n\n"
+            "%XDATA%\npkgtype=pkg\n\n%VERSION%\n1:2.0-3\n\n"
+            "%DEPENDS%\nbar>=1\n\n"))
+        self.assertEqual('foo', pkg.name)
+        self.assertEqual(('2.0', '3', 1), (pkg.ver, pkg.rel, pkg.epoch))
+        self.assertEqual(('bar>=1',), pkg.depends)
+        self.assertFalse(hasattr(pkg, 'foo'))
+
+
+# some backends log queries as "QUERY = u'...' - PARAMS = (...)"
+WRITE_RE = re.compile(r"^(?:QUERY = u?')?(?:INSERT|UPDATE|DELETE)\b")
+
+
+def write_repo(path, packages):
+    '''Write a repo .files.tar.gz holding the given packages, as (name,
+    version, depends, provides, files) tuples.'''
+    def add(name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        repo.addfile(info, io.BytesIO(data))
+
+    repo = tarfile.open(path, 'w:gz')
+    for name, version, depends, provides, files in packages:
+        entry = '%s-%s' % (name, version)
+        desc = ['%FILENAME%', entry + '-x86_64.pkg.tar.xz', '',
+                '%NAME%', name, '', '%BASE%', name.split('-')[0], '',
+                '%VERSION%', version, '', '%DESC%', 'The %s package' % name,
+                '', '%CSIZE%', '1000', '', '%ISIZE%', '2000', '',
+                '%LICENSE%', 'GPL', '', '%ARCH%', 'x86_64', '',
+                '%BUILDDATE%', '1400000000', '',
+                '%PACKAGER%', 'Joe User <joe@example.com>', '',
+                '%PGPSIG%', 'iQEcBAABAgAGBQJTk3qf', '',
+                '%GROUPS%', 'base', '', '%PROVIDES%'] + list(provides) + [
+                '', '%DEPENDS%'] + list(depends) + [
+                '', '%CONFLICTS%', name + '-git', '']
+        add(entry + '/desc', '\n'.join(desc) + '\n')
+        add(entry + '/files', '%FILES%\n' + '\n'.join(files) + '\n')
+    repo.close()
+
+
+def package_files(name):
+    return ['usr/', 'usr/bin/', 'usr/bin/' + name, 'usr/share/%s/' % name,
+            'usr/share/%s/README' % name]
+
+
+class RepoImportTest(TransactionTestCase):
+    fixtures = ['arches', 'repos']
+    modes = (('default', {}), ('bulk', {'bulk': True}),
+            ('stream', {'stream': True}))
+    packages = [
+        ('glibc', '2.19-1', [], ['libc.so=6-64'], package_files('glibc')),
+        ('gawk', '4.1.1-1', ['glibc', 'sh'], ['awk'], package_files('gawk')),
+        ('bash', '4.3-1', ['glibc>=2.19', 'gawk-doc'], ['sh'],
+            package_files('bash')),
+        ('gawk-doc', '4.1.1-1', [], [], package_files('gawk-doc')),
+    ]
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'core.files.tar.gz')
+        # importing into an empty web database warns every time
+        logging.disable(logging.WARNING)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def import_repo(self, packages, **options):
+        write_repo(self.path, packages)
+        options['keep_connection'] = True
+        self.assertEqual(0, read_repo('x86_64', self.path, options))
+
+    def changed(self):
+        '''The packages with bash updated, gawk-doc gone, and sed added.'''
+        packages = [pkg for pkg in self.packages if pkg[0] != 'gawk-doc']
+        bash_files = package_files('bash')[:-1] + ['usr/share/bash/NEWS']
+        packages[2] = ('bash', '4.3-2', ['glibc>=2.19', 'readline'], ['sh'],
+                bash_files)
+        packages.append(('sed', '4.2.2-1', ['glibc', 'sh'], [],
+            package_files('sed')))
+        return packages
+
+    def rows(self):
+        '''Everything an import writes, without ids and timestamps.'''
+        tables = (
+            (Package, ('pkgname', 'pkgbase', 'repo__name', 'arch__name',
+                'pkgver', 'pkgrel', 'epoch', 'pkgdesc', 'filename',
+                'compressed_size', 'installed_size', 'build_date',
+                'packager_str', 'flag_date')),
+            (PackageFile, ('pkg__pkgname', 'is_directory', 'directory',
+                'filename')),
+            (Depend, ('pkg__pkgname', 'name', 'comparison', 'version',
+                'deptype')),
+            (Provision, ('pkg__pkgname', 'name', 'version')),
+            (Conflict, ('pkg__pkgname', 'name')),
+            (PackageGroup, ('pkg__pkgname', 'name')),
+            (License, ('pkg__pkgname', 'name')),
+            (ReverseDepend, ('pkg__pkgname', 'depend__pkg__pkgname',
+                'depend__name')),
+            (PackageBase, ('pkgbase', 'base__pkgname', 'pkgver', 'pkgrel',
+                'packages__pkgname')),
+            (Update, ('pkgname', 'action_flag', 'old_pkgver', 'old_pkgrel',
+                'new_pkgver', 'new_pkgrel')),
+        )
+        return {model.__name__: sorted(model.objects.values_list(*fields))
+                for model, fields in tables}
+
+    def clear(self):
+        for model in (Package, Update, PackageBase, PackageRelation,
+                RepoDatabaseState):
+            model.objects.all().delete()
+
+    def test_modes_agree(self):
+        results = {}
+        for mode, options in self.modes:
+            self.clear()
+            self.import_repo(self.packages, **options)
+            self.import_repo(self.changed(), **options)
+            results[mode] = self.rows()
+        rows = results['default']
+        self.assertEqual(['bash', 'gawk', 'glibc', 'sed'],
+                [row[0] for row in rows['Package']])
+        self.assertIn(('bash', 'sed', 'sh'), rows['ReverseDepend'])
+        self.assertNotIn(('gawk-doc', 'bash', 'gawk-doc'),
+                rows['ReverseDepend'])
+        for mode, _ in self.modes:
+            self.assertEqual(results['default'], results[mode], mode)
+
+    def test_reimport_writes_nothing(self):
+        for mode, options in self.modes:
+            self.clear()
+            self.import_repo(self.packages, **options)
+            rows = self.rows()
+            digest = RepoDatabaseState.objects.get().digest
+            # the very same file is skipped as a whole, the same packages in
+            # another file one by one
+            for packages in (self.packages, self.packages[::-1]):
+                with CaptureQueriesContext(connection) as context:
+                    self.import_repo(packages, **options)
+                writes = [query['sql'] for query in context.captured_queries
+                        if WRITE_RE.match(query['sql'])
+                        and 'packages_repodatabasestate' not in query['sql']]
+                self.assertEqual([], writes, mode)
+            self.assertEqual(rows, self.rows(), mode)
+            self.assertNotEqual(digest,
+                    RepoDatabaseState.objects.get().digest, mode)
+
+    def test_file_list_diff(self):
+        for mode, options in self.modes:
+            self.clear()
+            self.import_repo(self.packages, **options)
+            before = dict(((f.directory, f.filename), f.id) for f in
+                    PackageFile.objects.filter(pkg__pkgname='bash'))
+            self.import_repo(self.changed(), **options)
+            after = dict(((f.directory, f.filename), f.id) for f in
+                    PackageFile.objects.filter(pkg__pkgname='bash'))
+            self.assertEqual(set(before) - {('usr/share/bash/', 'README')},
+                    set(after) - {('usr/share/bash/', 'NEWS')}, mode)
+            # the files that stayed the same kept their rows
+            for path, file_id in after.items():
+                if path in before:
+                    self.assertEqual(before[path], file_id, mode)
+
+
+class ImportSchedulerTest(unittest.TestCase):
+
+    def test_coalesce(self):
+        started = threading.Event()
+        release = threading.Event()
+        imports = []
+
+        class FakeDatabase(Database):
+            def update(self, worker=None):
+                imports.append(self.path)
+                started.set()
+                release.wait(10)
+
+        scheduler = ImportScheduler(workers=1)
+        busy = FakeDatabase('x86_64', 'extra.db', scheduler)
+        waiting = FakeDatabase('x86_64', 'core.db', scheduler)
+        scheduler.submit(busy)
+        self.assertTrue(started.wait(10))
+        for _ in range(3):
+            scheduler.submit(waiting)
+        self.assertEqual(1, len(scheduler.queue))
+        # events for the running import wait for it to finish
+        busy.queue_for_update(1)
+        self.assertTrue(busy.run_again)
+        self.assertIsNone(busy.update_thread)
+        release.set()
+        for _ in range(100):
+            with scheduler.condition:
+                if not scheduler.queue and not scheduler.running:
+                    break
+            threading.Event().wait(0.1)
+        self.assertEqual(['extra.db', 'core.db'], imports)
+
+    def test_max_load(self):
+        imported = threading.Event()
+        load = [10.0]
+
+        class FakeDatabase(Database):
+            def update(self, worker=None):
+                imported.set()
+
+        scheduler = ImportScheduler(workers=1, max_load=1.0,
+                poll_interval=0.01)
+        scheduler._overloaded = lambda: load[0] > scheduler.max_load
+        scheduler.submit(FakeDatabase('x86_64', 'core.db', scheduler))
+        self.assertFalse(imported.wait(0.2))
+        self.assertEqual(1, len(scheduler.queue))
+        load[0] = 0.5
+        self.assertTrue(imported.wait(10))
+
+
+def make_signature(key_id, timestamp):
+    '''A minimal v4 signature packet; enough for the key id and creation
+    time to be read back, not to verify anything.'''
+    hashed = struct.pack('>BBI', 5, 2, timestamp)
+    unhashed = struct.pack('>BB', 9, 16) + key_id.decode('hex')
+    body = (struct.pack('>BBBBH', 4, 0, 1, 8, len(hashed)) + hashed +
+            struct.pack('>H', len(unhashed)) + unhashed +
+            b'\0\0' + struct.pack('>H', 8) + b'\xff')
+    return struct.pack('>BB', 0x88, len(body)) + body
+
+
+class SignatureReportTest(TestCase):
+    fixtures = ['arches', 'repos']
+
+    def create(self, pkgname, packager, key_id, signed):
+        return Package.objects.create(pkgname=pkgname, pkgbase=pkgname,
+                pkgver='1.0', pkgrel='1', repo=Repo.objects.get(name='Core'),
+                arch=Arch.objects.get(name='x86_64'), filename=pkgname,
+                compressed_size=1, installed_size=1, last_update=now(),
+                created=now(), build_date=self.built, packager=packager,
+                packager_str='Joe User', signature_key_id=key_id,
+                signature_time=signed)
+
+    def setUp(self):
+        self.built = datetime(2014, 5, 1, tzinfo=utc)
+        self.joe = User.objects.create(username="joe")
+        self.jane = User.objects.create(username="jane")
+        DeveloperKey.objects.create(owner=self.joe, key='0123456789ABCDEF',
+                created=now())
+        later = self.built + timedelta(hours=1)
+        self.create('good', self.joe, '0123456789ABCDEF', later)
+        self.create('other', self.jane, '0123456789ABCDEF', later)
+        self.create('unknown', self.joe, 'FEDCBA9876543210', later)
+        self.create('late', self.joe, '0123456789ABCDEF',
+                self.built + timedelta(days=2))
+        self.create('unsigned', self.joe, None, None)
+
+    def test_signature_info(self):
+        self.assertEqual((None, None), signature_info(None))
+        self.assertEqual(('0123456789ABCDEF',
+            datetime(2014, 5, 13, 16, 53, 20, tzinfo=utc)),
+            signature_info(make_signature('0123456789ABCDEF', 1400000000)))
+        truncated = make_signature('0123456789ABCDEF', 1400000000)[:12]
+        self.assertEqual((None, None), signature_info(truncated))
+
+    def test_mismatched_signature(self):
+        with self.assertNumQueries(2):
+            packages = mismatched_signature(Package.objects.all(), None)
+        sig_by = {pkg.pkgname: pkg.sig_by for pkg in packages}
+        self.assertEqual({'other': self.joe, 'unknown': 'FEDCBA9876543210'},
+                sig_by)
+
+    def test_signature_time(self):
+        with self.assertNumQueries(1):
+            packages = signature_time(Package.objects.all(), None)
+        self.assertEqual(['late'], [pkg.pkgname for pkg in packages])
+        self.assertEqual(self.built.date() + timedelta(days=2),
+                packages[0].sig_date)
+
 # vim: set ts=4 sw=4 et:
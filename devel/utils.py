@@ -58,12 +58,111 @@ def new_func(*args, **kwargs):
     return new_func
 
 
+# marker for index keys that match more than one user
+AMBIGUOUS = object()
+
+
+def quoted_token(token):
+    return re.match(r'^[\'"].*[\'"]$', token) is not None
+
+
+class UserIndex(object):
+    '''In-memory indexes over all users and their profiles. It offers the same
+    matchers as UserFinder with identical semantics, but answers them without
+    touching the database; building it takes two queries.'''
+    def __init__(self):
+        self.users = list(User.objects.all())
+        by_id = {user.id: user for user in self.users}
+        self.by_username = {user.username: user for user in self.users}
+        self.by_email = {}
+        for user in self.users:
+            self._add(self.by_email, user.email, user)
+        self.by_profile_email = {}
+        self.pgp_keys = []
+        profiles = UserProfile.objects.values_list(
+                'user_id', 'public_email', 'pgp_key').order_by()
+        for user_id, public_email, pgp_key in profiles:
+            user = by_id[user_id]
+            self._add(self.by_profile_email, public_email, user)
+            if pgp_key:
+                self.pgp_keys.append((pgp_key, user))
+        self.names = [(user, (user.first_name or '').lower(),
+            (user.last_name or '').lower()) for user in self.users]
+
+    @staticmethod
+    def _add(index, key, user):
+        if not key:
+            return
+        if key in index and index[key] is not user:
+            index[key] = AMBIGUOUS
+        else:
+            index[key] = user
+
+    @staticmethod
+    def _get(index, key):
+        user = index.get(key, None)
+        if user is AMBIGUOUS:
+            return None
+        return user
+
+    def user_email(self, name, email):
+        if email:
+            return self._get(self.by_email, email)
+        return None
+
+    def username_email(self, name, email):
+        if email and '@' in email:
+            username, domain = email.split('@', 1)
+            if re.match(r'^(.+\.)?archlinux.org$', domain):
+                return self.by_username.get(username, None)
+        return None
+
+    def profile_email(self, name, email):
+        if email:
+            return self._get(self.by_profile_email, email)
+        return None
+
+    def user_name(self, name, email):
+        if not name:
+            return None
+        tokens = [token.lower() for token in name.split()
+                if not quoted_token(token)]
+        matches = [user for user, first, last in self.names
+                if all(token in first or token in last for token in tokens)]
+        if len(matches) == 1:
+            return matches[0]
+        return None
+
+    def pgp_key(self, pgp_key):
+        matches = [user for key, user in self.pgp_keys
+                if key.endswith(pgp_key)]
+        if len(matches) == 1:
+            return matches[0]
+        return None
+
+
 class UserFinder(object):
     def __init__(self):
         self.cache = {}
         self.username_cache = {}
         self.email_cache = {}
         self.pgp_cache = {}
+        self.index = None
+
+    def preload(self):
+        '''Load all users and profiles into memory once, after which every
+        lookup is answered without any database queries. Calling this again
+        refreshes the data and clears all cached results.'''
+        self.clear_cache()
+        self.index = UserIndex()
+
+    def find_all(self, userstrings):
+        '''Resolve many packager strings in a single pass, returning a dict
+        of string -> User (or None). Loads the in-memory index if needed.'''
+        if self.index is None:
+            self.preload()
+        return {userstring: self.find(userstring)
+                for userstring in set(userstrings)}
 
     @staticmethod
     @ignore_does_not_exist
@@ -102,12 +201,20 @@ def user_name(name, email):
         name_q = Q()
         for token in name.split():
             # ignore quoted parts; e.g. nicknames in strings
-            if re.match(r'^[\'"].*[\'"]$', token):
+            if quoted_token(token):
                 continue
             name_q &= (Q(first_name__icontains=token) |
                     Q(last_name__icontains=token))
         return User.objects.get(name_q)
 
+    def matchers(self):
+        if self.index is not None:
+            source = self.index
+        else:
+            source = self
+        return (source.user_email, source.profile_email,
+                source.username_email, source.user_name)
+
     def find(self, userstring):
         '''
         Attempt to find the corresponding User object for a standard
@@ -131,9 +238,7 @@ def find(self, userstring):
             email = matches.group(2)
 
         user = None
-        find_methods = (self.user_email, self.profile_email,
-                self.username_email, self.user_name)
-        for matcher in find_methods:
+        for matcher in self.matchers():
             user = matcher(name, email)
             if user is not None:
                 break
@@ -148,10 +253,13 @@ def find_by_username(self, username):
         if username in self.username_cache:
             return self.username_cache[username]
 
-        try:
-            user = User.objects.get(username=username)
-        except User.DoesNotExist:
-            user = None
+        if self.index is not None:
+            user = self.index.by_username.get(username, None)
+        else:
+            try:
+                user = User.objects.get(username=username)
+            except User.DoesNotExist:
+                user = None
 
         self.username_cache[username] = user
         return user
@@ -162,11 +270,12 @@ def find_by_email(self, email):
         if email in self.email_cache:
             return self.email_cache[email]
 
-        user = self.user_email(None, email)
+        user_email, profile_email, username_email, _ = self.matchers()
+        user = user_email(None, email)
         if user is None:
-            user = self.profile_email(None, email)
+            user = profile_email(None, email)
             if user is None:
-                user = self.username_email(None, email)
+                user = username_email(None, email)
 
         self.email_cache[email] = user
         return user
@@ -177,11 +286,14 @@ def find_by_pgp_key(self, pgp_key):
         if pgp_key in self.pgp_cache:
             return self.pgp_cache[pgp_key]
 
-        try:
-            user = User.objects.get(
-                    userprofile__pgp_key__endswith=pgp_key)
-        except User.DoesNotExist:
-            user = None
+        if self.index is not None:
+            user = self.index.pgp_key(pgp_key)
+        else:
+            try:
+                user = User.objects.get(
+                        userprofile__pgp_key__endswith=pgp_key)
+            except (User.DoesNotExist, MultipleObjectsReturned):
+                user = None
 
         self.pgp_cache[pgp_key] = user
         return user
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='package',
+            name='signature_key_id',
+            field=models.CharField(max_length=40, null=True, verbose_name=b'PGP signature key ID', db_index=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='package',
+            name='signature_time',
+            field=models.DateTimeField(null=True, verbose_name=b'PGP signature time', db_index=True),
+            preserve_default=True,
+        ),
+    ]
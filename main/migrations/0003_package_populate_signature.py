@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+from main.utils import signature_info
+
+def forwards(apps, schema_editor):
+    Package = apps.get_model('main', 'Package')
+    packages = Package.objects.filter(signature_bytes__isnull=False).values_list(
+            'id', 'signature_bytes').order_by()
+    for pkg_id, signature_bytes in packages.iterator():
+        key_id, created = signature_info(signature_bytes)
+        if key_id is None:
+            continue
+        Package.objects.filter(id=pkg_id).update(signature_key_id=key_id,
+                signature_time=created)
+
+def backwards(apps, schema_editor):
+    pass
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0002_auto_20261018_0618'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards)
+    ]
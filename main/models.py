@@ -109,6 +109,11 @@ class Package(models.Model):
     packager = models.ForeignKey(User, null=True, blank=True,
             on_delete=models.SET_NULL)
     signature_bytes = models.BinaryField('PGP signature', null=True)
+    # parsed out of signature_bytes on import, see utils.signature_info()
+    signature_key_id = models.CharField('PGP signature key ID',
+            max_length=40, null=True, db_index=True)
+    signature_time = models.DateTimeField('PGP signature time', null=True,
+            db_index=True)
     flag_date = models.DateTimeField(null=True, blank=True)
 
     objects = PackageManager()
@@ -147,11 +152,11 @@ def signature(self):
 
     @property
     def signer(self):
-        sig = self.signature
-        if sig and sig.key_id:
+        if self.signature_key_id:
             try:
                 matching_key = DeveloperKey.objects.select_related(
-                        'owner').get(key=sig.key_id, owner_id__isnull=False)
+                        'owner').get(key=self.signature_key_id,
+                                owner_id__isnull=False)
                 user = matching_key.owner
             except DeveloperKey.DoesNotExist:
                 user = None
@@ -162,11 +167,9 @@ def signer(self):
 
     @property
     def maintainers(self):
-        from packages.models import PackageRelation
+        from packages.utils import get_maintainers
         if self._maintainers is None:
-            self._maintainers = User.objects.filter(
-                    package_relations__pkgbase=self.pkgbase,
-                    package_relations__type=PackageRelation.MAINTAINER)
+            self._maintainers = get_maintainers(self.pkgbase)
         return self._maintainers
 
     @maintainers.setter
@@ -196,14 +199,12 @@ def get_requiredby(self):
         WHEN 'M' THEN 2
         WHEN 'C' THEN 3
         ELSE 1000 END)'''
-        name_clause = '''packages_depend.name IN (
-        SELECT %s UNION ALL
-        SELECT z.name FROM packages_provision z WHERE z.pkg_id = %s
-        )'''
+        # depends matching our name or one of our provisions, looked up in
+        # the reverse dependency index maintained by reporead
         requiredby = Depend.objects.select_related('pkg',
                 'pkg__arch', 'pkg__repo').extra(
-                select={'sorttype': sorttype},
-                where=[name_clause], params=[self.pkgname, self.id]).order_by(
+                select={'sorttype': sorttype}).filter(
+                targets__pkg=self).order_by(
                 'sorttype', 'pkg__pkgname',
                 'pkg__arch__name', 'pkg__repo__name')
         if not self.arch.agnostic:
@@ -211,29 +212,33 @@ def get_requiredby(self):
             requiredby = requiredby.filter(
                     pkg__arch__in=self.applicable_arches())
 
-        # if we can use ALPM, ensure our returned Depend objects abide by the
-        # version comparison operators they may specify
+        # ensure our returned Depend objects abide by the version comparison
+        # operators they may specify
         alpm = AlpmAPI()
-        if alpm.available:
-            provides = self.provides.all()
-            new_rqd = []
-            for dep in requiredby:
-                if not dep.comparison or not dep.version:
-                    # no comparisson/version, so always let it through
+        requiredby = list(requiredby)
+        # those depending on this package directly are checked in one batch
+        direct = [dep for dep in requiredby if dep.comparison and
+                dep.version and self.pkgname == dep.name]
+        satisfied = alpm.compare_many(self.full_version,
+                [(dep.comparison, dep.version) for dep in direct])
+        satisfied = {dep.id for dep, ok in zip(direct, satisfied) if ok}
+        provides = self.provides.all()
+        new_rqd = []
+        for dep in requiredby:
+            if not dep.comparison or not dep.version:
+                # no comparisson/version, so always let it through
+                new_rqd.append(dep)
+            elif self.pkgname == dep.name:
+                if dep.id in satisfied:
                     new_rqd.append(dep)
-                elif self.pkgname == dep.name:
-                    # depends on this package, so check it directly
-                    if alpm.compare_versions(self.full_version,
+            else:
+                # it must be a provision of ours at this point
+                for provide in (p for p in provides if p.name == dep.name):
+                    if alpm.compare_versions(provide.version,
                             dep.comparison, dep.version):
                         new_rqd.append(dep)
-                else:
-                    # it must be a provision of ours at this point
-                    for provide in (p for p in provides if p.name == dep.name):
-                        if alpm.compare_versions(provide.version,
-                                dep.comparison, dep.version):
-                            new_rqd.append(dep)
-                            break
-            requiredby = new_rqd
+                        break
+        requiredby = new_rqd
 
         # sort out duplicate packages; this happens if something has a double
         # versioned depend such as a kernel module
@@ -292,15 +297,11 @@ def get_depends(self):
         providers.
         Packages will match the testing status of this package if possible.
         """
-        deps = []
-        # TODO: we can use list comprehension and an 'in' query to make this
-        # more effective
-        for dep in self.depends.all():
-            pkg = dep.get_best_satisfier()
-            providers = None
-            if not pkg:
-                providers = dep.get_providers()
-            deps.append({'dep': dep, 'pkg': pkg, 'providers': providers})
+        from packages.utils import resolve_depends
+        depends = list(self.depends.all())
+        for dep in depends:
+            dep.pkg = self
+        deps = resolve_depends(depends)
         # sort the list; deptype sorting makes this tricker than expected
         sort_order = {'D': 0, 'O': 1, 'M': 2, 'C': 3}
 
@@ -318,22 +319,22 @@ def reverse_conflicts(self):
             # make sure we match architectures if possible
             pkgs = pkgs.filter(arch__in=self.applicable_arches())
 
+        # Filter out items that don't actually conflict due to the version
+        # specification; all of them are checked against our version at once.
         alpm = AlpmAPI()
-        if not alpm.available:
-            return pkgs
-
-        # If we can use ALPM, we can filter out items that don't actually
-        # conflict due to the version specification.
         pkgs = pkgs.prefetch_related('conflicts')
+        conflicts = [(package, conflict) for package in pkgs
+                for conflict in package.conflicts.all()
+                if conflict.name == self.pkgname]
+        versioned = [(conflict.comparison, conflict.version)
+                for _, conflict in conflicts
+                if conflict.comparison and conflict.version]
+        results = iter(alpm.compare_many(self.full_version, versioned))
         new_pkgs = []
-        for package in pkgs:
-            for conflict in package.conflicts.all():
-                if conflict.name != self.pkgname:
-                    continue
-                if not conflict.comparison or not conflict.version \
-                        or alpm.compare_versions(self.full_version,
-                        conflict.comparison, conflict.version):
-                    new_pkgs.append(package)
+        for package, conflict in conflicts:
+            if not conflict.comparison or not conflict.version \
+                    or next(results):
+                new_pkgs.append(package)
         return new_pkgs
 
     def base_package(self):
@@ -342,19 +343,18 @@ def base_package(self):
         or if it was built in a way that the base package isn't real, will
         return None.
         """
-        try:
-            # start by looking for something in this repo
-            return Package.objects.normal().get(arch=self.arch,
-                    repo=self.repo, pkgname=self.pkgbase)
-        except Package.DoesNotExist:
-            # this package might be split across repos? find one
-            # that matches the correct [testing] repo flag
-            pkglist = Package.objects.normal().filter(arch=self.arch,
-                    repo__testing=self.repo.testing,
-                    repo__staging=self.repo.staging, pkgname=self.pkgbase)
-            if len(pkglist) > 0:
-                return pkglist[0]
+        if self.pkgname == self.pkgbase:
+            return self
+        # reporead records the base package in the pkgbase index; it looks
+        # in this repo first, then in any other that matches the correct
+        # [testing] repo flag in case this package is split across repos
+        from packages.models import PackageBase
+        base = PackageBase.objects.select_related('base__arch',
+                'base__repo').filter(pkgbase=self.pkgbase, repo=self.repo,
+                arch=self.arch).first()
+        if base is None:
             return None
+        return base.base
 
     def split_packages(self):
         """
@@ -414,9 +414,8 @@ def in_staging(self):
         except Package.DoesNotExist:
             return None
 
-    def elsewhere(self):
-        '''attempt to locate this package anywhere else, regardless of
-        architecture or repository. Excludes this package from the list.'''
+    def elsewhere_names(self):
+        '''our name, along with the names of our multilib counterparts.'''
         names = [self.pkgname]
         if self.pkgname.startswith(u'lib32-'):
             names.append(self.pkgname[6:])
@@ -425,6 +424,12 @@ def elsewhere(self):
         else:
             names.append(u'lib32-' + self.pkgname)
             names.append(self.pkgname + u'-multilib')
+        return names
+
+    def elsewhere(self):
+        '''attempt to locate this package anywhere else, regardless of
+        architecture or repository. Excludes this package from the list.'''
+        names = self.elsewhere_names()
         return Package.objects.normal().filter(
                 pkgname__in=names).exclude(id=self.id).order_by(
                 'arch__name', 'repo__name')
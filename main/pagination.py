@@ -0,0 +1,258 @@
+import base64
+import json
+from datetime import date, datetime
+
+from django.core.exceptions import ValidationError
+from django.db import connections, router
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class Key(object):
+    '''
+    One of the columns a keyset paginated queryset is ordered by. Knows the
+    SQL for the column, how to get its value from a result and how to turn a
+    value that went through a cursor back into something to compare against.
+    '''
+    def __init__(self, sql, params, descending, nullable, getter, to_python):
+        self.sql = sql
+        self.params = list(params)
+        self.descending = descending
+        self.nullable = nullable
+        self.getter = getter
+        self.to_python = to_python
+
+    def equal(self, value):
+        if value is None:
+            return '%s IS NULL' % self.sql, self.params
+        return '%s = %%s' % self.sql, self.params + [value]
+
+    def after(self, value, reverse, nulls_largest):
+        '''SQL matching the values that come after the given one when walking
+        in order, or in reverse order if asked to.'''
+        descending = self.descending != reverse
+        nulls_after = nulls_largest != descending
+        if value is None:
+            if nulls_after:
+                return '1 = 0', []
+            return '%s IS NOT NULL' % self.sql, self.params
+        operator = '<' if descending else '>'
+        clause = '%s %s %%s' % (self.sql, operator)
+        params = self.params + [value]
+        if self.nullable and nulls_after:
+            clause = '(%s OR %s IS NULL)' % (clause, self.sql)
+            params += self.params
+        return clause, params
+
+
+def value_getter(lookup, path):
+    '''Gets a value from a values() row by its lookup, or from an object by
+    following the path of attributes.'''
+    def getter(obj):
+        if isinstance(obj, dict):
+            return obj[lookup]
+        for name in path:
+            obj = getattr(obj, name)
+            if obj is None:
+                break
+        return obj
+    return getter
+
+
+def identity(value):
+    return value
+
+
+def field_key(queryset, name, descending, quote_name):
+    '''A key for a field of the model, or for a field of a model it has a
+    foreign key to, written as 'fk__field'.'''
+    opts = queryset.model._meta
+    table = quote_name(opts.db_table)
+    path = name.split('__')
+    if len(path) > 2:
+        raise ValueError('Cannot paginate by %s' % name)
+    field = opts.pk if path[0] == 'pk' else opts.get_field(path[0])
+    sql = '%s.%s' % (table, quote_name(field.column))
+    nullable = field.null
+    if len(path) == 2:
+        related = field.rel.to._meta
+        target = related.pk if path[1] == 'pk' else related.get_field(path[1])
+        sql = '(SELECT z.%s FROM %s z WHERE z.%s = %s)' % (
+                quote_name(target.column), quote_name(related.db_table),
+                quote_name(related.pk.column), sql)
+        nullable = nullable or target.null
+        field = target
+    else:
+        name = field.attname
+        path = [name]
+    return Key(sql, [], descending, nullable, value_getter(name, path),
+            field.to_python)
+
+
+class KeysetPage(object):
+    def __init__(self, object_list, previous_cursor, next_cursor):
+        self.object_list = object_list
+        self.previous_cursor = previous_cursor
+        self.next_cursor = next_cursor
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator(object):
+    '''
+    Paginates an ordered queryset by the values of the columns it is ordered
+    by rather than by offset, so every page costs the same to fetch no matter
+    how deep it is. The primary key is added to the ordering to break ties.
+    Pages are asked for with opaque cursors naming the row to start after or
+    stop before, as handed out by the previous page.
+
+    The ordering may use fields of the model, fields of models it has a
+    foreign key to, and extra select columns; the latter are assumed to never
+    be NULL. For values() querysets, the rows need to include all of these.
+    '''
+    def __init__(self, queryset, per_page):
+        self.per_page = per_page
+        self.connection = connections[router.db_for_read(queryset.model)]
+        quote_name = self.connection.ops.quote_name
+        ordering = list(queryset.query.order_by or
+                queryset.model._meta.ordering)
+        if not {'pk', 'id', '-pk', '-id'}.intersection(ordering):
+            ordering.append('pk')
+        self.queryset = queryset.order_by(*ordering)
+        self.ordering = ordering
+        self.keys = []
+        extra = queryset.query.extra
+        for name in ordering:
+            descending = name.startswith('-')
+            name = name.lstrip('-')
+            if name in extra:
+                sql, params = extra[name]
+                key = Key('(%s)' % sql, params, descending, False,
+                        value_getter(name, [name]), identity)
+            else:
+                key = field_key(queryset, name, descending, quote_name)
+            self.keys.append(key)
+        self._count = None
+        self._count_is_estimate = False
+
+    # estimates below this are replaced by an exact count, which is cheap
+    exact_count_limit = 1000
+
+    @property
+    def count(self):
+        '''The number of results. On PostgreSQL, larger counts are only
+        estimated, as counting them exactly would cost as much as walking
+        through all of the pages; see count_is_estimate.'''
+        if self._count is None:
+            self._count = self.estimated_count()
+        return self._count
+
+    @property
+    def count_is_estimate(self):
+        self.count
+        return self._count_is_estimate
+
+    def estimated_count(self):
+        queryset = self.queryset.order_by()
+        if self.connection.vendor != 'postgresql':
+            return queryset.count()
+        sql, params = queryset.query.sql_with_params()
+        cursor = self.connection.cursor()
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        estimate = int(plan[0]['Plan']['Plan Rows'])
+        if estimate < self.exact_count_limit:
+            return queryset.count()
+        self._count_is_estimate = True
+        return estimate
+
+    def encode(self, obj):
+        values = []
+        for key in self.keys:
+            value = key.getter(obj)
+            if isinstance(value, (date, datetime)):
+                value = value.isoformat()
+            values.append(value)
+        data = json.dumps(values, separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode('utf-8')).rstrip('=')
+
+    def decode(self, cursor):
+        try:
+            cursor = str(cursor)
+            data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            values = json.loads(data.decode('utf-8'))
+            if not isinstance(values, list) or len(values) != len(self.keys):
+                raise ValueError
+            return [None if value is None else key.to_python(value)
+                    for key, value in zip(self.keys, values)]
+        except (TypeError, ValueError, UnicodeError, ValidationError):
+            raise InvalidCursor('Invalid cursor')
+
+    def where(self, values, reverse=False):
+        '''SQL matching the rows after the ones with the given key values,
+        i.e. the row value comparison (a, b, ...) > (x, y, ...) written out
+        in a way that takes the direction of each key and NULLs into
+        account.'''
+        nulls_largest = self.connection.features.nulls_order_largest
+        clauses = []
+        params = []
+        equal = []
+        equal_params = []
+        for key, value in zip(self.keys, values):
+            clause, clause_params = key.after(value, reverse, nulls_largest)
+            clauses.append(' AND '.join(equal + [clause]))
+            params.extend(equal_params + clause_params)
+            clause, clause_params = key.equal(value)
+            equal.append(clause)
+            equal_params.extend(clause_params)
+        return '(%s)' % ' OR '.join('(%s)' % c for c in clauses), params
+
+    def page(self, after=None, before=None):
+        '''The page starting after the row of the after cursor, or the one
+        ending before the row of the before cursor, or else the first page.
+        Raises InvalidCursor for cursors that were not made by a paginator
+        with the same ordering.'''
+        queryset = self.queryset
+        reverse = before is not None
+        cursor = before if reverse else after
+        if cursor:
+            where, params = self.where(self.decode(cursor), reverse)
+            queryset = queryset.extra(where=[where], params=params)
+        if reverse:
+            queryset = queryset.reverse()
+        results = list(queryset[:self.per_page + 1])
+        more = len(results) > self.per_page
+        results = results[:self.per_page]
+        if reverse:
+            results.reverse()
+
+        # coming from a cursor means there is something on the other side
+        if reverse:
+            has_previous, has_next = more, bool(cursor)
+        else:
+            has_previous, has_next = bool(cursor), more
+        previous_cursor = next_cursor = None
+        if results and has_previous:
+            previous_cursor = self.encode(results[0])
+        if results and has_next:
+            next_cursor = self.encode(results[-1])
+        return KeysetPage(results, previous_cursor, next_cursor)
+
+# vim: set ts=4 sw=4 et:
@@ -6,6 +6,9 @@
 import hashlib
 import markdown
 from markdown.extensions import Extension
+from pgpdump import BinaryData
+from pgpdump.utils import PgpdumpException
+from pytz import utc
 
 from django.core.cache import cache
 from django.db import connections, router
@@ -101,6 +104,19 @@ def find_unique_slug(model, title):
     return suffixed
 
 
+def signature_info(signature_bytes):
+    '''Returns the key id and creation time of a binary PGP signature, or a
+    pair of None values if there is no signature we can read.'''
+    if not signature_bytes:
+        return None, None
+    try:
+        sig = next(BinaryData(signature_bytes).packets())
+    except (PgpdumpException, IndexError, StopIteration):
+        # pgpdump does not check lengths on truncated packets
+        return None, None
+    return sig.key_id, sig.creation_time.replace(tzinfo=utc)
+
+
 def database_vendor(model, mode='read'):
     if mode == 'read':
         database = router.db_for_read(model)
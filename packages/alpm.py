@@ -1,6 +1,9 @@
+from collections import OrderedDict
 import ctypes
 from ctypes.util import find_library
 import operator
+import string
+from threading import Lock
 
 
 def load_alpm(name=None):
@@ -27,6 +30,151 @@ def load_alpm(name=None):
 
 ALPM = load_alpm()
 
+
+DIGITS = frozenset(string.digits)
+ALPHA = frozenset(string.ascii_letters)
+ALNUM = DIGITS | ALPHA
+
+
+def rpmvercmp(a, b):
+    '''Compare two version segments (epoch, version or release); a direct
+    port of rpmvercmp() in libalpm's version.c.'''
+    if a == b:
+        return 0
+    len_a, len_b = len(a), len(b)
+    one = ptr1 = 0
+    two = ptr2 = 0
+
+    # loop through each version segment of a and b and compare them
+    while one < len_a and two < len_b:
+        while one < len_a and a[one] not in ALNUM:
+            one += 1
+        while two < len_b and b[two] not in ALNUM:
+            two += 1
+
+        # if we ran to the end of either, we are finished with the loop
+        if one >= len_a or two >= len_b:
+            break
+
+        # if the separator lengths were different, we are also finished
+        if one - ptr1 != two - ptr2:
+            return -1 if one - ptr1 < two - ptr2 else 1
+
+        ptr1, ptr2 = one, two
+        # grab first completely alpha or completely numeric segment
+        if a[ptr1] in DIGITS:
+            while ptr1 < len_a and a[ptr1] in DIGITS:
+                ptr1 += 1
+            while ptr2 < len_b and b[ptr2] in DIGITS:
+                ptr2 += 1
+            isnum = True
+        else:
+            while ptr1 < len_a and a[ptr1] in ALPHA:
+                ptr1 += 1
+            while ptr2 < len_b and b[ptr2] in ALPHA:
+                ptr2 += 1
+            isnum = False
+
+        seg1, seg2 = a[one:ptr1], b[two:ptr2]
+        # numeric segments are always newer than alpha segments
+        if not seg2:
+            return 1 if isnum else -1
+
+        if isnum:
+            # throw away any leading zeros; whichever number has more
+            # digits wins
+            seg1, seg2 = seg1.lstrip('0'), seg2.lstrip('0')
+            if len(seg1) != len(seg2):
+                return 1 if len(seg1) > len(seg2) else -1
+
+        if seg1 != seg2:
+            return -1 if seg1 < seg2 else 1
+
+        one, two = ptr1, ptr2
+
+    # all segments compared identically, but the separators may differ
+    if one >= len_a and two >= len_b:
+        return 0
+
+    # the final showdown. we never want a remaining alpha string to beat an
+    # empty string:
+    # - if a is empty and b is not an alpha, b is newer.
+    # - if a is an alpha, b is newer.
+    # - otherwise a is newer.
+    if (one >= len_a and b[two] not in ALPHA) or \
+            (one < len_a and a[one] in ALPHA):
+        return -1
+    return 1
+
+
+def parse_evr(evr):
+    '''Split a full version into (epoch, version, release); release is None
+    if there is none. Mirrors parseEVR() in libalpm.'''
+    s = 0
+    while s < len(evr) and evr[s] in DIGITS:
+        s += 1
+    se = evr.rfind('-', s)
+
+    if s < len(evr) and evr[s] == ':':
+        epoch = evr[:s] or '0'
+        start = s + 1
+    else:
+        epoch = '0'
+        start = 0
+    if se != -1:
+        return epoch, evr[start:se], evr[se + 1:]
+    return epoch, evr[start:], None
+
+
+def vercmp(ver1, ver2):
+    '''Pure Python equivalent of alpm_pkg_vercmp().'''
+    if ver1 == ver2:
+        return 0
+    epoch1, version1, release1 = parse_evr(ver1)
+    epoch2, version2, release2 = parse_evr(ver2)
+    ret = rpmvercmp(epoch1, epoch2)
+    if ret == 0:
+        ret = rpmvercmp(version1, version2)
+        if ret == 0 and release1 is not None and release2 is not None:
+            ret = rpmvercmp(release1, release2)
+    return ret
+
+
+class VercmpCache(object):
+    '''A process-wide, size-bounded LRU memo of version comparisons. The
+    same handful of versions get compared over and over, e.g. every depend
+    on glibc>=2.19 against the same few glibc packages.'''
+    def __init__(self, maxsize=8192):
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+        self.lock = Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            result = self.results.pop(key, None)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.results[key] = result
+            return result
+
+    def set(self, key, result):
+        with self.lock:
+            self.results[key] = result
+            if len(self.results) > self.maxsize:
+                self.results.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+            self.hits = self.misses = 0
+
+
+VERCMP_CACHE = VercmpCache()
+
+
 class AlpmAPI(object):
     OPERATOR_MAP = {
         '=':  operator.eq,
@@ -40,7 +188,10 @@ class AlpmAPI(object):
 
     def __init__(self):
         self.alpm = ALPM
+        # whether libalpm itself could be loaded; if not, version comparisons
+        # use the pure Python implementation with the same results
         self.available = ALPM is not None
+        self.cache = VERCMP_CACHE
 
     def version(self):
         if not self.available:
@@ -48,19 +199,44 @@ def version(self):
         return ALPM.alpm_version()
 
     def vercmp(self, ver1, ver2):
-        if not self.available:
-            return None
-        return ALPM.alpm_pkg_vercmp(str(ver1), str(ver2))
+        key = (str(ver1), str(ver2))
+        result = self.cache.get(key)
+        if result is None:
+            if self.available:
+                result = ALPM.alpm_pkg_vercmp(*key)
+            else:
+                result = vercmp(*key)
+            self.cache.set(key, result)
+        return result
 
-    def compare_versions(self, ver1, oper, ver2):
+    def vercmp_many(self, ver1, versions):
+        '''Compare one version against many, returning a list of results in
+        the same order. Each distinct version is only compared once.'''
+        results = {}
+        for ver2 in versions:
+            if ver2 not in results:
+                results[ver2] = self.vercmp(ver1, ver2)
+        return [results[ver2] for ver2 in versions]
+
+    def get_operator(self, oper):
         func = self.OPERATOR_MAP.get(oper, None)
         if func is None:
             raise Exception("Invalid operator %s specified" % oper)
-        if not self.available:
-            return None
+        return func
+
+    def compare_versions(self, ver1, oper, ver2):
+        func = self.get_operator(oper)
         res = self.vercmp(ver1, ver2)
         return func(res, 0)
 
+    def compare_many(self, ver1, constraints):
+        '''Check one version against many (operator, version) constraints,
+        returning a list of booleans in the same order.'''
+        constraints = list(constraints)
+        funcs = [self.get_operator(oper) for oper, _ in constraints]
+        results = self.vercmp_many(ver1, [ver2 for _, ver2 in constraints])
+        return [func(res, 0) for func, res in zip(funcs, results)]
+
 
 def main():
     api = AlpmAPI()
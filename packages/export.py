@@ -0,0 +1,123 @@
+import hashlib
+import os
+from tempfile import NamedTemporaryFile
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from django.conf import settings
+from django.db.models import Sum
+
+from .models import RepoDatabaseState
+from .utils import (package_records, stored_generation, to_json,
+        FLAGS_GENERATION, MAINTAINERS_GENERATION, PACKAGE_VALUES)
+
+
+CHUNK_SIZE = 500
+
+
+def encode_json(record):
+    data = to_json(record)
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    return data + b'\n'
+
+
+def encode_msgpack(record):
+    return msgpack.packb(record, use_bin_type=True)
+
+
+# format name: (content type, file extension, record encoder)
+FORMATS = {
+    'json': ('application/x-ndjson', 'ndjson', encode_json),
+}
+if msgpack is not None:
+    FORMATS['msgpack'] = ('application/x-msgpack', 'msgpack', encode_msgpack)
+
+
+def package_chunks(packages):
+    '''The values() rows of the packages of the queryset, in chunks by id
+    so only one chunk is held in memory at a time.'''
+    packages = packages.values(*PACKAGE_VALUES).order_by('id')
+    last_id = 0
+    while True:
+        chunk = list(packages.filter(id__gt=last_id)[:CHUNK_SIZE])
+        if not chunk:
+            break
+        last_id = chunk[-1]['id']
+        yield chunk
+
+
+def export_name(format_name, repos, arches):
+    '''The name of the cached export of some packages, prefixed by what was
+    exported and ending in the generations of the data it was made from.'''
+    selection = '%s:%r:%r' % (format_name,
+            sorted(repo.id for repo in repos),
+            sorted(arch.id for arch in arches))
+    prefix = hashlib.md5(selection).hexdigest()[:16]
+    repos_generation = RepoDatabaseState.objects.aggregate(
+            Sum('generation'))['generation__sum'] or 0
+    generations = '%d.%d.%d' % (repos_generation,
+            stored_generation(MAINTAINERS_GENERATION),
+            stored_generation(FLAGS_GENERATION))
+    return prefix, '%s-%s.%s' % (prefix, generations, FORMATS[format_name][1])
+
+
+def export_packages(packages, format_name, repos, arches):
+    '''
+    An iterator over an export of the packages in the given format, made of
+    one encoded record per package. Exports are written to files in
+    PACKAGE_EXPORT_DIR as they are generated and served from there until the
+    packages, their flags or their maintainers change.
+    '''
+    export_dir = settings.PACKAGE_EXPORT_DIR
+    prefix, name = export_name(format_name, repos, arches)
+    path = os.path.join(export_dir, name)
+    try:
+        export = open(path, 'rb')
+    except IOError:
+        return generate_export(packages, format_name, export_dir, prefix,
+                path)
+    return read_export(export)
+
+
+def read_export(export, size=64 * 1024):
+    with export:
+        while True:
+            data = export.read(size)
+            if not data:
+                break
+            yield data
+
+
+def generate_export(packages, format_name, export_dir, prefix, path):
+    encode = FORMATS[format_name][2]
+    if not os.path.isdir(export_dir):
+        os.makedirs(export_dir)
+    temp = NamedTemporaryFile(dir=export_dir, prefix='.' + prefix,
+            delete=False)
+    try:
+        with temp:
+            for chunk in package_chunks(packages):
+                for record in package_records(chunk):
+                    data = encode(record)
+                    temp.write(data)
+                    yield data
+        # only complete exports ever show up under their real name
+        os.rename(temp.name, path)
+    except BaseException:
+        # including GeneratorExit for clients going away halfway through
+        os.unlink(temp.name)
+        raise
+
+    # anything older with the same packages and format is stale now
+    for filename in os.listdir(export_dir):
+        if filename.startswith(prefix + '-') and \
+                filename != os.path.basename(path):
+            try:
+                os.unlink(os.path.join(export_dir, filename))
+            except OSError:
+                pass
+
+# vim: set ts=4 sw=4 et:
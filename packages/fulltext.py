@@ -0,0 +1,215 @@
+import re
+from collections import defaultdict, OrderedDict
+
+from django.apps import apps as global_apps
+from django.db import connection
+from django.db.models import Q
+
+from main.models import Package
+from main.utils import database_vendor
+
+
+# the most file names of a single package that end up in the index
+FILES_LIMIT = 1000
+
+TERM_RE = re.compile(r'[^\W_]+', re.UNICODE)
+# words made of terms with single separators between them, like "base-devel"
+WORD_RE = re.compile(r'^[^\W_]+(?:[\W_][^\W_]+)*$', re.UNICODE)
+
+
+class SearchBackend(object):
+    '''The database specific parts of the search index. The index itself is a
+    table named packages_search, created from packages/sql/search.*.sql, and
+    each backend only differs in the SQL it uses to fill and query it.'''
+    vendor = None
+    # the column of packages_search holding the package id
+    id_column = None
+    # inserts a row out of the values given by documents()
+    insert_sql = None
+    # a condition on packages_search rows matching a query
+    match_sql = None
+    # how well a matching row matches a query, where lower is better
+    score_sql = None
+    # how each search term is written in a query, and what joins them
+    term_format = None
+    term_separator = None
+
+    def delete(self, cursor, pkg_ids):
+        placeholders = ', '.join(['%s'] * len(pkg_ids))
+        cursor.execute('DELETE FROM packages_search WHERE %s IN (%s)' %
+                (self.id_column, placeholders), pkg_ids)
+
+    def insert(self, cursor, documents):
+        cursor.executemany(self.insert_sql, documents)
+
+    def query(self, terms):
+        return self.term_separator.join(
+                self.term_format % term for term in terms)
+
+    def match(self, terms):
+        '''SQL for "packages.id IN (...)" matching all of the terms, along
+        with its parameters.'''
+        return ('packages.id IN (SELECT %s FROM packages_search WHERE %s)' %
+                (self.id_column, self.match_sql), [self.query(terms)])
+
+    def score(self, terms):
+        '''SQL for a score of how well a matching package matches the terms,
+        where lower is better, along with its parameters.'''
+        sql = ('COALESCE((SELECT %s FROM packages_search '
+                'WHERE %s = packages.id AND %s), 0)' %
+                (self.score_sql, self.id_column, self.match_sql))
+        return sql, [self.query(terms)] * sql.count('%s')
+
+
+class SQLiteBackend(SearchBackend):
+    '''An FTS5 table holding the text of each package under its id.'''
+    vendor = 'sqlite'
+    id_column = 'rowid'
+    insert_sql = '''INSERT INTO packages_search
+        (rowid, pkgname, pkgdesc, provides, groups, files)
+        VALUES (%s, %s, %s, %s, %s, %s)'''
+    match_sql = 'packages_search MATCH %s'
+    score_sql = 'bm25(packages_search, 10.0, 2.0, 5.0, 2.0, 0.5)'
+    term_format = '"%s"*'
+    term_separator = ' '
+
+
+class PostgreSQLBackend(SearchBackend):
+    '''A tsvector of each package, weighted by where the words came from.'''
+    vendor = 'postgresql'
+    id_column = 'pkg_id'
+    insert_sql = '''INSERT INTO packages_search (pkg_id, vector)
+        VALUES (%s,
+            setweight(to_tsvector('simple', %s), 'A') ||
+            setweight(to_tsvector('simple', %s), 'C') ||
+            setweight(to_tsvector('simple', %s), 'B') ||
+            setweight(to_tsvector('simple', %s), 'C') ||
+            setweight(to_tsvector('simple', %s), 'D'))'''
+    match_sql = 'vector @@ to_tsquery(\'simple\', %s)'
+    # ts_rank() gives a real, which would not compare equal to the double
+    # precision value it turns into once it went through a cursor
+    score_sql = '(-ts_rank(vector, to_tsquery(\'simple\', %s)))::float8'
+    term_format = '%s:*'
+    term_separator = ' & '
+
+
+BACKENDS = {backend.vendor: backend for backend in
+        (SQLiteBackend(), PostgreSQLBackend())}
+
+
+def get_backend():
+    return BACKENDS.get(database_vendor(Package), None)
+
+
+def search_terms(query):
+    '''Split a search query into the words the index knows about.'''
+    return [term.lower() for term in TERM_RE.findall(query)]
+
+
+def documents(pkg_ids, apps=global_apps):
+    '''The text of each of the given packages that goes into the index, as
+    (id, pkgname, pkgdesc, provides, groups, files) tuples. The models are
+    looked up in apps, so migrations can pass in their historical ones.'''
+    Package = apps.get_model('main', 'Package')
+    PackageFile = apps.get_model('main', 'PackageFile')
+    PackageGroup = apps.get_model('packages', 'PackageGroup')
+    Provision = apps.get_model('packages', 'Provision')
+    provides = defaultdict(list)
+    for pkg_id, name in Provision.objects.filter(
+            pkg_id__in=pkg_ids).values_list('pkg_id', 'name').order_by():
+        provides[pkg_id].append(name)
+    groups = defaultdict(list)
+    for pkg_id, name in PackageGroup.objects.filter(
+            pkg_id__in=pkg_ids).values_list('pkg_id', 'name').order_by():
+        groups[pkg_id].append(name)
+    files = defaultdict(set)
+    for pkg_id, filename in PackageFile.objects.filter(pkg_id__in=pkg_ids,
+            is_directory=False).values_list('pkg_id', 'filename').order_by():
+        if filename and len(files[pkg_id]) < FILES_LIMIT:
+            files[pkg_id].add(filename)
+
+    packages = Package.objects.filter(id__in=pkg_ids).values_list(
+            'id', 'pkgname', 'pkgdesc').order_by('id')
+    return [(pkg_id, pkgname, pkgdesc or '', ' '.join(provides[pkg_id]),
+        ' '.join(groups[pkg_id]), ' '.join(sorted(files[pkg_id])))
+        for pkg_id, pkgname, pkgdesc in packages]
+
+
+def update_search_index(pkg_ids=None, apps=global_apps):
+    '''Reindex the given packages, which may have been added, changed or
+    removed since. With no package ids, the whole index is rebuilt. Does
+    nothing on databases without a search index. See documents() for
+    apps.'''
+    backend = get_backend()
+    if backend is None:
+        return
+    cursor = connection.cursor()
+    if pkg_ids is None:
+        cursor.execute('DELETE FROM packages_search')
+        pkg_ids = apps.get_model('main', 'Package').objects.values_list(
+                'id', flat=True).order_by('id')
+    pkg_ids = list(pkg_ids)
+    for offset in range(0, len(pkg_ids), 250):
+        ids = pkg_ids[offset:offset + 250]
+        backend.delete(cursor, ids)
+        backend.insert(cursor, documents(ids, apps))
+
+
+# Results are ordered by how they match: an exact name first, then names
+# starting with the query, then packages providing it, then everything
+# else; ties are broken by the full text score, then by name.
+RANK_SQL = '''(CASE
+    WHEN LOWER(packages.pkgname) = %s THEN 0
+    WHEN LOWER(packages.pkgname) LIKE %s ESCAPE '\\' THEN 1
+    WHEN EXISTS (SELECT 1 FROM packages_provision z
+        WHERE z.pkg_id = packages.id AND LOWER(z.name) = %s) THEN 2
+    ELSE 3 END)'''
+
+RANK_ORDER = ('search_rank', 'search_score', 'pkgname')
+
+
+def like_escape(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def search_packages(packages, query):
+    '''Restrict a queryset of packages to those matching the query: those
+    with names or descriptions containing it, along with those where all of
+    its words show up in the name, description, provides, groups or file
+    names. The results get search_rank and search_score values to order by,
+    see RANK_ORDER.
+
+    Queries with words that are more than terms joined by punctuation, like
+    "c++", only match on names and descriptions containing them, as
+    splitting them into terms would match far more than asked for. On
+    databases without a search index, this is all that matches, and all
+    results rank the same.'''
+    backend = get_backend()
+    terms = search_terms(query)
+    if backend is None:
+        return packages.filter(Q(pkgname__icontains=query) |
+                Q(pkgdesc__icontains=query)).extra(
+                select={'search_rank': '0', 'search_score': '0'})
+
+    lowered = query.lower()
+    contains = '%' + like_escape(lowered) + '%'
+    where = ['UPPER(packages.pkgname) LIKE UPPER(%s) ESCAPE \'\\\'',
+            'UPPER(packages.pkgdesc) LIKE UPPER(%s) ESCAPE \'\\\'']
+    params = [contains, contains]
+    score, score_params = '0', []
+    if terms and all(WORD_RE.match(word) for word in lowered.split()):
+        match, match_params = backend.match(terms)
+        where.append(match)
+        params.extend(match_params)
+        score, score_params = backend.score(terms)
+    where = ['(%s)' % ' OR '.join(where)]
+    select = OrderedDict((
+        ('search_rank', RANK_SQL),
+        ('search_score', score),
+    ))
+    select_params = [lowered, like_escape(lowered) + '%', lowered]
+    select_params.extend(score_params)
+    return packages.extra(select=select, select_params=select_params,
+            where=where, params=params)
+
+# vim: set ts=4 sw=4 et:
@@ -0,0 +1,295 @@
+from array import array
+from collections import deque
+from threading import Lock
+
+from django.db.models import Sum
+
+from main.models import Arch, Package, Repo
+from .models import Depend, Provision, RepoDatabaseState
+
+
+class StringTable(object):
+    '''Interns package and depend names as small integers, so the graph holds
+    each distinct name only once.'''
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+
+    def intern(self, value):
+        string_id = self.ids.get(value, None)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.strings.append(value)
+            self.ids[value] = string_id
+        return string_id
+
+    def __getitem__(self, string_id):
+        return self.strings[string_id]
+
+    def __len__(self):
+        return len(self.strings)
+
+
+class RepoPartition(object):
+    '''The packages of a single repo that make up part of a graph, along with
+    the names they depend on and provide, interned in the string table of the
+    snapshot they belong to. Partitions are reloaded one at a time when their
+    repo changes.'''
+    __slots__ = ('repo', 'generation', 'pkg_ids', 'names', 'arch_ids',
+            'depends', 'provides')
+
+    def __init__(self, repo, generation):
+        self.repo = repo
+        self.generation = generation
+        self.pkg_ids = []
+        self.names = []
+        self.arch_ids = []
+        self.depends = []
+        self.provides = []
+
+    def load(self, arches, strings):
+        packages = Package.objects.filter(repo=self.repo,
+                arch__in=arches).values_list(
+                'id', 'pkgname', 'arch_id').order_by('pkgname', 'arch__name')
+        position = {}
+        for pkg_id, pkgname, arch_id in packages:
+            position[pkg_id] = len(self.pkg_ids)
+            self.pkg_ids.append(pkg_id)
+            self.names.append(strings.intern(pkgname))
+            self.arch_ids.append(arch_id)
+        depends = [[] for _ in self.pkg_ids]
+        provides = [[] for _ in self.pkg_ids]
+        for model, related, extra in ((Depend, depends, {'deptype': 'D'}),
+                (Provision, provides, {})):
+            rows = model.objects.filter(pkg__repo=self.repo,
+                    pkg__arch__in=arches, **extra).values_list(
+                    'pkg_id', 'name').order_by()
+            for pkg_id, name in rows:
+                related[position[pkg_id]].append(strings.intern(name))
+        self.depends = [array('i', names) for names in depends]
+        self.provides = [array('i', names) for names in provides]
+        return self
+
+    def reintern(self, old, new):
+        '''A copy of the partition with its names moved from the old string
+        table to the new one.'''
+        def move(names):
+            return array('i', [new.intern(old[name]) for name in names])
+        partition = RepoPartition(self.repo, self.generation)
+        partition.pkg_ids = self.pkg_ids
+        partition.names = [new.intern(old[name]) for name in self.names]
+        partition.arch_ids = self.arch_ids
+        partition.depends = [move(names) for names in self.depends]
+        partition.provides = [move(names) for names in self.provides]
+        return partition
+
+
+class GraphSnapshot(object):
+    '''
+    The nodes and edges of a DependencyGraph as of one refresh. Nodes are
+    numbered from zero and hold adjacency lists of other node numbers in both
+    directions. Snapshots are never changed once built, so any number of
+    threads can walk one while the graph builds the next.
+    '''
+    def __init__(self, arch, generation, partitions, arches, strings):
+        self.arch = arch
+        self.generation = generation
+        self.arches = arches
+        self.strings = strings
+        self.repos = {repo_id: partition.repo
+                for repo_id, partition in partitions.items()}
+        self.pkg_ids = array('l')
+        self.names = array('i')
+        self.repo_ids = array('i')
+        self.arch_ids = array('i')
+        self.nodes = {}
+        self.depends = []
+        self.required_by = []
+        self.build(partitions)
+
+    def build(self, partitions):
+        ranks = []
+        provides = []
+        depends = []
+        for repo_id in sorted(partitions):
+            partition = partitions[repo_id]
+            rank = int(partition.repo.testing) + 2 * int(partition.repo.staging)
+            for index, pkg_id in enumerate(partition.pkg_ids):
+                self.nodes[pkg_id] = len(self.pkg_ids)
+                self.pkg_ids.append(pkg_id)
+                self.names.append(partition.names[index])
+                self.repo_ids.append(repo_id)
+                self.arch_ids.append(partition.arch_ids[index])
+                ranks.append(rank)
+                provides.append(partition.provides[index])
+                depends.append(partition.depends[index])
+
+        # packages shadowed by one of the same name in a testing or staging
+        # repo can still be looked at, but nothing depends on them
+        best = {}
+        for node, name in enumerate(self.names):
+            if ranks[node] > best.get(name, -1):
+                best[name] = ranks[node]
+        by_name = {}
+        by_provision = {}
+        for node, name in enumerate(self.names):
+            if ranks[node] < best[name]:
+                continue
+            by_name.setdefault(name, []).append(node)
+            for provision in provides[node]:
+                by_provision.setdefault(provision, []).append(node)
+
+        required_by = [[] for _ in self.pkg_ids]
+        for node, names in enumerate(depends):
+            targets = set()
+            for name in names:
+                targets.update(by_name.get(name, None) or
+                        by_provision.get(name, ()))
+            targets.discard(node)
+            targets = array('i', sorted(targets))
+            self.depends.append(targets)
+            for target in targets:
+                required_by[target].append(node)
+        self.required_by = [array('i', nodes) for nodes in required_by]
+
+    def node(self, pkg):
+        return self.nodes.get(pkg.id, None)
+
+    def closure(self, start, edges):
+        '''Breadth-first walk from the start node; returns a list of
+        (node, depth) tuples for every node reached, without the start.'''
+        seen = {start}
+        found = []
+        queue = deque([(start, 0)])
+        while queue:
+            node, depth = queue.popleft()
+            for target in edges[node]:
+                if target not in seen:
+                    seen.add(target)
+                    found.append((target, depth + 1))
+                    queue.append((target, depth + 1))
+        return found
+
+    def transitive_depends(self, start):
+        return self.closure(start, self.depends)
+
+    def transitive_required_by(self, start):
+        return self.closure(start, self.required_by)
+
+    def cycle(self, start):
+        '''The other nodes of the dependency cycles the start node is part
+        of, i.e. its strongly connected component, as (node, depth) tuples
+        like closure() returns. Empty if there are none.'''
+        depends = self.transitive_depends(start)
+        if not depends:
+            return []
+        required_by = {node for node, _ in self.transitive_required_by(start)}
+        return [(node, depth) for node, depth in depends
+                if node in required_by]
+
+    def describe(self, node):
+        return {
+            'pkgname': self.strings[self.names[node]],
+            'repo': self.repos[self.repo_ids[node]].name.lower(),
+            'arch': self.arches[self.arch_ids[node]].name,
+        }
+
+
+class DependencyGraph(object):
+    '''
+    An in-memory graph of the runtime (deptype 'D') depends between the
+    packages of one architecture and repo set; agnostic packages are part of
+    every architecture's graph. Testing and staging repos are only included in
+    the graphs asked for with testing or staging.
+
+    A depend is satisfied by the package of that name if there is one, and by
+    every package providing the name otherwise; versions are not taken into
+    account. If the same package name shows up in several repos, the one from
+    the testing or staging repo wins, as it would for pacman.
+
+    The graph itself is only a loader; walks are done on the GraphSnapshot
+    each refresh that changed anything swaps in. Every snapshot gets a string
+    table of its own, so names of packages that are gone are not kept around.
+    '''
+    def __init__(self, arch, testing=False, staging=False):
+        self.arch = arch
+        self.testing = testing
+        self.staging = staging
+        self.partitions = {}
+        self.snapshot = None
+
+    @property
+    def generation(self):
+        return self.snapshot.generation if self.snapshot else None
+
+    def repos(self):
+        repos = Repo.objects.all()
+        if not self.testing:
+            repos = repos.filter(testing=False)
+        if not self.staging:
+            repos = repos.filter(staging=False)
+        return list(repos)
+
+    def repo_generations(self, repos):
+        '''Every import of a repo, for any architecture, bumps its generation;
+        it may have touched the agnostic packages as well.'''
+        generations = {repo.id: 0 for repo in repos}
+        states = RepoDatabaseState.objects.filter(
+                repo__in=repos).values_list('repo_id').annotate(
+                Sum('generation')).order_by()
+        for repo_id, generation in states:
+            generations[repo_id] = generation
+        return generations
+
+    def refresh(self):
+        '''Reload the repos that were imported since we last looked, then
+        build a new snapshot if anything changed. Returns whether it did.'''
+        repos = self.repos()
+        generations = self.repo_generations(repos)
+        stale = {repo_id for repo_id, generation in generations.items()
+                if repo_id not in self.partitions or
+                self.partitions[repo_id].generation != generation}
+        if self.snapshot is not None and not stale and \
+                set(self.partitions) == set(generations):
+            return False
+
+        # names only live as long as the snapshot that uses them
+        old = self.snapshot.strings if self.snapshot else None
+        strings = StringTable()
+        arches = [self.arch] + list(Arch.objects.filter(agnostic=True))
+        partitions = {}
+        for repo in repos:
+            if repo.id in stale:
+                partitions[repo.id] = RepoPartition(repo,
+                        generations[repo.id]).load(arches, strings)
+            else:
+                partitions[repo.id] = self.partitions[repo.id].reintern(
+                        old, strings)
+        self.partitions = partitions
+        self.snapshot = GraphSnapshot(self.arch, sum(generations.values()),
+                partitions, {arch.id: arch for arch in arches}, strings)
+        return True
+
+
+_graphs = {}
+_graphs_lock = Lock()
+
+
+def get_graph(arch, testing=False, staging=False):
+    '''Returns a snapshot of the up to date process-wide dependency graph for
+    the given architecture and repo set, building or refreshing the graph as
+    necessary.'''
+    key = (arch.id, testing, staging)
+    with _graphs_lock:
+        graph = _graphs.get(key, None)
+        if graph is None:
+            graph = _graphs[key] = DependencyGraph(arch, testing, staging)
+        graph.refresh()
+        return graph.snapshot
+
+
+def clear_graphs():
+    with _graphs_lock:
+        _graphs.clear()
+
+# vim: set ts=4 sw=4 et:
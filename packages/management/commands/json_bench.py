@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+json_bench command
+
+Times how long the package JSON views take to build their responses, both the
+way they used to, with model objects and PackageJSONEncoder, and with the
+plain values used now. Database queries are part of the timings. The packages
+are the first ones search_json would return, the files those of the package
+with the most files. Each case is run several times and the best time is
+reported.
+
+Usage: ./manage.py json_bench [--limit N] [--repeat N]
+"""
+
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+
+from devel.management.commands.reporead_bench import best_time
+from main.models import Package, PackageFile
+from packages.utils import (attach_maintainers, package_records, to_json,
+        PackageJSONEncoder, PACKAGE_VALUES)
+from packages.views.display import sorted_paths
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', action='store', type='int', dest='limit',
+            default=250, help='Number of packages to serialize.'),
+        make_option('--repeat', action='store', type='int', dest='repeat',
+            default=5, help='Number of times to run each benchmark.'),
+    )
+    help = "Times the serialization done by the package JSON views."
+
+    def handle(self, **options):
+        repeat = options['repeat']
+        if repeat < 1:
+            raise CommandError('--repeat must be at least 1.')
+        packages = Package.objects.order_by('pkgname', 'id')
+        pkg_ids = list(packages.values_list('id', flat=True)[:options['limit']])
+        if not pkg_ids:
+            raise CommandError('There are no packages to serialize.')
+        packages = packages.filter(id__in=pkg_ids)
+        files_pkg = PackageFile.objects.values('pkg_id').annotate(
+                count=Count('id')).order_by('-count')[:1]
+        files_pkg_id = files_pkg[0]['pkg_id'] if files_pkg else None
+
+        cases = [('search', search_reference, search_current, (packages,))]
+        if files_pkg_id is not None:
+            cases.append(('files', files_reference, files_current,
+                (files_pkg_id,)))
+
+        # make sure both ways give the same answers before timing them
+        for name, reference, current, args in cases:
+            if json.loads(reference(*args)) != json.loads(current(*args)):
+                raise CommandError('%s results differ' % name)
+
+        self.stdout.write('%d packages, %d files\n' % (len(pkg_ids),
+            files_pkg[0]['count'] if files_pkg else 0))
+        for name, reference, current, args in cases:
+            before = best_time(reference, [args], repeat)
+            after = best_time(current, [args], repeat)
+            self.stdout.write('%-8s reference %8.4fs  current %8.4fs  '
+                    '%5.1fx\n' % (name, before, after,
+                        before / after if after else 0.0))
+
+
+def search_reference(packages):
+    '''What search_json used to do with its results.'''
+    packages = packages.select_related('arch', 'repo', 'packager')
+    packages = packages.prefetch_related('groups', 'licenses',
+            'conflicts', 'provides', 'replaces', 'depends')
+    packages = attach_maintainers(packages)
+    return json.dumps({'results': packages}, ensure_ascii=False,
+            cls=PackageJSONEncoder)
+
+
+def search_current(packages):
+    return to_json({'results':
+        package_records(packages.values(*PACKAGE_VALUES))})
+
+
+def files_reference(pkg_id):
+    '''What files_json used to do for the file list.'''
+    fileslist = PackageFile.objects.filter(pkg_id=pkg_id).order_by()
+    fileslist = sorted(fileslist,
+            key=lambda f: f.directory + (f.filename or u''))
+    return json.dumps({'files': fileslist}, ensure_ascii=False,
+            cls=PackageJSONEncoder)
+
+
+def files_current(pkg_id):
+    paths, _ = sorted_paths(pkg_id)
+    return to_json({'files': paths})
+
+# vim: set ts=4 sw=4 et:
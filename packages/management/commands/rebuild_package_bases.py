@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+rebuild_package_bases command
+
+Rebuild the pkgbase index used for split package and base package lookups
+from scratch. reporead keeps the index up to date; this is only needed if it
+was bypassed, e.g. after editing packages by hand.
+
+Usage: ./manage.py rebuild_package_bases
+"""
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+import logging
+import sys
+
+from packages.models import PackageBase
+from packages.utils import update_package_bases
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s -> %(levelname)s: %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    stream=sys.stderr)
+logger = logging.getLogger()
+
+class Command(NoArgsCommand):
+    help = "Rebuild the pkgbase index from scratch."
+
+    def handle_noargs(self, **options):
+        v = int(options.get('verbosity', None))
+        if v == 0:
+            logger.level = logging.ERROR
+        elif v == 1:
+            logger.level = logging.INFO
+        elif v >= 2:
+            logger.level = logging.DEBUG
+
+        with transaction.atomic():
+            update_package_bases()
+        logger.info("pkgbase index rebuilt, %d entries",
+                PackageBase.objects.count())
+
+# vim: set ts=4 sw=4 et:
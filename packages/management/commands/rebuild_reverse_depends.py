@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+rebuild_reverse_depends command
+
+Rebuild the reverse dependency index used for the 'Required By' lists from
+scratch. reporead keeps the index up to date; this is only needed if it was
+bypassed, e.g. after editing packages by hand.
+
+Usage: ./manage.py rebuild_reverse_depends
+"""
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+import logging
+import sys
+
+from packages.models import ReverseDepend
+from packages.utils import update_reverse_depends
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s -> %(levelname)s: %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    stream=sys.stderr)
+logger = logging.getLogger()
+
+class Command(NoArgsCommand):
+    help = "Rebuild the reverse dependency index from scratch."
+
+    def handle_noargs(self, **options):
+        v = int(options.get('verbosity', None))
+        if v == 0:
+            logger.level = logging.ERROR
+        elif v == 1:
+            logger.level = logging.INFO
+        elif v >= 2:
+            logger.level = logging.DEBUG
+
+        with transaction.atomic():
+            update_reverse_depends()
+        logger.info("reverse dependency index rebuilt, %d entries",
+                ReverseDepend.objects.count())
+
+# vim: set ts=4 sw=4 et:
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+rebuild_search_index command
+
+Rebuild the full text index used by the package search from scratch. reporead
+keeps the index up to date; this is only needed if it was bypassed, e.g. after
+editing packages by hand.
+
+Usage: ./manage.py rebuild_search_index
+"""
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+import logging
+import sys
+
+from packages.fulltext import update_search_index
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s -> %(levelname)s: %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    stream=sys.stderr)
+logger = logging.getLogger()
+
+class Command(NoArgsCommand):
+    help = "Rebuild the package search index from scratch."
+
+    def handle_noargs(self, **options):
+        v = int(options.get('verbosity', None))
+        if v == 0:
+            logger.level = logging.ERROR
+        elif v == 1:
+            logger.level = logging.INFO
+        elif v >= 2:
+            logger.level = logging.DEBUG
+
+        with transaction.atomic():
+            update_search_index()
+        logger.info("package search index rebuilt")
+
+# vim: set ts=4 sw=4 et:
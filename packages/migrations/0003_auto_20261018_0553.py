@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0001_initial'),
+        ('packages', '0002_auto_20160731_0556'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PackageDigest',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('pkgid', models.CharField(max_length=255)),
+                ('pkgname', models.CharField(max_length=255)),
+                ('desc_digest', models.CharField(default=b'', max_length=64)),
+                ('depends_digest', models.CharField(default=b'', max_length=64)),
+                ('files_digest', models.CharField(default=b'', max_length=64)),
+                ('arch', models.ForeignKey(related_name='+', to='main.Arch')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='RepoDatabaseState',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('digest', models.CharField(max_length=64)),
+                ('last_import', models.DateTimeField()),
+                ('arch', models.ForeignKey(related_name='+', to='main.Arch')),
+                ('repo', models.ForeignKey(related_name='+', to='main.Repo')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='repodatabasestate',
+            unique_together=set([('repo', 'arch')]),
+        ),
+        migrations.AddField(
+            model_name='packagedigest',
+            name='database',
+            field=models.ForeignKey(related_name='packages', to='packages.RepoDatabaseState'),
+            preserve_default=True,
+        ),
+        migrations.AlterUniqueTogether(
+            name='packagedigest',
+            unique_together=set([('database', 'pkgid')]),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0001_initial'),
+        ('packages', '0003_auto_20261018_0553'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReverseDepend',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('depend', models.ForeignKey(related_name='targets', to='packages.Depend')),
+                ('pkg', models.ForeignKey(related_name='reverse_depends', to='main.Package')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='reversedepend',
+            unique_together=set([('pkg', 'depend')]),
+        ),
+    ]
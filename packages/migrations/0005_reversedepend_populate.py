@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+def forwards(apps, schema_editor):
+    cursor = schema_editor.connection.cursor()
+    cursor.execute('''INSERT INTO packages_reversedepend (pkg_id, depend_id)
+    SELECT p.id, d.id FROM packages_depend d
+    JOIN packages p ON p.pkgname = d.name
+    UNION
+    SELECT z.pkg_id, d.id FROM packages_depend d
+    JOIN packages_provision z ON z.name = d.name''')
+
+def backwards(apps, schema_editor):
+    ReverseDepend = apps.get_model('packages', 'ReverseDepend')
+    ReverseDepend.objects.all().delete()
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('packages', '0004_auto_20261018_0610'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards)
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('packages', '0005_reversedepend_populate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='repodatabasestate',
+            name='generation',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+
+from django.db import models, migrations
+
+# SQLite gets the same function registered on each new connection instead,
+# see packages.models.register_vercmp()
+SQL_FILE = os.path.join(os.path.dirname(__file__), os.pardir, 'sql',
+        'vercmp.postgresql_psycopg2.sql')
+
+def forwards(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with open(SQL_FILE) as sql:
+        schema_editor.connection.cursor().execute(sql.read())
+
+def backwards(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    cursor = schema_editor.connection.cursor()
+    cursor.execute('DROP FUNCTION IF EXISTS vercmp(text, text)')
+    cursor.execute('DROP FUNCTION IF EXISTS parse_evr(text)')
+    cursor.execute('DROP FUNCTION IF EXISTS rpmvercmp(text, text)')
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('packages', '0006_repodatabasestate_generation'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards)
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_package_populate_signature'),
+        ('packages', '0007_vercmp_function'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PackageBase',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('pkgbase', models.CharField(max_length=255, db_index=True)),
+                ('pkgver', models.CharField(max_length=255)),
+                ('pkgrel', models.CharField(max_length=255)),
+                ('epoch', models.PositiveIntegerField(default=0)),
+                ('last_update', models.DateTimeField(db_index=True)),
+                ('arch', models.ForeignKey(related_name='package_bases', to='main.Arch')),
+                ('base', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.SET_NULL, to='main.Package', null=True)),
+                ('packages', models.ManyToManyField(related_name='package_bases', to='main.Package')),
+                ('repo', models.ForeignKey(related_name='package_bases', to='main.Repo')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='packagebase',
+            unique_together=set([('pkgbase', 'repo', 'arch')]),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+from packages.utils import create_package_bases
+
+def forwards(apps, schema_editor):
+    Package = apps.get_model('main', 'Package')
+    PackageBase = apps.get_model('packages', 'PackageBase')
+    PackageBase.objects.all().delete()
+    create_package_bases(Package.objects.all(), model=PackageBase)
+
+def backwards(apps, schema_editor):
+    PackageBase = apps.get_model('packages', 'PackageBase')
+    PackageBase.objects.all().delete()
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('packages', '0008_auto_20261018_0630'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards)
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+
+from django.db import models, migrations
+
+from packages.fulltext import update_search_index
+
+SQL_DIR = os.path.join(os.path.dirname(__file__), os.pardir, 'sql')
+SQL_FILES = {
+    'postgresql': 'search.postgresql_psycopg2.sql',
+    'sqlite': 'search.sqlite3.sql',
+}
+
+def forwards(apps, schema_editor):
+    filename = SQL_FILES.get(schema_editor.connection.vendor, None)
+    if filename is None:
+        return
+    with open(os.path.join(SQL_DIR, filename)) as sql:
+        schema_editor.connection.cursor().execute(sql.read())
+    update_search_index(apps=apps)
+
+def backwards(apps, schema_editor):
+    if schema_editor.connection.vendor not in SQL_FILES:
+        return
+    schema_editor.connection.cursor().execute(
+            'DROP TABLE IF EXISTS packages_search')
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('packages', '0009_packagebase_populate'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards)
+    ]
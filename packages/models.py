@@ -1,7 +1,8 @@
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 from django.db import models
-from django.db.models.signals import pre_save
+from django.db.backends.signals import connection_created
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.contrib.admin.models import ADDITION, CHANGE, DELETION
 from django.contrib.auth.models import User
 
@@ -369,6 +370,93 @@ class Meta:
         ordering = ('name',)
 
 
+class RepoDatabaseState(models.Model):
+    '''
+    The state of the last successful import of a repo database file for a
+    given repo and (primary) architecture. reporead uses the digest of the
+    whole file, as well as the digests of each package stored in the related
+    PackageDigest objects, to skip unchanged files and packages entirely.
+    The generation is bumped on every import that changes anything, so
+    long-lived caches of package data (see packages.graph) can tell when they
+    went stale.
+    '''
+    repo = models.ForeignKey(Repo, related_name='+')
+    arch = models.ForeignKey(Arch, related_name='+')
+    digest = models.CharField(max_length=64)
+    last_import = models.DateTimeField()
+    generation = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('repo', 'arch'),)
+
+    def __unicode__(self):
+        return u'%s (%s): %s' % (self.repo, self.arch, self.digest)
+
+
+class Generation(models.Model):
+    '''
+    A named counter bumped whenever some data changes, so long-lived copies
+    of that data in other processes (see packages.utils.MaintainerCache) can
+    tell when they went stale without relying on a shared cache.
+    '''
+    name = models.CharField(max_length=64, unique=True)
+    generation = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return u'%s: %d' % (self.name, self.generation)
+
+
+class PackageDigest(models.Model):
+    '''
+    Digests of the members of a single package entry (e.g. 'foo-1.0-1/') in a
+    repo database file, as of the last successful import.
+    '''
+    database = models.ForeignKey(RepoDatabaseState, related_name='packages')
+    pkgid = models.CharField(max_length=255)
+    pkgname = models.CharField(max_length=255)
+    arch = models.ForeignKey(Arch, related_name='+')
+    desc_digest = models.CharField(max_length=64, default='')
+    depends_digest = models.CharField(max_length=64, default='')
+    files_digest = models.CharField(max_length=64, default='')
+
+    class Meta:
+        unique_together = (('database', 'pkgid'),)
+
+    def digests(self):
+        return (self.desc_digest, self.depends_digest, self.files_digest)
+
+    def __unicode__(self):
+        return self.pkgid
+
+
+# the full version of a package as Package.full_version builds it, so it can be
+# handed to the vercmp() database function
+PACKAGE_VERSION_SQL = ("(CASE WHEN packages.epoch > 0 THEN "
+        "CAST(packages.epoch AS TEXT) || ':' || packages.pkgver || '-' || "
+        "packages.pkgrel ELSE packages.pkgver || '-' || packages.pkgrel END)")
+
+SQL_OPERATORS = {
+    '=':  '=',
+    '==': '=',
+    '!=': '<>',
+    '<':  '<',
+    '<=': '<=',
+    '>':  '>',
+    '>=': '>=',
+}
+
+
+def filter_version(queryset, column, comparison, version):
+    '''Restrict a queryset to the rows where the version in the given SQL
+    column or expression satisfies the comparison, using the vercmp()
+    database function.'''
+    oper = SQL_OPERATORS.get(comparison, None)
+    if oper is None:
+        raise Exception("Invalid operator %s specified" % comparison)
+    return queryset.extra(where=['vercmp(%s, %%s) %s 0' % (column, oper)],
+            params=[version])
+
+
 class RelatedToBase(models.Model):
     '''A base class for conflicts/provides/replaces/etc.'''
     name = models.CharField(max_length=255, db_index=True)
@@ -393,30 +481,18 @@ def get_best_satisfier(self):
         # if we have a comparison operation, make sure the packages we grab
         # actually satisfy the requirements
         if self.comparison and self.version:
-            alpm = AlpmAPI()
-            pkgs = [pkg for pkg in pkgs if not alpm.available or
-                    alpm.compare_versions(pkg.full_version, self.comparison,
-                        self.version)]
-        if len(pkgs) == 0:
-            # couldn't find a package in the DB
-            # it should be a virtual depend (or a removed package)
-            return None
-        if len(pkgs) == 1:
-            return pkgs[0]
-        # more than one package, see if we can't shrink it down
-        # grab the first though in case we fail
-        pkg = pkgs[0]
-        # prevents yet more DB queries, these lists should be short;
-        # after each grab the best available in case we remove all entries
-        pkgs = [p for p in pkgs if p.repo.staging == self.pkg.repo.staging]
-        if len(pkgs) > 0:
-            pkg = pkgs[0]
-
-        pkgs = [p for p in pkgs if p.repo.testing == self.pkg.repo.testing]
-        if len(pkgs) > 0:
-            pkg = pkgs[0]
-
-        return pkg
+            pkgs = filter_version(pkgs, PACKAGE_VERSION_SQL,
+                    self.comparison, self.version)
+        # prefer a package in the same staging repo, then one in the same
+        # staging and testing repo; a virtual depend (or a removed package)
+        # has no package in the DB at all
+        staging = self.pkg.repo.staging
+        testing = self.pkg.repo.testing
+        pkgs = pkgs.extra(select=OrderedDict((
+            ('same_staging', 'repos.staging = %s'),
+            ('same_flags', 'repos.staging = %s AND repos.testing = %s'),
+        )), select_params=(staging, staging, testing))
+        return pkgs.order_by('-same_staging', '-same_flags', 'id').first()
 
     def get_providers(self):
         '''Return providers of this related package. Does *not* include exact
@@ -431,18 +507,9 @@ def get_providers(self):
 
         # If we have a comparison operation, make sure the packages we grab
         # actually satisfy the requirements.
-        alpm = AlpmAPI()
-        if alpm.available and self.comparison and self.version:
-            pkgs = pkgs.prefetch_related('provides')
-            new_pkgs = []
-            for package in pkgs:
-                for provide in package.provides.all():
-                    if provide.name != self.name:
-                        continue
-                    if alpm.compare_versions(provide.version,
-                            self.comparison, self.version):
-                        new_pkgs.append(package)
-            pkgs = new_pkgs
+        if self.comparison and self.version:
+            pkgs = filter_version(pkgs, 'packages_provision.version',
+                    self.comparison, self.version)
 
         # Sort providers by preference. We sort those in same staging/testing
         # combination first, followed by others. We sort by a (staging,
@@ -504,10 +571,94 @@ class Replacement(RelatedToBase):
     comparison = models.CharField(max_length=255, default='')
 
 
+class ReverseDepend(models.Model):
+    '''
+    Materialized reverse dependency index: one row for each package whose name
+    or one of whose provisions matches the name of a Depend. Versions are not
+    taken into account. reporead keeps this up to date as packages change; see
+    packages.utils.update_reverse_depends().
+    '''
+    pkg = models.ForeignKey(Package, related_name='reverse_depends')
+    depend = models.ForeignKey(Depend, related_name='targets')
+
+    class Meta:
+        unique_together = (('pkg', 'depend'),)
+
+
+class PackageBase(models.Model):
+    '''
+    Materialized pkgbase index: one row for each pkgbase in each repo and
+    architecture, linking to the packages built from it. The base package is
+    the package named after the pkgbase that Package.base_package() would
+    find, if there is one. The version is that of the base package if it is
+    in the same repo, otherwise that of the most recently updated member.
+    reporead keeps this up to date as packages change; see
+    packages.utils.update_package_bases().
+    '''
+    pkgbase = models.CharField(max_length=255, db_index=True)
+    repo = models.ForeignKey(Repo, related_name='package_bases')
+    arch = models.ForeignKey(Arch, related_name='package_bases')
+    base = models.ForeignKey(Package, related_name='+', null=True,
+            on_delete=models.SET_NULL)
+    packages = models.ManyToManyField(Package, related_name='package_bases')
+    pkgver = models.CharField(max_length=255)
+    pkgrel = models.CharField(max_length=255)
+    epoch = models.PositiveIntegerField(default=0)
+    last_update = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = (('pkgbase', 'repo', 'arch'),)
+
+    @property
+    def full_version(self):
+        if self.epoch > 0:
+            return u'%d:%s-%s' % (self.epoch, self.pkgver, self.pkgrel)
+        return u'%s-%s' % (self.pkgver, self.pkgrel)
+
+    def __unicode__(self):
+        return u'%s-%s (%s, %s)' % (self.pkgbase, self.full_version,
+                self.repo, self.arch)
+
+
+def register_vercmp(sender, connection, **kwargs):
+    '''SQLite has no vercmp() function of its own, unlike the PostgreSQL
+    one the migrations install; give each new connection one.'''
+    if connection.vendor != 'sqlite':
+        return
+    alpm = AlpmAPI()
+    def vercmp(ver1, ver2):
+        if ver1 is None or ver2 is None:
+            return None
+        return alpm.vercmp(ver1, ver2)
+    connection.connection.create_function('vercmp', 2, vercmp)
+
+
 # hook up some signals
 for sender in (FlagRequest, PackageRelation,
         SignoffSpecification, Signoff, Update):
     pre_save.connect(set_created_field, sender=sender,
             dispatch_uid="packages.models")
 
+connection_created.connect(register_vercmp, dispatch_uid="packages.models")
+
+
+def maintainers_changed(sender, **kwargs):
+    from packages.utils import announce_maintainers, MaintainerCache
+    if sender is User:
+        # new users maintain nothing yet, and saves of other fields, such as
+        # the last_login of a login, leave what is cached of users alone
+        if kwargs.get('created', False):
+            return
+        update_fields = kwargs.get('update_fields', None)
+        if update_fields is not None and \
+                not update_fields.intersection(MaintainerCache.user_fields):
+            return
+    announce_maintainers()
+
+for sender in (PackageRelation, User):
+    post_save.connect(maintainers_changed, sender=sender,
+            dispatch_uid="packages.models")
+    post_delete.connect(maintainers_changed, sender=sender,
+            dispatch_uid="packages.models")
+
 # vim: set ts=4 sw=4 et:
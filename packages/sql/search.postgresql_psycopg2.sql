@@ -0,0 +1,10 @@
+-- The full text package search index, see packages/fulltext.py. Installed by
+-- the packages migrations; reporead keeps it up to date.
+
+CREATE TABLE packages_search (
+	pkg_id integer PRIMARY KEY REFERENCES packages (id)
+		ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+	vector tsvector NOT NULL
+);
+
+CREATE INDEX packages_search_vector ON packages_search USING gin (vector);
@@ -0,0 +1,7 @@
+-- The full text package search index, see packages/fulltext.py. Installed by
+-- the packages migrations; reporead keeps it up to date. The rowid is the
+-- package id.
+CREATE VIRTUAL TABLE packages_search USING fts5(
+	pkgname, pkgdesc, provides, groups, files,
+	tokenize = 'unicode61', prefix = '2 3'
+);
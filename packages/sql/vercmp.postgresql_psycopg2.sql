@@ -0,0 +1,151 @@
+-- vercmp(text, text): alpm_pkg_vercmp() for use in queries. A port of
+-- rpmvercmp() and parseEVR() from libalpm's version.c, like the one in
+-- packages/alpm.py; SQLite gets that one registered as vercmp() instead.
+-- Installed by the packages migrations.
+
+CREATE OR REPLACE FUNCTION rpmvercmp(a text, b text) RETURNS integer AS $body$
+DECLARE
+	len_a integer := length(a);
+	len_b integer := length(b);
+	one integer := 1;
+	two integer := 1;
+	ptr1 integer := 1;
+	ptr2 integer := 1;
+	isnum boolean;
+	seg1 text;
+	seg2 text;
+BEGIN
+	IF a = b THEN
+		RETURN 0;
+	END IF;
+
+	-- loop through each version segment of a and b and compare them
+	WHILE one <= len_a AND two <= len_b LOOP
+		WHILE one <= len_a AND substr(a, one, 1) !~ '[A-Za-z0-9]' LOOP
+			one := one + 1;
+		END LOOP;
+		WHILE two <= len_b AND substr(b, two, 1) !~ '[A-Za-z0-9]' LOOP
+			two := two + 1;
+		END LOOP;
+
+		-- if we ran to the end of either, we are finished with the loop
+		IF one > len_a OR two > len_b THEN
+			EXIT;
+		END IF;
+
+		-- if the separator lengths were different, we are also finished
+		IF one - ptr1 <> two - ptr2 THEN
+			RETURN CASE WHEN one - ptr1 < two - ptr2 THEN -1 ELSE 1 END;
+		END IF;
+
+		ptr1 := one;
+		ptr2 := two;
+		-- grab first completely alpha or completely numeric segment
+		IF substr(a, ptr1, 1) ~ '[0-9]' THEN
+			WHILE ptr1 <= len_a AND substr(a, ptr1, 1) ~ '[0-9]' LOOP
+				ptr1 := ptr1 + 1;
+			END LOOP;
+			WHILE ptr2 <= len_b AND substr(b, ptr2, 1) ~ '[0-9]' LOOP
+				ptr2 := ptr2 + 1;
+			END LOOP;
+			isnum := true;
+		ELSE
+			WHILE ptr1 <= len_a AND substr(a, ptr1, 1) ~ '[A-Za-z]' LOOP
+				ptr1 := ptr1 + 1;
+			END LOOP;
+			WHILE ptr2 <= len_b AND substr(b, ptr2, 1) ~ '[A-Za-z]' LOOP
+				ptr2 := ptr2 + 1;
+			END LOOP;
+			isnum := false;
+		END IF;
+
+		seg1 := substr(a, one, ptr1 - one);
+		seg2 := substr(b, two, ptr2 - two);
+		-- numeric segments are always newer than alpha segments
+		IF seg2 = '' THEN
+			RETURN CASE WHEN isnum THEN 1 ELSE -1 END;
+		END IF;
+
+		IF isnum THEN
+			-- throw away any leading zeros; whichever number has more
+			-- digits wins
+			seg1 := ltrim(seg1, '0');
+			seg2 := ltrim(seg2, '0');
+			IF length(seg1) <> length(seg2) THEN
+				RETURN CASE WHEN length(seg1) > length(seg2) THEN 1 ELSE -1 END;
+			END IF;
+		END IF;
+
+		IF seg1 <> seg2 THEN
+			RETURN CASE WHEN seg1 COLLATE "C" < seg2 COLLATE "C" THEN -1 ELSE 1 END;
+		END IF;
+
+		one := ptr1;
+		two := ptr2;
+	END LOOP;
+
+	-- all segments compared identically, but the separators may differ
+	IF one > len_a AND two > len_b THEN
+		RETURN 0;
+	END IF;
+
+	-- the final showdown. we never want a remaining alpha string to beat an
+	-- empty string
+	IF (one > len_a AND substr(b, two, 1) !~ '[A-Za-z]') OR
+			(one <= len_a AND substr(a, one, 1) ~ '[A-Za-z]') THEN
+		RETURN -1;
+	END IF;
+	RETURN 1;
+END;
+$body$ LANGUAGE plpgsql IMMUTABLE STRICT;
+
+-- Split a full version into {epoch, version, release}; release is NULL if
+-- there is none.
+CREATE OR REPLACE FUNCTION parse_evr(evr text) RETURNS text[] AS $body$
+DECLARE
+	digits text := coalesce(substring(evr FROM '^[0-9]*'), '');
+	s integer := length(digits);
+	epoch text := '0';
+	start integer := 1;
+	rest text;
+	se integer;
+BEGIN
+	IF substr(evr, s + 1, 1) = ':' THEN
+		IF s > 0 THEN
+			epoch := digits;
+		END IF;
+		start := s + 2;
+	END IF;
+
+	-- the release follows the last dash after the epoch digits
+	rest := substr(evr, s + 1);
+	se := position('-' IN reverse(rest));
+	IF se = 0 THEN
+		RETURN ARRAY[epoch, substr(evr, start), NULL];
+	END IF;
+	se := s + length(rest) - se + 1;
+	RETURN ARRAY[epoch, substr(evr, start, se - start), substr(evr, se + 1)];
+END;
+$body$ LANGUAGE plpgsql IMMUTABLE STRICT;
+
+CREATE OR REPLACE FUNCTION vercmp(ver1 text, ver2 text) RETURNS integer AS $body$
+DECLARE
+	evr1 text[];
+	evr2 text[];
+	ret integer;
+BEGIN
+	IF ver1 = ver2 THEN
+		RETURN 0;
+	END IF;
+	evr1 := parse_evr(ver1);
+	evr2 := parse_evr(ver2);
+	ret := rpmvercmp(evr1[1], evr2[1]);
+	IF ret = 0 THEN
+		ret := rpmvercmp(evr1[2], evr2[2]);
+		IF ret = 0 AND evr1[3] IS NOT NULL AND evr2[3] IS NOT NULL THEN
+			ret := rpmvercmp(evr1[3], evr2[3]);
+		END IF;
+	END IF;
+	RETURN ret;
+END;
+$body$ LANGUAGE plpgsql IMMUTABLE STRICT;
@@ -1,6 +1,30 @@
+import json
+import os
+import shutil
+import tempfile
 import unittest
 
-from .alpm import AlpmAPI
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils.timezone import now
+
+from main.models import Arch, Package, PackageFile, Repo
+from main.pagination import InvalidCursor, KeysetPaginator
+from .alpm import AlpmAPI, VercmpCache, vercmp
+from .fulltext import (search_packages, search_terms, update_search_index,
+        RANK_ORDER)
+from .graph import DependencyGraph, clear_graphs, get_graph
+from .models import (Conflict, Depend, License, PackageBase, PackageGroup,
+        PackageRelation, Provision, RepoDatabaseState, Replacement, ReverseDepend)
+from .utils import (attach_maintainers, bump_stored_generation,
+        defer_maintainers, flush_maintainers, get_maintainers,
+        get_split_packages_info, get_target_repo_map, invalidate_details,
+        invalidate_flags, maintainer_cache, stored_generation,
+        package_names, package_records, resolve_depends, to_json,
+        update_package_bases, update_reverse_depends, PackageJSONEncoder,
+        MAINTAINERS_GENERATION, PACKAGE_VALUES)
 
 
 alpm = AlpmAPI()
@@ -16,12 +40,10 @@ def test_version(self):
         # version is a 3-tuple, e.g., '7.0.2'
         self.assertEqual(3, len(version))
 
-    @unittest.skipUnless(alpm.available, "ALPM is unavailable")
     def test_vercmp(self):
         self.assertEqual(0, alpm.vercmp("1.0", "1.0"))
         self.assertEqual(1, alpm.vercmp("1.1", "1.0"))
 
-    @unittest.skipUnless(alpm.available, "ALPM is unavailable")
     def test_compare_versions(self):
         self.assertTrue(alpm.compare_versions("1.0", "<=", "2.0"))
         self.assertTrue(alpm.compare_versions("1.0", "<", "2.0"))
@@ -39,8 +61,790 @@ def test_behavior_when_unavailable(self):
         mock_alpm.available = False
 
         self.assertIsNone(mock_alpm.version())
-        self.assertIsNone(mock_alpm.vercmp("1.0", "1.0"))
-        self.assertIsNone(mock_alpm.compare_versions("1.0", "=", "1.0"))
+        # comparisons fall back to the pure Python implementation
+        self.assertEqual(0, mock_alpm.vercmp("1.0", "1.0"))
+        self.assertEqual(-1, mock_alpm.vercmp("1.0", "1.1"))
+        self.assertTrue(mock_alpm.compare_versions("1.0", "=", "1.0"))
+
+    def test_batch(self):
+        self.assertEqual([1, 0, -1, 0],
+                alpm.vercmp_many("1.0-2", ["1.0-1", "1.0-2", "2.0", "1.0"]))
+        self.assertEqual([True, False, True],
+                alpm.compare_many("1:1.0", [(">", "2.0"), ("<", "1:1.0"),
+                    ("=", "1:1.0-3")]))
+        with self.assertRaises(Exception):
+            alpm.compare_many("1.0", [("~", "1.0")])
+
+    def test_cache(self):
+        cache = VercmpCache(maxsize=2)
+        cache.set(("1", "2"), -1)
+        cache.set(("2", "1"), 1)
+        self.assertEqual(-1, cache.get(("1", "2")))
+        # ("2", "1") is now the least recently used entry
+        cache.set(("1", "1"), 0)
+        self.assertIsNone(cache.get(("2", "1")))
+        self.assertEqual(0, cache.get(("1", "1")))
+        self.assertEqual((2, 1), (cache.hits, cache.misses))
+
+
+class VercmpTestCase(unittest.TestCase):
+    # the test cases from pacman's vercmptest.sh
+    cases = (
+        ("1.5.0", "1.5.0", 0),
+        ("1.5.1", "1.5.0", 1),
+        ("1.5.1", "1.5", 1),
+        ("1.5.0-1", "1.5.0-1", 0),
+        ("1.5.0-1", "1.5.0-2", -1),
+        ("1.5.0-1", "1.5.1-1", -1),
+        ("1.5.0-2", "1.5.1-1", -1),
+        ("1.5-1", "1.5.1-1", -1),
+        ("1.5-2", "1.5.1-1", -1),
+        ("1.5-2", "1.5.1-2", -1),
+        ("1.5", "1.5-1", 0),
+        ("1.5-1", "1.5", 0),
+        ("1.1-1", "1.1", 0),
+        ("1.0-1", "1.1", -1),
+        ("1.1-1", "1.0", 1),
+        ("1.5b-1", "1.5-1", -1),
+        ("1.5b", "1.5", -1),
+        ("1.5b-1", "1.5", -1),
+        ("1.5b", "1.5.1", -1),
+        ("1.0a", "1.0alpha", -1),
+        ("1.0alpha", "1.0b", -1),
+        ("1.0b", "1.0beta", -1),
+        ("1.0beta", "1.0rc", -1),
+        ("1.0rc", "1.0", -1),
+        ("1.5.a", "1.5", 1),
+        ("1.5.b", "1.5.a", 1),
+        ("1.5.1", "1.5.b", 1),
+        ("1.5.b-1", "1.5.b", 0),
+        ("1.5-1", "1.5.b", -1),
+        ("2.0", "2_0", 0),
+        ("2.0_a", "2_0.a", 0),
+        ("2.0a", "2.0.a", -1),
+        ("2___a", "2_a", 1),
+        ("0:1.0", "0:1.0", 0),
+        ("0:1.0", "0:1.1", -1),
+        ("1:1.0", "0:1.0", 1),
+        ("1:1.0", "0:1.1", 1),
+        ("1:1.0", "2:1.1", -1),
+        ("1:1.0", "0:1.0-1", 1),
+        ("1:1.0-1", "0:1.1-1", 1),
+        ("0:1.0", "1.0", 0),
+        ("0:1.0", "1.1", -1),
+        ("0:1.1", "1.0", 1),
+        ("1:1.0", "1.0", 1),
+        ("1:1.0", "1.1", 1),
+        ("1:1.1", "1.1", 1),
+    )
+
+    def test_pure_python(self):
+        for ver1, ver2, expected in self.cases:
+            self.assertEqual(expected, vercmp(ver1, ver2),
+                    "%s vs %s" % (ver1, ver2))
+            self.assertEqual(-expected, vercmp(ver2, ver1),
+                    "%s vs %s" % (ver2, ver1))
+
+    @unittest.skipUnless(alpm.available, "ALPM is unavailable")
+    def test_matches_alpm(self):
+        for ver1, ver2, _ in self.cases:
+            self.assertEqual(alpm.alpm.alpm_pkg_vercmp(ver1, ver2),
+                    vercmp(ver1, ver2))
+
+    def test_database(self):
+        cursor = connection.cursor()
+        for ver1, ver2, expected in self.cases:
+            cursor.execute('SELECT vercmp(%s, %s), vercmp(%s, %s)',
+                    [ver1, ver2, ver2, ver1])
+            self.assertEqual((expected, -expected), tuple(cursor.fetchone()),
+                    "%s vs %s" % (ver1, ver2))
+
+
+class DependsTestCase(TestCase):
+    fixtures = ['arches', 'repos']
+
+    def create(self, pkgname, repo='Core', arch='x86_64', depends=(),
+            provides=(), conflicts=(), pkgbase=None):
+        pkg = Package.objects.create(pkgname=pkgname,
+                pkgbase=pkgbase or pkgname,
+                pkgver='1.0', pkgrel='1', repo=Repo.objects.get(name=repo),
+                arch=Arch.objects.get(name=arch), filename=pkgname,
+                compressed_size=1, installed_size=1, last_update=now(),
+                created=now(), packager_str='Joe User')
+        for name in depends:
+            Depend.objects.create(pkg=pkg, name=name)
+        for name in provides:
+            Provision.objects.create(pkg=pkg, name=name)
+        for name in conflicts:
+            Conflict.objects.create(pkg=pkg, name=name)
+        return pkg
+
+    def setUp(self):
+        self.create('glibc')
+        self.create('glibc', repo='Testing')
+        self.create('bash', arch='i686')
+        self.create('python', arch='any')
+        self.create('gawk', provides=['awk'])
+        self.create('nawk', repo='Testing', provides=['awk'])
+        self.create('mawk', arch='i686', provides=['awk'])
+        self.pkg = self.create('foo', depends=['glibc', 'bash', 'python',
+            'awk', 'sh', 'missing'])
+        self.testing_pkg = self.create('foo', repo='Testing',
+                depends=['glibc', 'awk'])
+
+
+class ResolveDependsTest(DependsTestCase):
+
+    def check_matches_per_depend(self, package):
+        for item in resolve_depends(package.depends.all()):
+            dep = item['dep']
+            self.assertEqual(dep.get_best_satisfier(), item['pkg'])
+            if item['pkg'] is None:
+                self.assertEqual(dep.get_providers(), item['providers'])
+            else:
+                self.assertIsNone(item['providers'])
+
+    def test_matches_per_depend(self):
+        self.check_matches_per_depend(self.pkg)
+        self.check_matches_per_depend(self.testing_pkg)
+
+    def test_versioned(self):
+        Package.objects.filter(pkgname='glibc', repo__name='Testing').update(
+                epoch=1)
+        Provision.objects.filter(pkg__pkgname='nawk').update(version='2.0-1')
+        pkg = self.create('bar')
+        for name, comparison, version in (('glibc', '>=', '1.0'),
+                ('glibc', '>', '1.0-1'), ('glibc', '<', '1:1.0'),
+                ('awk', '>=', '1.5'), ('awk', '<', '1.5'),
+                ('awk', '!=', '2.0-1')):
+            Depend.objects.create(pkg=pkg, name=name, comparison=comparison,
+                    version=version)
+        self.check_matches_per_depend(pkg)
+
+        deps = {str(dep): dep for dep in pkg.depends.all()}
+        for name, repo in (('glibc>=1.0', 'Core'), ('glibc>1.0-1', 'Testing'),
+                ('glibc<1:1.0', 'Core')):
+            self.assertEqual(repo, deps[name].get_best_satisfier().repo.name)
+        for name, providers in (('awk>=1.5', ['nawk']), ('awk<1.5', ['gawk']),
+                ('awk!=2.0-1', ['gawk'])):
+            self.assertEqual(providers,
+                    [p.pkgname for p in deps[name].get_providers()])
+
+    def test_preferences(self):
+        deps = {item['dep'].name: item for item in self.pkg.get_depends()}
+        self.assertEqual('Core', deps['glibc']['pkg'].repo.name)
+        self.assertEqual('python', deps['python']['pkg'].pkgname)
+        self.assertIsNone(deps['bash']['pkg'])
+        self.assertEqual(['gawk', 'nawk'],
+                [pkg.pkgname for pkg in deps['awk']['providers']])
+        self.assertEqual([], deps['missing']['providers'])
+
+        deps = {item['dep'].name: item
+                for item in self.testing_pkg.get_depends()}
+        self.assertEqual('Testing', deps['glibc']['pkg'].repo.name)
+        self.assertEqual(['nawk', 'gawk'],
+                [pkg.pkgname for pkg in deps['awk']['providers']])
+
+    def test_query_count(self):
+        pkg = Package.objects.normal().get(id=self.pkg.id)
+        with self.assertNumQueries(3):
+            self.assertEqual(6, len(pkg.get_depends()))
+        with self.assertNumQueries(4):
+            depends = Depend.objects.filter(pkg__pkgname='foo')
+            self.assertEqual(8, len(resolve_depends(depends)))
+
+
+class ReverseDependTest(DependsTestCase):
+
+    def index(self):
+        return set(ReverseDepend.objects.values_list(
+            'pkg__pkgname', 'depend__name'))
+
+    def test_update(self):
+        update_reverse_depends()
+        full = self.index()
+        self.assertIn(('gawk', 'awk'), full)
+        self.assertIn(('glibc', 'glibc'), full)
+        self.assertNotIn(('missing', 'missing'), full)
+
+        ReverseDepend.objects.all().delete()
+        update_reverse_depends(Package.objects.values_list('id', flat=True))
+        self.assertEqual(full, self.index())
+
+        # a new provider of a name others already depend on
+        sh = self.create('dash', provides=['sh'])
+        update_reverse_depends([sh.id])
+        self.assertEqual(full | {('dash', 'sh')}, self.index())
+
+    def test_requiredby(self):
+        update_reverse_depends()
+        glibc = Package.objects.get(pkgname='glibc', repo__name='Core')
+        self.assertEqual([self.pkg.id],
+                [dep.pkg.id for dep in glibc.get_requiredby()])
+        gawk = Package.objects.get(pkgname='gawk')
+        self.assertEqual(2, len(gawk.get_requiredby()))
+
+        Package.objects.filter(pkgname='foo').delete()
+        self.assertEqual([], glibc.get_requiredby())
+
+
+class DetailsTestCase(DependsTestCase):
+
+    def setUp(self):
+        super(DetailsTestCase, self).setUp()
+        update_reverse_depends()
+        Package.objects.filter(id=self.pkg.id).update(flag_date=now())
+
+    def details_queries(self):
+        # always count loading the maintainers
+        maintainer_cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/packages/core/x86_64/foo/')
+        self.assertEqual(200, response.status_code)
+        return len(context.captured_queries)
+
+
+class DetailsQueryBudgetTest(DetailsTestCase):
+    # the most queries the package details page may take for a flagged
+    # package with maintainers, relations and versions elsewhere
+    budget = 21
+
+    def add_relations(self, names):
+        for name in names:
+            Conflict.objects.create(pkg=self.pkg, name=name)
+            Replacement.objects.create(pkg=self.pkg, name=name)
+            Provision.objects.create(pkg=self.pkg, name=name + '-compat')
+            Depend.objects.create(pkg=self.pkg, name=name, deptype='O')
+            split = self.create(name + '-split', depends=['foo'])
+            split.pkgbase = 'foo'
+            split.save()
+            self.create(name + '-split', repo='Testing', conflicts=['foo'])
+        update_reverse_depends()
+
+    def test_budget(self):
+        self.add_relations(['gawk'])
+        before = self.details_queries()
+        self.assertLessEqual(before, self.budget)
+
+        # more of everything must not mean more queries
+        self.add_relations(['nawk', 'mawk', 'glibc', 'bash'])
+        self.assertEqual(before, self.details_queries())
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class DetailsCacheTest(DetailsTestCase):
+
+    def test_cached(self):
+        uncached = self.details_queries()
+        cached = self.details_queries()
+        self.assertLess(cached, uncached)
+
+        # new required by entries only show up after reporead invalidates
+        self.create('bar', depends=['foo'])
+        update_reverse_depends()
+        self.assertNotContains(self.client.get('/packages/core/x86_64/foo/'),
+                'View package details for bar')
+        invalidate_details()
+        self.assertContains(self.client.get('/packages/core/x86_64/foo/'),
+                'View package details for bar')
+        self.assertEqual(cached, self.details_queries())
+
+        # flags are part of the key, so flagging others keeps the fragment
+        invalidate_flags()
+        self.assertEqual(cached, self.details_queries())
+
+        # unflagging changes the key by itself
+        Package.objects.filter(id=self.pkg.id).update(flag_date=None)
+        self.assertLess(cached, self.details_queries())
+
+    def test_arches(self):
+        self.details_queries()
+        self.create('bar', depends=['foo'])
+        update_reverse_depends()
+        # imports of other architectures leave the fragment alone
+        invalidate_details([Arch.objects.get(name='i686').id])
+        self.assertNotContains(self.client.get('/packages/core/x86_64/foo/'),
+                'View package details for bar')
+        invalidate_details([Arch.objects.get(name='x86_64').id])
+        self.assertContains(self.client.get('/packages/core/x86_64/foo/'),
+                'View package details for bar')
+
+
+class DependencyGraphTest(DependsTestCase):
+
+    def setUp(self):
+        super(DependencyGraphTest, self).setUp()
+        self.create('chicken', depends=['egg'])
+        self.create('egg', depends=['chicken', 'glibc'])
+        self.x86_64 = Arch.objects.get(name='x86_64')
+        clear_graphs()
+
+    def names(self, graph, found):
+        return sorted((graph.describe(node)['pkgname'],
+            graph.describe(node)['repo']) for node, _ in found)
+
+    def test_closures(self):
+        graph = get_graph(self.x86_64)
+        foo = graph.node(self.pkg)
+        self.assertEqual([('gawk', 'core'), ('glibc', 'core'),
+            ('python', 'core')],
+            self.names(graph, graph.transitive_depends(foo)))
+        self.assertIsNone(graph.node(self.testing_pkg))
+
+        glibc = graph.node(Package.objects.get(pkgname='glibc',
+            repo__name='Core'))
+        self.assertEqual([('chicken', 'core'), ('egg', 'core'),
+            ('foo', 'core')],
+            self.names(graph, graph.transitive_required_by(glibc)))
+
+    def test_testing(self):
+        graph = get_graph(self.x86_64, testing=True)
+        found = graph.transitive_depends(graph.node(self.testing_pkg))
+        self.assertEqual([('gawk', 'core'), ('glibc', 'testing'),
+            ('nawk', 'testing')], self.names(graph, found))
+        # the Core package is shadowed by the one in Testing
+        glibc = graph.node(Package.objects.get(pkgname='glibc',
+            repo__name='Core'))
+        self.assertEqual([], graph.transitive_required_by(glibc))
+
+    def test_cycle(self):
+        graph = get_graph(self.x86_64)
+        chicken = graph.node(Package.objects.get(pkgname='chicken'))
+        self.assertEqual([('egg', 'core')],
+                self.names(graph, graph.cycle(chicken)))
+        self.assertEqual([], graph.cycle(graph.node(self.pkg)))
+
+    def test_refresh(self):
+        graph = DependencyGraph(self.x86_64)
+        self.assertTrue(graph.refresh())
+        self.assertFalse(graph.refresh())
+
+        # new packages only show up once reporead bumps the generation
+        self.create('dash', provides=['sh'])
+        self.assertFalse(graph.refresh())
+        core = Repo.objects.get(name='Core')
+        RepoDatabaseState.objects.create(repo=core, arch=self.x86_64,
+                digest='', last_import=now(), generation=1)
+        # only Core is loaded again
+        with self.assertNumQueries(6):
+            self.assertTrue(graph.refresh())
+        self.assertEqual(1, graph.generation)
+        snapshot = graph.snapshot
+        self.assertEqual([('dash', 'core'), ('gawk', 'core'),
+            ('glibc', 'core'), ('python', 'core')],
+            self.names(snapshot,
+                snapshot.transitive_depends(snapshot.node(self.pkg))))
+        self.assertIn('dash', snapshot.strings.ids)
+
+        # snapshots handed out earlier are left alone by later refreshes
+        Package.objects.filter(pkgname='dash').delete()
+        RepoDatabaseState.objects.update(generation=2)
+        self.assertTrue(graph.refresh())
+        self.assertIsNot(snapshot, graph.snapshot)
+        self.assertIn(('dash', 'core'), self.names(snapshot,
+            snapshot.transitive_depends(snapshot.node(self.pkg))))
+        # and names of packages that are gone are dropped
+        self.assertNotIn('dash', graph.snapshot.strings.ids)
+
+    def test_json(self):
+        response = self.client.get('/packages/core/x86_64/foo/depends/json/')
+        self.assertEqual(200, response.status_code)
+        data = json.loads(response.content)
+        self.assertEqual(3, data['count'])
+        self.assertEqual({'pkgname': 'glibc', 'repo': 'core',
+            'arch': 'x86_64', 'depth': 1},
+            [p for p in data['packages'] if p['pkgname'] == 'glibc'][0])
+
+        response = self.client.get(
+                '/packages/core/x86_64/glibc/requiredby/json/')
+        self.assertEqual(3, json.loads(response.content)['count'])
+        response = self.client.get('/packages/core/x86_64/egg/cycle/json/')
+        self.assertEqual(['chicken'], [p['pkgname']
+            for p in json.loads(response.content)['packages']])
+        response = self.client.get(
+                '/packages/testing/x86_64/foo/depends/json/')
+        self.assertEqual(3, json.loads(response.content)['count'])
+
+
+class PackageBaseTest(DependsTestCase):
+
+    def setUp(self):
+        super(PackageBaseTest, self).setUp()
+        self.gcc = self.create('gcc')
+        self.gcc_libs = self.create('gcc-libs', pkgbase='gcc')
+        self.qt = self.create('qt')
+        self.qt_docs = self.create('qt-docs', repo='Extra', pkgbase='qt')
+        self.create('qt-docs', repo='Testing', pkgbase='qt')
+        self.lib32 = self.create('lib32-foo', pkgbase='foo-split')
+        update_package_bases()
+
+    def test_base_package(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.gcc, self.gcc_libs.base_package())
+        self.assertEqual(self.qt, self.qt_docs.base_package())
+        self.assertIsNone(self.lib32.base_package())
+        base = PackageBase.objects.get(pkgbase='gcc', repo__name='Core')
+        self.assertEqual({self.gcc, self.gcc_libs}, set(base.packages.all()))
+
+    def test_update(self):
+        self.qt.delete()
+        self.create('lib32-foo', repo='Extra', pkgbase='foo-split')
+        update_package_bases(['qt', 'foo-split'])
+        self.assertIsNone(self.qt_docs.base_package())
+        splits = get_split_packages_info()
+        self.assertEqual(['foo-split', 'foo-split', 'qt', 'qt'],
+                sorted(split['pkgbase'] for split in splits))
+        self.assertEqual(['Core', 'Extra'], sorted(PackageBase.objects.filter(
+            pkgbase='foo-split').values_list('repo__name', flat=True)))
+
+    def test_update_repo(self):
+        others = dict(PackageBase.objects.exclude(repo__name='Core'
+            ).values_list('id', 'pkgbase'))
+        self.create('gcc-docs', pkgbase='gcc')
+        self.create('qt-docs', repo='Extra', arch='i686', pkgbase='qt')
+        update_package_bases(['gcc', 'gcc-docs', 'qt', 'qt-docs'],
+                Repo.objects.get(name='Core'),
+                [Arch.objects.get(name='x86_64')])
+        base = PackageBase.objects.get(pkgbase='gcc', repo__name='Core')
+        self.assertEqual(['gcc', 'gcc-docs', 'gcc-libs'],
+                sorted(pkg.pkgname for pkg in base.packages.all()))
+        # other repos keep their rows, and only pick up their own changes
+        self.assertEqual(others, dict(PackageBase.objects.exclude(
+            repo__name='Core').values_list('id', 'pkgbase')))
+
+    def test_target_repo(self):
+        repos = get_target_repo_map(Repo.objects.filter(name='Testing'))
+        self.assertEqual('Core', repos['glibc'])
+        self.assertIn(repos['qt'], ('Core', 'Extra'))
+        self.assertNotIn('nawk', repos)
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class MaintainerCacheTest(DependsTestCase):
+
+    def setUp(self):
+        super(MaintainerCacheTest, self).setUp()
+        maintainer_cache.clear()
+        self.joe = User.objects.create(username='joe')
+        self.ann = User.objects.create(username='ann')
+        for user in (self.joe, self.ann):
+            PackageRelation.objects.create(pkgbase='foo', user=user)
+
+    def test_attach(self):
+        packages = list(Package.objects.filter(pkgname__in=('foo', 'glibc')))
+        self.assertEqual(4, len(packages))
+        attach_maintainers(packages)
+        with self.assertNumQueries(0):
+            attach_maintainers(packages)
+            self.assertEqual([self.ann, self.joe], self.pkg.maintainers)
+        maintainers = {pkg.pkgname: pkg.maintainers for pkg in packages}
+        self.assertEqual(['ann', 'joe'],
+                [user.username for user in maintainers['foo']])
+        self.assertEqual([], maintainers['glibc'])
+
+    def test_invalidate(self):
+        self.assertEqual([self.ann, self.joe], self.pkg.maintainers)
+        PackageRelation.objects.filter(user=self.ann).delete()
+        self.assertEqual([self.joe], self.testing_pkg.maintainers)
+        self.joe.first_name = 'Joe'
+        self.joe.save()
+        self.assertEqual('Joe', attach_maintainers(
+            [self.pkg])[0].maintainers[0].first_name)
+
+        # logins, new users and other fields leave the cache alone
+        self.joe.save(update_fields=['last_login'])
+        self.joe.save(update_fields=['password', 'is_staff'])
+        User.objects.create(username='bob')
+        with self.assertNumQueries(0):
+            attach_maintainers([self.pkg])
+
+    def test_deferred(self):
+        generation = stored_generation(MAINTAINERS_GENERATION)
+        with defer_maintainers():
+            bob = User.objects.create(username='bob')
+            PackageRelation.objects.create(pkgbase='foo', user=bob)
+            self.ann.delete()
+        self.assertEqual(generation, stored_generation(MAINTAINERS_GENERATION))
+        flush_maintainers()
+        self.assertEqual([bob, self.joe], get_maintainers('foo'))
+        # with nothing held back, nothing changes
+        flush_maintainers()
+        self.assertEqual(generation + 1,
+                stored_generation(MAINTAINERS_GENERATION))
+
+    def test_other_process(self):
+        self.assertEqual([self.ann, self.joe], get_maintainers('foo'))
+        # as done by another process, which leaves our copy alone
+        PackageRelation.objects.filter(user=self.ann).update(pkgbase='bar')
+        bump_stored_generation(MAINTAINERS_GENERATION)
+        self.assertEqual([self.ann, self.joe], get_maintainers('foo'))
+        maintainer_cache.checked -= maintainer_cache.check_interval
+        self.assertEqual([self.joe], get_maintainers('foo'))
+
+
+class SearchTest(DependsTestCase):
+
+    def setUp(self):
+        super(SearchTest, self).setUp()
+        self.create('awk', repo='Extra')
+        self.create('awk-tools', repo='Extra')
+        Package.objects.filter(pkgname='python').update(
+                pkgdesc='Scripting language, not to be confused with AWK')
+        PackageGroup.objects.create(pkg=self.pkg, name='base-devel')
+        update_search_index()
+
+    def search(self, **params):
+        response = self.client.get('/packages/search/json/', params)
+        self.assertEqual(200, response.status_code)
+        return [pkg['pkgname'] for pkg in json.loads(response.content)['results']]
+
+    def test_terms(self):
+        self.assertEqual(['python', 'foo', 'bar', '2'],
+                search_terms('Python foo_bar-2 !'))
+
+    def test_ranking(self):
+        results = self.search(q='awk')
+        # exact name, name prefix, provides, then the rest
+        self.assertEqual(['awk', 'awk-tools'], results[:2])
+        self.assertEqual(['gawk', 'mawk', 'nawk'], sorted(results[2:5]))
+        self.assertEqual(['python'], results[5:])
+
+    def test_match(self):
+        self.assertEqual(['python'], self.search(q='confused scripting'))
+        self.assertEqual(['python'], self.search(q='script'))
+        self.assertEqual(['foo'], self.search(q='base-devel'))
+        self.assertEqual(['gawk', 'nawk'], self.search(q='aw', arch='x86_64',
+            repo=['Core', 'Testing']))
+        self.assertEqual([], self.search(q='%'))
+
+    def test_punctuation(self):
+        Package.objects.filter(pkgname='awk').update(
+                pkgdesc='Pattern scanning for C++ and gtk+ sources')
+        update_search_index()
+        # splitting these into terms would match "confused" and "tools"
+        self.assertEqual(['awk'], self.search(q='c++'))
+        self.assertEqual(['awk'], self.search(q='gtk+'))
+        self.assertEqual(['awk'], self.search(q='+ and gtk'))
+
+    def test_substring(self):
+        self.assertEqual(['python'], self.search(q='onfused with'))
+        self.assertEqual(['python'], self.search(q='guage'))
+
+    def test_update(self):
+        Package.objects.filter(pkgname='python').update(pkgdesc='snake')
+        self.assertEqual(['python'], self.search(q='confused'))
+        update_search_index(Package.objects.filter(
+            pkgname='python').values_list('id', flat=True))
+        self.assertEqual([], self.search(q='confused'))
+        self.assertEqual(['python'], self.search(q='snake'))
+
+
+class SuggestTest(DependsTestCase):
+
+    def setUp(self):
+        super(SuggestTest, self).setUp()
+        package_names.clear()
+        RepoDatabaseState.objects.create(repo=Repo.objects.get(name='Core'),
+                arch=Arch.objects.get(name='x86_64'), generation=1,
+                last_import=now())
+
+    def suggest(self, term):
+        response = self.client.get('/opensearch/packages/suggest',
+                {'q': term})
+        self.assertEqual(200, response.status_code)
+        return json.loads(response.content)
+
+    def test_suggest(self):
+        self.assertEqual(['gl', ['glibc']], self.suggest('gl'))
+        self.assertEqual(['GAwk', ['gawk']], self.suggest('GAwk'))
+        with self.assertNumQueries(0):
+            self.assertEqual(['g', ['gawk', 'glibc']], self.suggest('g'))
+            self.assertEqual(['a', []], self.suggest('a'))
+
+    def test_refresh(self):
+        self.suggest('x')
+        self.create('xz')
+        self.assertEqual(['x', []], self.suggest('x'))
+        # a new import is picked up at the next check
+        RepoDatabaseState.objects.update(generation=2)
+        package_names.checked = None
+        self.assertEqual(['x', ['xz']], self.suggest('x'))
+
+
+class KeysetPaginationTest(DependsTestCase):
+
+    def setUp(self):
+        super(KeysetPaginationTest, self).setUp()
+        Package.objects.filter(pkgname__in=('bash', 'nawk')).update(
+                flag_date=now())
+        Package.objects.filter(pkgname='gawk').update(build_date=now())
+
+    def walk(self, packages, per_page=3):
+        paginator = KeysetPaginator(packages, per_page)
+        pages = [paginator.page()]
+        while pages[-1].has_next():
+            pages.append(paginator.page(after=pages[-1].next_cursor))
+        ids = [pkg.id for page in pages for pkg in page]
+        # and back again
+        page = pages[-1]
+        back = []
+        while page.has_previous():
+            page = paginator.page(before=page.previous_cursor)
+            back[:0] = [pkg.id for pkg in page]
+        self.assertEqual(ids[:len(back)], back)
+        return ids
+
+    def test_orderings(self):
+        packages = Package.objects.normal()
+        for sort in ('pkgname', '-last_update', 'flag_date', '-flag_date',
+                'build_date', '-arch__name', 'repo__name'):
+            expected = list(packages.order_by(sort, 'pk').values_list(
+                'id', flat=True))
+            self.assertEqual(expected, self.walk(packages.order_by(sort)),
+                    sort)
+
+    def test_invalid(self):
+        paginator = KeysetPaginator(Package.objects.all(), 3)
+        for cursor in ('garbage', 'WzFd', paginator.encode(self.pkg) + 'x'):
+            with self.assertRaises(InvalidCursor):
+                paginator.page(after=cursor)
+
+    def test_search_json(self):
+        update_search_index()
+        response = self.client.get('/packages/search/json/',
+                {'q': 'awk', 'count': 1})
+        results = json.loads(response.content)
+        self.assertEqual(3, results['count'])
+        self.assertFalse(results['count_is_estimate'])
+        self.assertEqual(None, results['next'])
+        self.assertEqual(['gawk', 'mawk', 'nawk'],
+                sorted(pkg['pkgname'] for pkg in results['results']))
+        ranked = Package.objects.all()
+        ranked = search_packages(ranked, 'awk').order_by(*RANK_ORDER)
+        self.assertEqual([pkg.id for pkg in ranked], self.walk(ranked, 1))
+
+    def test_tied_scores(self):
+        for name in ('wa', 'wb', 'wc'):
+            for repo in ('Core', 'Extra'):
+                self.create(name, repo=repo)
+        Package.objects.filter(pkgname__in=('wa', 'wb', 'wc')).update(
+                pkgdesc='Frobnicates widgets')
+        update_search_index()
+        ranked = search_packages(Package.objects.all(), 'widgets')
+        ranked = ranked.order_by(*RANK_ORDER)
+        self.assertEqual(1, len({pkg.search_score for pkg in ranked}))
+        self.assertEqual([pkg.id for pkg in ranked], self.walk(ranked, 1))
+        self.assertEqual(6, len(ranked))
+
+    def test_search_html(self):
+        response = self.client.get('/packages/', {'sort': '-last_update'})
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(response.context['is_paginated'])
+        self.assertEqual(404, self.client.get('/packages/',
+            {'after': 'garbage'}).status_code)
+
+
+class ExportTest(DependsTestCase):
+
+    def setUp(self):
+        super(ExportTest, self).setUp()
+        self.export_dir = tempfile.mkdtemp()
+        self.settings = override_settings(PACKAGE_EXPORT_DIR=self.export_dir)
+        self.settings.enable()
+        PackageGroup.objects.create(pkg=self.pkg, name='base-devel')
+        PackageRelation.objects.create(pkgbase='foo',
+                user=User.objects.create(username='joe'))
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.export_dir)
+        super(ExportTest, self).tearDown()
+
+    def export(self, **params):
+        response = self.client.get('/packages/export/json/', params)
+        self.assertEqual(200, response.status_code)
+        return [json.loads(line) for line in
+                b''.join(response.streaming_content).splitlines()]
+
+    def test_records(self):
+        records = self.export(repo='core', arch='x86_64')
+        self.assertEqual(['glibc', 'gawk', 'foo'],
+                [record['pkgname'] for record in records])
+        response = self.client.get('/packages/search/json/',
+                {'name': 'foo', 'repo': 'Core'})
+        self.assertEqual(json.loads(response.content)['results'][0],
+                records[-1])
+        self.assertEqual(['joe'], records[-1]['maintainers'])
+        self.assertEqual(9, len(self.export()))
+        self.assertEqual(404, self.client.get('/packages/export/json/',
+            {'repo': 'nonexistent'}).status_code)
+        self.assertEqual(404, self.client.get(
+            '/packages/export/xml/').status_code)
+
+    def test_cached(self):
+        records = self.export(arch='i686')
+        self.assertEqual(1, len(os.listdir(self.export_dir)))
+        with self.assertNumQueries(5):
+            self.assertEqual(records, self.export(arch='i686'))
+
+        # imports make for a new export
+        Package.objects.filter(pkgname='bash').update(pkgdesc='shell')
+        self.assertEqual(records, self.export(arch='i686'))
+        RepoDatabaseState.objects.create(repo=Repo.objects.get(name='Core'),
+                arch=Arch.objects.get(name='i686'), generation=1,
+                last_import=now())
+        self.assertEqual('shell', self.export(arch='i686')[0]['pkgdesc'])
+
+        # and so do changes to flags and maintainers
+        Package.objects.filter(pkgname='bash').update(flag_date=now())
+        invalidate_flags()
+        self.assertIsNotNone(self.export(arch='i686')[0]['flag_date'])
+        PackageRelation.objects.create(pkgbase='bash',
+                user=User.objects.get(username='joe'))
+        self.assertEqual(['joe'], self.export(arch='i686')[0]['maintainers'])
+        self.assertEqual(1, len(os.listdir(self.export_dir)))
+
+
+class SerializerTest(DependsTestCase):
+
+    def setUp(self):
+        super(SerializerTest, self).setUp()
+        PackageGroup.objects.create(pkg=self.pkg, name='base-devel')
+        License.objects.create(pkg=self.pkg, name='GPL')
+        Depend.objects.create(pkg=self.pkg, name='perl', comparison='>=',
+                version='5.20', description='for scripts', deptype='O')
+        Provision.objects.create(pkg=self.pkg, name='bar', version='2.0')
+        Conflict.objects.create(pkg=self.pkg, name='baz', comparison='<',
+                version='1:3')
+        Replacement.objects.create(pkg=self.pkg, name='qux')
+        self.joe = User.objects.create(username='joe')
+        PackageRelation.objects.create(pkgbase='foo', user=self.joe)
+        Package.objects.filter(pkgname='foo').update(packager=self.joe,
+                flag_date=now(), build_date=now(), url=u'http://f\xf6o/')
+
+    def test_records(self):
+        packages = Package.objects.normal().order_by('id')
+        expected = json.loads(json.dumps(attach_maintainers(
+            packages.prefetch_related('groups', 'licenses', 'conflicts',
+                'provides', 'replaces', 'depends')),
+            cls=PackageJSONEncoder))
+        records = package_records(packages.values(*PACKAGE_VALUES))
+        self.assertEqual(expected, json.loads(to_json(records)))
+        self.assertEqual(['perl>=5.20: for scripts'],
+                [dep for dep in records[-2]['depends'] if 'perl' in dep])
+
+    def test_files_json(self):
+        for directory, filename in (('usr/', None), ('usr/bin/', None),
+                ('usr/bin/', 'foo'), ('usr/', 'README')):
+            PackageFile.objects.create(pkg=self.pkg, directory=directory,
+                    filename=filename, is_directory=filename is None)
+        response = self.client.get('/packages/core/x86_64/foo/files/json/')
+        data = json.loads(response.content)
+        self.assertEqual(['usr/', 'usr/README', 'usr/bin/', 'usr/bin/foo'],
+                data['files'])
+        self.assertEqual((2, 2), (data['dir_count'], data['files_count']))
 
 
 # vim: set ts=4 sw=4 et:
@@ -7,6 +7,9 @@
     (r'^json/$',       'details_json'),
     (r'^files/$',      'files'),
     (r'^files/json/$', 'files_json'),
+    (r'^depends/json/$', 'depends_json'),
+    (r'^requiredby/json/$', 'requiredby_json'),
+    (r'^cycle/json/$', 'cycle_json'),
     (r'^flag/$',       'flag'),
     (r'^flag/done/$',  'flag_confirmed', {}, 'package-flag-confirmed'),
     (r'^unflag/$',     'unflag'),
@@ -25,6 +28,7 @@
 
     (r'^$', SearchListView.as_view(), {}, 'packages-search'),
     (r'^search/json/$', 'search_json'),
+    (r'^export/(?P<format_name>[a-z]+)/$', 'export'),
 
     (r'^differences/$',          'arch_differences', {}, 'packages-differences'),
     (r'^stale_relations/$',      'stale_relations'),
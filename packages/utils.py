@@ -1,20 +1,32 @@
-from collections import defaultdict
-from itertools import chain
+from bisect import bisect_left
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from itertools import chain, islice
+import json
 from operator import attrgetter, itemgetter
 import re
-
+from threading import local, Lock
+import time
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+from django.core.cache import cache
 from django.core.serializers.json import DjangoJSONEncoder
-from django.db import connection
-from django.db.models import Count, Max, F
-from django.db.models.query import QuerySet
+from django.db import connection, IntegrityError, transaction
+from django.db.models import Count, F, Max, Q, Sum
 from django.contrib.auth.models import User
+from django.template.loader import render_to_string
 
 from main.models import Package, PackageFile, Arch, Repo
 from main.utils import (database_vendor,
         groupby_preserve_order, PackageStandin)
+from .alpm import AlpmAPI
 from .models import (PackageGroup, PackageRelation,
-        License, Depend, Conflict, Provision, Replacement,
-        SignoffSpecification, Signoff, fake_signoff_spec)
+        License, Depend, Conflict, Provision, Replacement, ReverseDepend,
+        PackageBase, Generation, RepoDatabaseState, SignoffSpecification,
+        Signoff, fake_signoff_spec)
 
 
 VERSION_RE = re.compile(r'^((\d+):)?(.+)-([^-]+)$')
@@ -76,9 +88,9 @@ def get_split_packages_info():
     '''Return info on split packages that do not have an actual package name
     matching the split pkgbase.'''
     pkgnames = Package.objects.values('pkgname')
-    split_pkgs = Package.objects.exclude(pkgname=F('pkgbase')).exclude(
-            pkgbase__in=pkgnames).values('pkgbase', 'repo', 'arch').annotate(
-            last_update=Max('last_update')).order_by().distinct()
+    split_pkgs = PackageBase.objects.filter(base__isnull=True).exclude(
+            pkgbase__in=pkgnames).values('pkgbase', 'repo', 'arch',
+            'last_update').order_by()
     all_arches = Arch.objects.in_bulk({s['arch'] for s in split_pkgs})
     all_repos = Repo.objects.in_bulk({s['repo'] for s in split_pkgs})
     for split in split_pkgs:
@@ -249,39 +261,666 @@ def get_wrong_permissions():
     return relations
 
 
-def attach_maintainers(packages):
-    '''Given a queryset or something resembling it of package objects, find all
-    the maintainers and attach them to the packages to prevent N+1 query
-    cascading.'''
-    if isinstance(packages, QuerySet):
-        pkgbases = packages.values('pkgbase')
+def stored_generation(name):
+    '''The current value of a generation counter kept in the database.'''
+    generations = Generation.objects.filter(name=name).values_list(
+            'generation', flat=True)
+    return generations[0] if generations else 0
+
+
+def bump_stored_generation(name):
+    updated = Generation.objects.filter(name=name).update(
+            generation=F('generation') + 1)
+    if updated:
+        return
+    try:
+        with transaction.atomic():
+            Generation.objects.create(name=name, generation=1)
+    except IntegrityError:
+        # someone else created it in the meantime
+        Generation.objects.filter(name=name).update(
+                generation=F('generation') + 1)
+
+
+MAINTAINERS_GENERATION = 'maintainers'
+
+
+class MaintainerCache(object):
+    '''
+    A process-wide copy of who maintains which pkgbase, so the maintainers of
+    any number of packages can be found without a query. It holds a map of
+    pkgbase to maintainer user ids and one of user id to a lightweight User
+    object with just the fields needed to show and compare maintainers.
+    These objects are shared between all callers; never modify or save them.
+
+    The copy is reloaded once the maintainers generation stored in the
+    database has moved on, which happens whenever a PackageRelation or one
+    of the user_fields of a User changes; see invalidate_maintainers().
+    Changes made by this process show up right away; to keep lookups free
+    of any round trip, the generation is only looked at once every
+    check_interval seconds, so changes made by other processes may take
+    that long to show up.
+    '''
+    user_fields = ('id', 'username', 'first_name', 'last_name', 'email',
+            'is_active')
+    check_interval = 10
+
+    def __init__(self):
+        self.lock = Lock()
+        self.generation = None
+        self.checked = None
+        self.pkgbases = {}
+        self.users = {}
+
+    def refresh(self):
+        now = time.time()
+        if self.checked is not None and \
+                now - self.checked < self.check_interval:
+            return
+        with self.lock:
+            if self.checked is not None and \
+                    now - self.checked < self.check_interval:
+                return
+            generation = stored_generation(MAINTAINERS_GENERATION)
+            if generation != self.generation:
+                self.load()
+                self.generation = generation
+            self.checked = now
+
+    def load(self):
+        rels = PackageRelation.objects.filter(
+                type=PackageRelation.MAINTAINER).values_list(
+                'pkgbase', 'user_id').order_by().distinct()
+        pkgbases = defaultdict(list)
+        for pkgbase, user_id in rels:
+            pkgbases[pkgbase].append(user_id)
+        users = User.objects.filter(id__in={user_id for _, user_id in rels}
+                ).values_list(*self.user_fields).order_by()
+        users = {values[0]: User(**dict(zip(self.user_fields, values)))
+                for values in users}
+        # keep the order stable between reloads
+        username = lambda user_id: users[user_id].username
+        self.pkgbases = {pkgbase: tuple(sorted(user_ids, key=username))
+                for pkgbase, user_ids in pkgbases.iteritems()}
+        self.users = users
+
+    def clear(self):
+        with self.lock:
+            self.generation = None
+            self.checked = None
+
+    def maintainers(self, pkgbase):
+        users = self.users
+        return [users[user_id] for user_id in self.pkgbases.get(pkgbase, ())]
+
+
+maintainer_cache = MaintainerCache()
+
+
+def get_maintainers(pkgbase):
+    '''The maintainers of the given pkgbase, as a list of lightweight User
+    objects; see MaintainerCache.'''
+    maintainer_cache.refresh()
+    return maintainer_cache.maintainers(pkgbase)
+
+
+def invalidate_maintainers():
+    '''Make every process reload its maintainers, including this one.'''
+    bump_stored_generation(MAINTAINERS_GENERATION)
+    maintainer_cache.clear()
+
+
+deferred_maintainers = local()
+
+
+@contextmanager
+def defer_maintainers():
+    '''Leave changes to users and package relations made by this thread
+    within the block unannounced, instead of writing the shared maintainers
+    generation from within whatever transaction they are made in. The caller
+    has to call flush_maintainers() once its changes are committed.'''
+    depth = getattr(deferred_maintainers, 'depth', 0)
+    deferred_maintainers.depth = depth + 1
+    try:
+        yield
+    finally:
+        deferred_maintainers.depth = depth
+
+
+def announce_maintainers():
+    '''Called whenever maintainers may have changed.'''
+    if getattr(deferred_maintainers, 'depth', 0):
+        deferred_maintainers.pending = True
     else:
-        packages = list(packages)
-        pkgbases = {p.pkgbase for p in packages if p is not None}
-    rels = PackageRelation.objects.filter(type=PackageRelation.MAINTAINER,
-            pkgbase__in=pkgbases).values_list(
-            'pkgbase', 'user_id').order_by().distinct()
+        invalidate_maintainers()
 
-    # get all the user objects we will need
-    user_ids = {rel[1] for rel in rels}
-    users = User.objects.in_bulk(user_ids)
 
-    # now build a pkgbase -> [maintainers...] map
-    maintainers = defaultdict(list)
-    for rel in rels:
-        maintainers[rel[0]].append(users[rel[1]])
+def flush_maintainers():
+    '''Announce the changes held back by defer_maintainers(), if any.'''
+    if getattr(deferred_maintainers, 'pending', False):
+        deferred_maintainers.pending = False
+        invalidate_maintainers()
 
+
+def attach_maintainers(packages):
+    '''Given a queryset or something resembling it of package objects, find all
+    the maintainers and attach them to the packages to prevent N+1 query
+    cascading.'''
+    maintainer_cache.refresh()
     annotated = []
-    # and finally, attach the maintainer lists on the original packages
     for package in packages:
         if package is None:
             continue
-        package.maintainers = maintainers[package.pkgbase]
+        package.maintainers = maintainer_cache.maintainers(package.pkgbase)
         annotated.append(package)
 
     return annotated
 
 
+class PackageNameIndex(object):
+    '''
+    A process-wide sorted array of every distinct package name, for finding
+    the names starting with a prefix without a query.
+
+    Every import of a repo bumps the sum of the repo database generations;
+    the names are reloaded once it has moved on. To keep lookups free of any
+    round trip, that sum is only looked at once every check_interval
+    seconds, so a freshly imported name may take that long to show up.
+    '''
+    check_interval = 60
+
+    def __init__(self):
+        self.lock = Lock()
+        self.generation = None
+        self.checked = None
+        self.names = ()
+
+    def refresh(self):
+        now = time.time()
+        if self.checked is not None and \
+                now - self.checked < self.check_interval:
+            return
+        with self.lock:
+            if self.checked is not None and \
+                    now - self.checked < self.check_interval:
+                return
+            generation = RepoDatabaseState.objects.aggregate(
+                    Sum('generation'))['generation__sum'] or 0
+            if generation != self.generation:
+                self.load()
+                self.generation = generation
+            self.checked = now
+
+    def load(self):
+        names = Package.objects.values_list(
+                'pkgname', flat=True).order_by().distinct()
+        self.names = tuple(sorted(names))
+
+    def clear(self):
+        with self.lock:
+            self.generation = None
+            self.checked = None
+
+    def starting_with(self, prefix, limit):
+        '''Up to limit names starting with the prefix, in order.'''
+        names = self.names
+        start = bisect_left(names, prefix)
+        found = []
+        for name in islice(names, start, start + limit):
+            if not name.startswith(prefix):
+                break
+            found.append(name)
+        return found
+
+
+package_names = PackageNameIndex()
+
+
+def suggest_names(prefix, limit=10):
+    '''The first names of packages starting with the prefix. Package names are
+    lowercase by convention, so those starting with the lowercased prefix are
+    included as well.'''
+    package_names.refresh()
+    names = package_names.starting_with(prefix, limit)
+    lookup = prefix.lower()
+    if lookup != prefix:
+        names = sorted(set(names).union(
+            package_names.starting_with(lookup, limit)))[:limit]
+    return names
+
+
+def in_chunks(queryset, lookup, values, size=500):
+    '''Run a queryset filtered by 'lookup__in' in pieces to stay within
+    database parameter limits, returning all of the results.'''
+    values = list(values)
+    results = []
+    for offset in range(0, len(values), size):
+        results.extend(queryset.filter(
+                **{lookup: values[offset:offset + size]}))
+    return results
+
+
+def applicable(owner, pkg):
+    # match architectures if possible, see Package.applicable_arches()
+    return owner.arch.agnostic or pkg.arch.agnostic or \
+            pkg.arch_id == owner.arch_id
+
+
+def best_satisfiers(related):
+    '''Find the best satisfier of many related objects (depends, provides,
+    conflicts, etc.) at once, possibly spanning many packages. This gives the
+    same answers as calling get_best_satisfier() on each, but loads all
+    candidate packages with a single query. Returns a list of packages, or
+    None where there is no satisfier, in the order of the given objects.'''
+    related = list(related)
+    if not related:
+        return []
+    alpm = AlpmAPI()
+
+    # the owning packages, unless they were already attached
+    model = type(related[0])
+    cache_name = model._meta.get_field('pkg').get_cache_name()
+    missing = {rel.pkg_id for rel in related if not hasattr(rel, cache_name)}
+    if missing:
+        owners = Package.objects.normal().in_bulk(missing)
+        for rel in related:
+            if rel.pkg_id in missing:
+                rel.pkg = owners[rel.pkg_id]
+
+    candidates = defaultdict(list)
+    pkgs = Package.objects.normal().order_by('pkgname', 'id')
+    for pkg in in_chunks(pkgs, 'pkgname__in', {rel.name for rel in related}):
+        candidates[pkg.pkgname].append(pkg)
+
+    satisfiers = []
+    for rel in related:
+        owner = rel.pkg
+        pkgs = [pkg for pkg in candidates[rel.name] if applicable(owner, pkg)]
+        if rel.comparison and rel.version:
+            pkgs = [pkg for pkg in pkgs if alpm.compare_versions(
+                pkg.full_version, rel.comparison, rel.version)]
+        best = None
+        if pkgs:
+            # grab the first, then the best available by staging and testing
+            # status in case the filtering removes all entries
+            best = pkgs[0]
+            pkgs = [p for p in pkgs if p.repo.staging == owner.repo.staging]
+            if pkgs:
+                best = pkgs[0]
+            pkgs = [p for p in pkgs if p.repo.testing == owner.repo.testing]
+            if pkgs:
+                best = pkgs[0]
+        satisfiers.append(best)
+    return satisfiers
+
+
+def resolve_depends(depends):
+    '''Resolve many Depend objects at once, possibly spanning many packages.
+    This gives the same answers as calling get_best_satisfier() on each, and
+    get_providers() on those without a satisfier, but loads all candidate
+    packages and provisions with a fixed number of queries and ranks them in
+    memory. Returns a list of ('dep', 'pkg', 'providers') dicts in the order
+    of the given depends; see Package.get_depends().'''
+    depends = list(depends)
+    if not depends:
+        return []
+    alpm = AlpmAPI()
+
+    def versioned(dep):
+        return dep.comparison and dep.version
+
+    resolved = [{'dep': dep, 'pkg': best, 'providers': None}
+            for dep, best in zip(depends, best_satisfiers(depends))]
+
+    unresolved = [item['dep'] for item in resolved if item['pkg'] is None]
+    provisions = defaultdict(list)
+    provides = Provision.objects.select_related(
+            'pkg__arch', 'pkg__repo').order_by('pkg__id', 'id')
+    for provision in in_chunks(provides, 'name__in',
+            {dep.name for dep in unresolved}):
+        provisions[provision.name].append(provision)
+
+    for item in resolved:
+        if item['pkg'] is not None:
+            continue
+        dep = item['dep']
+        owner = dep.pkg
+        matches = [p for p in provisions[dep.name]
+                if applicable(owner, p.pkg)]
+        if versioned(dep):
+            pkgs = [p.pkg for p in matches if alpm.compare_versions(
+                p.version, dep.comparison, dep.version)]
+        else:
+            seen = set()
+            pkgs = []
+            for provision in matches:
+                if provision.pkg_id not in seen:
+                    seen.add(provision.pkg_id)
+                    pkgs.append(provision.pkg)
+        # same staging/testing combination first, followed by others
+        key_func = lambda x: (x.repo.staging == owner.repo.staging,
+                x.repo.testing == owner.repo.testing)
+        item['providers'] = sorted(pkgs, key=key_func, reverse=True)
+
+    return resolved
+
+
+REVERSE_DEPENDS_SQL = '''
+SELECT p.id AS pkg_id, d.id AS depend_id
+FROM packages_depend d
+JOIN packages p ON p.pkgname = d.name
+%(where_name)s
+UNION
+SELECT z.pkg_id AS pkg_id, d.id AS depend_id
+FROM packages_depend d
+JOIN packages_provision z ON z.name = d.name
+%(where_provision)s
+'''
+
+
+def update_reverse_depends(pkg_ids=None):
+    '''Recompute the ReverseDepend rows of the depends of the given packages,
+    as well as those pointing at the given packages, since their names and
+    provisions may have changed. Rows of deleted packages and depends go away
+    on their own. With no package ids, the whole index is rebuilt.
+
+    The rows are replaced in one transaction, which is retried if a
+    concurrent update of related packages created some of the same rows in
+    the meantime. Run this once the packages themselves are committed, so
+    pairs between packages of imports running at the same time are found by
+    whichever of them gets here last.'''
+    cursor = connection.cursor()
+    table = ReverseDepend._meta.db_table
+    if pkg_ids is None:
+        with transaction.atomic():
+            cursor.execute('DELETE FROM %s' % table)
+            cursor.execute('INSERT INTO %s (pkg_id, depend_id) %s' % (table,
+                REVERSE_DEPENDS_SQL % {'where_name': '',
+                    'where_provision': ''}))
+        return
+
+    pkg_ids = sorted(set(pkg_ids))
+    for attempt in range(3):
+        try:
+            with transaction.atomic():
+                replace_reverse_depends(cursor, table, pkg_ids)
+            break
+        except IntegrityError:
+            if attempt == 2:
+                raise
+
+
+def replace_reverse_depends(cursor, table, pkg_ids):
+    for offset in range(0, len(pkg_ids), 250):
+        ids = pkg_ids[offset:offset + 250]
+        placeholders = ', '.join(['%s'] * len(ids))
+        cursor.execute('''DELETE FROM %s WHERE pkg_id IN (%s)
+        OR depend_id IN (SELECT id FROM packages_depend WHERE pkg_id IN (%s))
+        ''' % (table, placeholders, placeholders), ids + ids)
+    for offset in range(0, len(pkg_ids), 250):
+        ids = pkg_ids[offset:offset + 250]
+        placeholders = ', '.join(['%s'] * len(ids))
+        select = REVERSE_DEPENDS_SQL % {
+            'where_name': 'WHERE d.pkg_id IN (%s) OR p.id IN (%s)' % (
+                placeholders, placeholders),
+            'where_provision': 'WHERE d.pkg_id IN (%s) OR z.pkg_id IN (%s)' % (
+                placeholders, placeholders),
+        }
+        # a pair may have been found through an earlier chunk already
+        cursor.execute('''INSERT INTO %s (pkg_id, depend_id)
+        SELECT x.pkg_id, x.depend_id FROM (%s) x
+        WHERE NOT EXISTS (SELECT 1 FROM %s r
+            WHERE r.pkg_id = x.pkg_id AND r.depend_id = x.depend_id)
+        ''' % (table, select, table), ids * 4)
+
+
+def create_package_bases(packages, pkgbases=None, model=PackageBase,
+        scopes=None):
+    '''Create the PackageBase rows for the given packages, restricted to
+    the given pkgbase names and (repo id, arch id) scopes if any. Base
+    packages are looked for among all of the given packages, so these must
+    include every package named after one of the pkgbases. Migrations pass
+    in their own version of the model.'''
+    packages = packages.values('id', 'pkgname', 'pkgbase', 'repo_id',
+            'arch_id', 'repo__testing', 'repo__staging', 'pkgver', 'pkgrel',
+            'epoch', 'last_update').order_by('id')
+    members = defaultdict(list)
+    named = defaultdict(list)
+    for pkg in packages:
+        if (pkgbases is None or pkg['pkgbase'] in pkgbases) and \
+                (scopes is None or
+                    (pkg['repo_id'], pkg['arch_id']) in scopes):
+            members[(pkg['pkgbase'], pkg['repo_id'], pkg['arch_id'])].append(
+                    pkg)
+        named[pkg['pkgname']].append(pkg)
+
+    bases = []
+    for (pkgbase, repo_id, arch_id), pkgs in members.items():
+        first = pkgs[0]
+        # the same search as Package.base_package(): this repo first, then
+        # any other with the same testing and staging flags
+        candidates = [p for p in named[pkgbase] if p['arch_id'] == arch_id
+                and p['repo__testing'] == first['repo__testing']
+                and p['repo__staging'] == first['repo__staging']]
+        base = next((p for p in candidates if p['repo_id'] == repo_id),
+                candidates[0] if candidates else None)
+        if base is None or base['repo_id'] != repo_id:
+            version = max(pkgs, key=itemgetter('last_update'))
+        else:
+            version = base
+        bases.append(model(pkgbase=pkgbase, repo_id=repo_id,
+                arch_id=arch_id, base_id=base['id'] if base else None,
+                pkgver=version['pkgver'], pkgrel=version['pkgrel'],
+                epoch=version['epoch'],
+                last_update=max(p['last_update'] for p in pkgs)))
+    model.objects.bulk_create(bases)
+
+    # bulk_create() does not give us primary keys, so fetch them
+    created = model.objects.values_list('pkgbase', 'repo_id',
+            'arch_id', 'id').order_by()
+    if pkgbases is not None:
+        created = created.filter(pkgbase__in=pkgbases)
+    Membership = model.packages.through
+    Membership.objects.bulk_create([
+            Membership(packagebase_id=base_id, package_id=pkg['id'])
+            for pkgbase, repo_id, arch_id, base_id in created
+            for pkg in members[(pkgbase, repo_id, arch_id)]])
+
+
+def update_package_bases(pkgbases=None, repo=None, arches=None):
+    '''Recompute the PackageBase rows of the given pkgbase names; any
+    package that was added, removed or changed should have both its pkgbase
+    and its pkgname passed in, as it may be the base package of another
+    pkgbase. With no names, the whole index is rebuilt.
+
+    Given a repo and its arches, only the rows of those are recomputed, so
+    imports of other repos running at the same time never touch the same
+    rows. Rows of other repos whose base package lives in this one lose it
+    when it is removed, and find a new one when their own repo is imported.
+    Each chunk of names is replaced in one transaction, which is retried
+    if a concurrent import of another architecture of the same repo created
+    some of the same rows in the meantime.'''
+    if pkgbases is None:
+        with transaction.atomic():
+            PackageBase.objects.all().delete()
+            create_package_bases(Package.objects.all())
+        return
+
+    bases = PackageBase.objects.all()
+    scopes = None
+    if repo is not None:
+        bases = bases.filter(repo=repo, arch__in=arches)
+        scopes = {(repo.id, arch.id) for arch in arches}
+    pkgbases = sorted(set(pkgbases))
+    for offset in range(0, len(pkgbases), 250):
+        names = pkgbases[offset:offset + 250]
+        packages = Package.objects.filter(
+                Q(pkgbase__in=names) | Q(pkgname__in=names))
+        for attempt in range(3):
+            try:
+                with transaction.atomic():
+                    # concurrent rebuilds of the same rows wait for this one
+                    list(bases.filter(pkgbase__in=names).select_for_update(
+                        ).values_list('id', flat=True))
+                    bases.filter(pkgbase__in=names).delete()
+                    create_package_bases(packages, set(names),
+                            scopes=scopes)
+                break
+            except IntegrityError:
+                if attempt == 2:
+                    raise
+
+
+def package_details(pkg):
+    '''Load everything the package details page shows about a package, using
+    a bounded number of queries no matter how many relations or other
+    versions it has. Each value matches what the Package method of the same
+    name would return. Returns the template context.'''
+    arch_ids = {arch.id for arch in pkg.applicable_arches()}
+    same_flags = lambda p: (p.repo.testing == pkg.repo.testing and
+            p.repo.staging == pkg.repo.staging)
+
+    # every other package in elsewhere(), in_testing(), base_package() and
+    # split_packages() in one go
+    names = pkg.elsewhere_names()
+    others = Package.objects.normal().filter(
+            Q(pkgname__in=names + [pkg.pkgbase]) | Q(pkgbase=pkg.pkgbase)
+            ).exclude(id=pkg.id).order_by('pkgname', 'arch__name', 'repo__name')
+    others = list(others)
+    elsewhere = sorted((p for p in others if p.pkgname in names),
+            key=lambda p: (p.arch.name, p.repo.name))
+    in_testing = None
+    if not pkg.repo.testing:
+        in_testing = next((p for p in others if p.repo.testing and
+            p.pkgname == pkg.pkgname and p.arch_id == pkg.arch_id), None)
+    base_package = pkg if pkg.pkgname == pkg.pkgbase else None
+    if base_package is None:
+        bases = [p for p in others if p.pkgname == pkg.pkgbase and
+                p.arch_id == pkg.arch_id]
+        base_package = next((p for p in bases if p.repo_id == pkg.repo_id),
+                next((p for p in bases if same_flags(p)), None))
+    split_packages = [p for p in others if p.pkgbase == pkg.pkgbase and
+            p.arch_id in arch_ids and same_flags(p)]
+
+    # resolve the links of all relations at once
+    relations = {}
+    for name in ('provides', 'replaces', 'conflicts'):
+        relations[name] = list(getattr(pkg, name).all())
+        for related in relations[name]:
+            related.pkg = pkg
+    satisfiers = iter(best_satisfiers(chain.from_iterable(
+        relations[name] for name in ('provides', 'replaces', 'conflicts'))))
+    for name in ('provides', 'replaces', 'conflicts'):
+        relations[name] = [(related, next(satisfiers))
+                for related in relations[name]]
+
+    context = {
+        'pkg': pkg,
+        'licenses': list(pkg.licenses.all()),
+        'groups': list(pkg.groups.all()),
+        'maintainers': list(pkg.maintainers),
+        'signer': pkg.signer,
+        'flag_request': pkg.flag_request(),
+        'in_testing': in_testing,
+        'elsewhere': elsewhere,
+        'base_package': base_package,
+        'split_packages': split_packages,
+        'reverse_conflicts': pkg.reverse_conflicts(),
+        'metadata': details_metadata(pkg),
+    }
+    context.update(relations)
+    return context
+
+
+DETAILS_GENERATION_KEY = 'packages:details:generation'
+DETAILS_ARCH_GENERATION_KEY = 'packages:details:generation:%s'
+DETAILS_CACHE_TIMEOUT = 86400
+
+
+def cache_generation(key):
+    '''The current value of a generation counter kept in the cache.'''
+    generation = cache.get(key)
+    if generation is None:
+        # start from the clock, so losing the counter from the cache can
+        # never bring back anything cached before it was lost
+        generation = int(time.time())
+        cache.add(key, generation, None)
+    return generation
+
+
+def bump_generation(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time()), None)
+
+
+def details_generation():
+    return cache_generation(DETAILS_GENERATION_KEY)
+
+
+def details_generations(pkg):
+    '''The generation counters the cached details of a package depend on:
+    the global one, and those of the architectures its relations are found
+    in. Packages of agnostic architectures are required by packages of any
+    architecture, so they share one that changes along with all others.'''
+    if pkg.arch.agnostic:
+        keys = [DETAILS_ARCH_GENERATION_KEY % 'all']
+    else:
+        keys = [DETAILS_ARCH_GENERATION_KEY % arch_id for arch_id in
+                sorted(arch.id for arch in pkg.applicable_arches())]
+    return [details_generation()] + [cache_generation(key) for key in keys]
+
+
+def invalidate_details(arch_ids=None):
+    '''Throw away cached package details fragments: all of them, or those
+    that may show packages of the given architectures. Needs to be called
+    whenever packages or their relations change.'''
+    if arch_ids is None:
+        bump_generation(DETAILS_GENERATION_KEY)
+        return
+    for arch_id in set(arch_ids):
+        bump_generation(DETAILS_ARCH_GENERATION_KEY % arch_id)
+    bump_generation(DETAILS_ARCH_GENERATION_KEY % 'all')
+
+
+FLAGS_GENERATION = 'flags'
+
+
+def invalidate_flags():
+    '''Needs to be called whenever packages are flagged or unflagged outside
+    of reporead, which takes care of the packages it imports itself. Cached
+    details fragments are keyed on the flag date of their package, so these
+    stay valid; the counter is for package exports.'''
+    bump_stored_generation(FLAGS_GENERATION)
+
+
+def details_fragment_key(pkg):
+    flag_date = pkg.flag_date.isoformat() if pkg.flag_date else ''
+    return 'packages:details:%d:%s:%s:%s' % (pkg.id,
+            pkg.last_update.isoformat(), flag_date,
+            '.'.join(str(generation) for generation in
+                details_generations(pkg)))
+
+
+def details_metadata(pkg):
+    '''The rendered dependencies, required by and package contents sections
+    of the package details page. These take the bulk of the queries, but
+    only change when reporead runs, so they are cached across requests.'''
+    key = details_fragment_key(pkg)
+    metadata = cache.get(key)
+    if metadata is None:
+        context = {
+            'pkg': pkg,
+            'depends': pkg.get_depends(),
+            'requiredby': pkg.get_requiredby(),
+        }
+        metadata = render_to_string('packages/details_metadata.html.jinja',
+                context)
+        cache.set(key, metadata, DETAILS_CACHE_TIMEOUT)
+    return metadata
+
+
 def approved_by_signoffs(signoffs, spec):
     if signoffs:
         good_signoffs = sum(1 for s in signoffs if not s.revoked)
@@ -417,13 +1056,13 @@ def get_current_specifications(repos):
 
 def get_target_repo_map(repos):
     sql = """
-SELECT DISTINCT p1.pkgbase, r.name
-    FROM packages p1
-    JOIN repos r ON p1.repo_id = r.id
-    JOIN packages p2 ON p1.pkgbase = p2.pkgbase
+SELECT DISTINCT b1.pkgbase, r.name
+    FROM packages_packagebase b1
+    JOIN repos r ON b1.repo_id = r.id
+    JOIN packages_packagebase b2 ON b1.pkgbase = b2.pkgbase
     WHERE r.staging = %s
     AND r.testing = %s
-    AND p2.repo_id IN (
+    AND b2.repo_id IN (
     """
     sql += ','.join(['%s' for _ in repos])
     sql += ")"
@@ -502,4 +1141,107 @@ def default(self, obj):
             return obj.username
         return super(PackageJSONEncoder, self).default(obj)
 
+
+# The columns package_records() needs, in values() terms, mapped to the keys
+# they end up under; the rest of the keys are filled in from relations.
+PACKAGE_VALUES = OrderedDict((
+    ('id', None),
+    ('pkgname', 'pkgname'),
+    ('pkgbase', 'pkgbase'),
+    ('repo__name', 'repo'),
+    ('arch__name', 'arch'),
+    ('pkgver', 'pkgver'),
+    ('pkgrel', 'pkgrel'),
+    ('epoch', 'epoch'),
+    ('pkgdesc', 'pkgdesc'),
+    ('url', 'url'),
+    ('filename', 'filename'),
+    ('compressed_size', 'compressed_size'),
+    ('installed_size', 'installed_size'),
+    ('build_date', 'build_date'),
+    ('last_update', 'last_update'),
+    ('flag_date', 'flag_date'),
+    ('packager__username', 'packager'),
+))
+
+
+def relation_strings(rows):
+    '''unicode() of each related object, as done from its values: name,
+    comparison, version and depend description, where the model has those.'''
+    for row in rows:
+        name, comparison, version = row[1:4]
+        value = name + comparison + version if version else name
+        if len(row) > 4 and row[4]:
+            value = u'%s: %s' % (value, row[4])
+        yield row[0], value
+
+
+def provision_strings(rows):
+    for pkg_id, name, version in rows:
+        yield pkg_id, name + u'=' + version if version else name
+
+
+# (key, model, columns after pkg_id, conversion of the rows)
+PACKAGE_RELATIONS = (
+    ('groups', PackageGroup, ('name',), None),
+    ('licenses', License, ('name',), None),
+    ('conflicts', Conflict, ('name', 'comparison', 'version'),
+        relation_strings),
+    ('provides', Provision, ('name', 'version'), provision_strings),
+    ('replaces', Replacement, ('name', 'comparison', 'version'),
+        relation_strings),
+    ('depends', Depend, ('name', 'comparison', 'version', 'description'),
+        relation_strings),
+)
+
+
+def package_records(rows):
+    '''
+    The same data PackageJSONEncoder gives for packages, made up of plain
+    values only so it can be dumped without any help; see to_json(). Takes
+    values() rows of the PACKAGE_VALUES columns, and loads the relations and
+    maintainers of all of them at once, reading tuples rather than building
+    model objects.
+    '''
+    rows = list(rows)
+    pkg_ids = [row['id'] for row in rows]
+    related = {}
+    for key, model, columns, convert in PACKAGE_RELATIONS:
+        values = in_chunks(model.objects.values_list(
+                'pkg_id', *columns).order_by('name', 'id'),
+                'pkg_id__in', pkg_ids)
+        if convert is not None:
+            values = convert(values)
+        by_pkg = defaultdict(list)
+        for pkg_id, value in values:
+            by_pkg[pkg_id].append(value)
+        related[key] = by_pkg
+
+    maintainer_cache.refresh()
+    encode_datetime = DjangoJSONEncoder().default
+    records = []
+    for row in rows:
+        record = {key: row[column] for column, key in
+                PACKAGE_VALUES.iteritems() if key is not None}
+        record['repo'] = record['repo'].lower()
+        record['arch'] = record['arch'].lower()
+        for key in ('build_date', 'last_update', 'flag_date'):
+            if record[key] is not None:
+                record[key] = encode_datetime(record[key])
+        record['maintainers'] = [user.username for user in
+                maintainer_cache.maintainers(record['pkgbase'])]
+        for key in related:
+            record[key] = related[key][row['id']]
+        records.append(record)
+    return records
+
+
+def to_json(data):
+    '''Dump plain data, such as package_records() gives, using ujson when it
+    is available.'''
+    if ujson is not None:
+        return ujson.dumps(data, ensure_ascii=False,
+                escape_forward_slashes=False)
+    return json.dumps(data, ensure_ascii=False)
+
 # vim: set ts=4 sw=4 et:
@@ -1,11 +1,8 @@
-import hashlib
 import json
 
 from django.contrib import messages
 from django.contrib.auth.decorators import permission_required
 from django.contrib.auth.models import User
-from django.core.cache import cache
-from django.db.models import Q
 from django.http import HttpResponse
 from django.shortcuts import redirect, render
 from django.views.decorators.cache import cache_control
@@ -13,14 +10,14 @@
 
 from main.models import Package, Arch
 from ..models import PackageRelation
-from ..utils import (get_differences_info,
-        multilib_differences, get_wrong_permissions)
+from ..utils import (get_differences_info, invalidate_details,
+        multilib_differences, get_wrong_permissions, suggest_names)
 
 # make other views available from this same package
 from .display import (details, groups, group_details, files, details_json,
-        files_json, download)
+        files_json, depends_json, requiredby_json, cycle_json, download)
 from .flag import flaghelp, flag, flag_confirmed, unflag, unflag_all
-from .search import search_json
+from .search import search_json, export
 from .signoff import signoffs, signoff_package, signoff_options, signoffs_json
 
 
@@ -41,21 +38,8 @@ def opensearch_suggest(request):
     if search_term == '':
         return HttpResponse('', content_type='application/x-suggestions+json')
 
-    cache_key = 'opensearch:packages:' + \
-            hashlib.md5(search_term.encode('utf-8')).hexdigest()
-    to_json = cache.get(cache_key, None)
-    if to_json is None:
-        q = Q(pkgname__startswith=search_term)
-        lookup = search_term.lower()
-        if search_term != lookup:
-            # package names are lowercase by convention, so include that in
-            # search if original wasn't lowercase already
-            q |= Q(pkgname__startswith=lookup)
-        names = Package.objects.filter(q).values_list(
-                'pkgname', flat=True).order_by('pkgname').distinct()[:10]
-        results = [search_term, list(names)]
-        to_json = json.dumps(results, ensure_ascii=False)
-        cache.set(cache_key, to_json, 613)
+    results = [search_term, suggest_names(search_term)]
+    to_json = json.dumps(results, ensure_ascii=False)
     return HttpResponse(to_json, content_type='application/x-suggestions+json')
 
 
@@ -102,6 +86,9 @@ def update(request):
 
     else:
         messages.error(request, "Are you trying to adopt or disown?")
+
+    if count:
+        invalidate_details()
     return redirect('/packages/')
 
 
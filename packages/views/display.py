@@ -2,6 +2,7 @@
 import json
 from urllib import urlencode
 
+from django.core.serializers.json import DjangoJSONEncoder
 from django.http import HttpResponse, Http404
 from django.shortcuts import get_object_or_404, redirect, render
 from django.utils.timezone import now
@@ -9,8 +10,10 @@
 from main.models import Package, PackageFile, Arch, Repo
 from main.utils import empty_response
 from mirrors.utils import get_mirror_url_for_download
+from ..graph import get_graph
 from ..models import Update
-from ..utils import get_group_info, PackageJSONEncoder
+from ..utils import (get_group_info, package_details, package_records,
+        to_json, PACKAGE_VALUES)
 
 
 def arch_plus_agnostic(arch):
@@ -129,7 +132,8 @@ def details(request, name='', repo='', arch=''):
                     repo=repo_obj, arch=arch_obj)
             if request.method == 'HEAD':
                 return empty_response()
-            return render(request, 'packages/details.html', {'pkg': pkg})
+            return render(request, 'packages/details.html',
+                    package_details(pkg))
         except Package.DoesNotExist:
             # attempt a variety of fallback options before 404ing
             options = (redirect_agnostic, split_package_details,
@@ -173,11 +177,30 @@ def group_details(request, arch, name):
     return render(request, 'packages/packages_list.html', context)
 
 
+def sorted_files(pkg):
+    '''Return the files of a package in the normal alpha-order that pacman
+    uses. reporead only inserts and deletes changed paths when a file list is
+    updated, so row order can't be relied upon.'''
+    fileslist = PackageFile.objects.filter(pkg=pkg).order_by()
+    return sorted(fileslist, key=lambda f: f.directory + (f.filename or u''))
+
+
+def sorted_paths(pkg_id):
+    '''The full paths of the files of a package in the order sorted_files()
+    has them, along with how many are directories. Plain strings are a lot
+    cheaper than PackageFile objects for packages with many files.'''
+    fileslist = PackageFile.objects.filter(pkg_id=pkg_id).values_list(
+            'directory', 'filename', 'is_directory').order_by()
+    dir_count = sum(1 for _, _, is_directory in fileslist if is_directory)
+    paths = sorted(directory + (filename or u'')
+            for directory, filename, _ in fileslist)
+    return paths, dir_count
+
+
 def files(request, name, repo, arch):
     pkg = get_object_or_404(Package.objects.normal(),
             pkgname=name, repo__name__iexact=repo, arch__name=arch)
-    # files are inserted in sorted order, so preserve that
-    fileslist = PackageFile.objects.filter(pkg=pkg).order_by('id')
+    fileslist = sorted_files(pkg)
     dir_count = sum(1 for f in fileslist if f.is_directory)
     files_count = len(fileslist) - dir_count
     context = {
@@ -191,33 +214,88 @@ def files(request, name, repo, arch):
 
 
 def details_json(request, name, repo, arch):
-    pkg = get_object_or_404(Package.objects.normal(),
-            pkgname=name, repo__name__iexact=repo, arch__name=arch)
-    to_json = json.dumps(pkg, ensure_ascii=False, cls=PackageJSONEncoder)
-    return HttpResponse(to_json, content_type='application/json')
+    packages = Package.objects.filter(pkgname=name, repo__name__iexact=repo,
+            arch__name=arch).values(*PACKAGE_VALUES)
+    pkg = get_object_or_404(packages)
+    return HttpResponse(to_json(package_records([pkg])[0]),
+            content_type='application/json')
 
 
 def files_json(request, name, repo, arch):
     pkg = get_object_or_404(Package.objects.normal(),
             pkgname=name, repo__name__iexact=repo, arch__name=arch)
-    # files are inserted in sorted order, so preserve that
-    fileslist = PackageFile.objects.filter(pkg=pkg).order_by('id')
-    dir_count = sum(1 for f in fileslist if f.is_directory)
+    fileslist, dir_count = sorted_paths(pkg.id)
     files_count = len(fileslist) - dir_count
+    encode_datetime = DjangoJSONEncoder().default
     data = {
         'pkgname': pkg.pkgname,
         'repo': pkg.repo.name.lower(),
         'arch': pkg.arch.name.lower(),
-        'pkg_last_update': pkg.last_update,
-        'files_last_update': pkg.files_last_update,
+        'pkg_last_update': encode_datetime(pkg.last_update),
+        'files_last_update': pkg.files_last_update and
+            encode_datetime(pkg.files_last_update),
         'files_count': files_count,
         'dir_count': dir_count,
         'files': fileslist,
     }
-    to_json = json.dumps(data, ensure_ascii=False, cls=PackageJSONEncoder)
+    return HttpResponse(to_json(data), content_type='application/json')
+
+
+def package_graph(request, pkg):
+    '''Find the dependency graph and the node of a package in it. Agnostic
+    packages are looked at in the graph of the architecture given in the
+    'arch' query parameter, or else the first one.'''
+    arch = pkg.arch
+    if arch.agnostic:
+        arches = Arch.objects.exclude(agnostic=True)
+        if 'arch' in request.GET:
+            arches = arches.filter(name=request.GET['arch'])
+        arch = arches.first()
+        if arch is None:
+            raise Http404
+    graph = get_graph(arch, pkg.repo.testing, pkg.repo.staging)
+    node = graph.node(pkg)
+    if node is None:
+        raise Http404
+    return graph, node
+
+
+def graph_json(request, name, repo, arch, walk):
+    pkg = get_object_or_404(Package.objects.normal(),
+            pkgname=name, repo__name__iexact=repo, arch__name=arch)
+    graph, node = package_graph(request, pkg)
+    packages = []
+    for found, depth in walk(graph, node):
+        data = graph.describe(found)
+        data['depth'] = depth
+        packages.append(data)
+    data = {
+        'pkgname': pkg.pkgname,
+        'repo': pkg.repo.name.lower(),
+        'arch': graph.arch.name,
+        'generation': graph.generation,
+        'count': len(packages),
+        'packages': packages,
+    }
+    to_json = json.dumps(data, ensure_ascii=False)
     return HttpResponse(to_json, content_type='application/json')
 
 
+def depends_json(request, name, repo, arch):
+    return graph_json(request, name, repo, arch,
+            lambda graph, node: graph.transitive_depends(node))
+
+
+def requiredby_json(request, name, repo, arch):
+    return graph_json(request, name, repo, arch,
+            lambda graph, node: graph.transitive_required_by(node))
+
+
+def cycle_json(request, name, repo, arch):
+    return graph_json(request, name, repo, arch,
+            lambda graph, node: graph.cycle(node))
+
+
 def download(request, name, repo, arch):
     pkg = get_object_or_404(Package.objects.normal(),
             pkgname=name, repo__name__iexact=repo, arch__name=arch)
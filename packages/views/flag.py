@@ -11,6 +11,8 @@
 from django.views.decorators.cache import cache_page, never_cache
 
 from ..models import FlagRequest
+from ..utils import invalidate_flags
+from devel.models import UserProfile
 from main.models import Package
 
 
@@ -99,6 +101,7 @@ def perform_updates():
                 flag_request.save()
 
             perform_updates()
+            invalidate_flags()
 
             maints = pkg.maintainers
             if not maints:
@@ -106,12 +109,13 @@ def perform_updates():
                 subject = 'Orphan %s package [%s] marked out-of-date' % \
                         (pkg.repo.name, pkg.pkgname)
             else:
-                toemail = []
                 subject = '%s package [%s] marked out-of-date' % \
                         (pkg.repo.name, pkg.pkgname)
-                for maint in maints:
-                    if maint.userprofile.notify is True:
-                        toemail.append(maint.email)
+                notify = set(UserProfile.objects.filter(notify=True,
+                        user__in=[maint.id for maint in maints]).values_list(
+                        'user_id', flat=True))
+                toemail = [maint.email for maint in maints
+                        if maint.id in notify]
 
             if toemail:
                 # send notification email to the maintainers
@@ -161,6 +165,7 @@ def unflag(request, name, repo, arch):
             pkgname=name, repo__name__iexact=repo, arch__name=arch)
     pkg.flag_date = None
     pkg.save()
+    invalidate_flags()
     return redirect(pkg)
 
 @permission_required('main.change_package')
@@ -171,6 +176,7 @@ def unflag_all(request, name, repo, arch):
     pkgs = Package.objects.filter(pkgbase=pkg.pkgbase,
             repo__testing=pkg.repo.testing, repo__staging=pkg.repo.staging)
     pkgs.update(flag_date=None)
+    invalidate_flags()
     return redirect(pkg)
 
 # vim: set ts=4 sw=4 et:
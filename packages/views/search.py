@@ -1,16 +1,17 @@
-import json
-
 from django import forms
 from django.contrib.auth.models import User
-from django.db.models import Q
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.views.decorators.http import require_safe
 from django.views.generic import ListView
 
 from devel.models import UserProfile
 from main.models import Package, Arch, Repo
+from main.pagination import InvalidCursor, KeysetPaginator
 from main.utils import empty_response, make_choice
+from ..export import export_packages, FORMATS
+from ..fulltext import search_packages, RANK_ORDER
 from ..models import PackageRelation
-from ..utils import attach_maintainers, PackageJSONEncoder
+from ..utils import package_records, to_json, PACKAGE_VALUES
 
 
 class PackageSearchForm(forms.Form):
@@ -57,6 +58,11 @@ def exact_matches(self):
         return Package.objects.normal().filter(pkgname=self.cleaned_data['q'])
 
 
+SORT_FIELDS = ("arch", "repo", "pkgname", "pkgbase", "compressed_size",
+        "installed_size", "build_date", "last_update", "flag_date")
+ALLOWED_SORT = list(SORT_FIELDS) + ["-" + s for s in SORT_FIELDS]
+
+
 def parse_form(form, packages):
     if form.cleaned_data['repo']:
         packages = packages.filter(
@@ -94,9 +100,19 @@ def parse_form(form, packages):
         packages = packages.filter(pkgdesc__icontains=desc)
 
     if form.cleaned_data['q']:
-        query = form.cleaned_data['q']
-        q = Q(pkgname__icontains=query) | Q(pkgdesc__icontains=query)
-        packages = packages.filter(q)
+        # best matches first, unless a view asks for something else
+        packages = search_packages(packages, form.cleaned_data['q'])
+        packages = packages.order_by(*RANK_ORDER)
+
+    sort = form.cleaned_data['sort']
+    if sort in ALLOWED_SORT:
+        # arches and repos are ordered by name, but say so to allow keyset
+        # pagination over them
+        if sort.lstrip('-') in ('arch', 'repo'):
+            sort += '__name'
+        packages = packages.order_by(sort)
+    elif not form.cleaned_data['q']:
+        packages = packages.order_by('pkgname')
 
     return packages
 
@@ -105,10 +121,6 @@ class SearchListView(ListView):
     template_name = "packages/search.html"
     paginate_by = 100
 
-    sort_fields = ("arch", "repo", "pkgname", "pkgbase", "compressed_size",
-            "installed_size", "build_date", "last_update", "flag_date")
-    allowed_sort = list(sort_fields) + ["-" + s for s in sort_fields]
-
     def get(self, request, *args, **kwargs):
         if request.method == 'HEAD':
             return empty_response()
@@ -121,21 +133,25 @@ def get_queryset(self):
         if not self.request.user.is_authenticated():
             packages = packages.filter(repo__staging=False)
         if self.form.is_valid():
-            packages = parse_form(self.form, packages)
-            sort = self.form.cleaned_data['sort']
-            if sort in self.allowed_sort:
-                packages = packages.order_by(sort)
-            else:
-                packages = packages.order_by('pkgname')
-            return packages
+            return parse_form(self.form, packages)
 
         # Form had errors so don't return any results
         return Package.objects.none()
 
+    def paginate_queryset(self, queryset, page_size):
+        paginator = KeysetPaginator(queryset, page_size)
+        try:
+            page = paginator.page(after=self.request.GET.get('after'),
+                    before=self.request.GET.get('before'))
+        except InvalidCursor:
+            raise Http404("Invalid page")
+        return (paginator, page, page.object_list, page.has_other_pages())
+
     def get_context_data(self, **kwargs):
         context = super(SearchListView, self).get_context_data(**kwargs)
         query_params = self.request.GET.copy()
-        query_params.pop('page', None)
+        for param in ('page', 'after', 'before'):
+            query_params.pop(param, None)
         context['current_query'] = query_params.urlencode()
         context['search_form'] = self.form
         return context
@@ -149,24 +165,62 @@ def search_json(request):
         'limit': limit,
         'valid': False,
         'results': [],
+        'next': None,
     }
 
     if request.GET:
         form = PackageSearchForm(data=request.GET,
                 show_staging=request.user.is_authenticated())
         if form.is_valid():
-            packages = Package.objects.select_related('arch', 'repo',
-                    'packager')
+            packages = Package.objects.all()
             if not request.user.is_authenticated():
                 packages = packages.filter(repo__staging=False)
-            packages = parse_form(form, packages)[:limit]
-            packages = packages.prefetch_related('groups', 'licenses',
-                    'conflicts', 'provides', 'replaces', 'depends')
-            attach_maintainers(packages)
-            container['results'] = packages
-            container['valid'] = True
-
-    to_json = json.dumps(container, ensure_ascii=False, cls=PackageJSONEncoder)
-    return HttpResponse(to_json, content_type='application/json')
+            packages = parse_form(form, packages)
+            # rows hold the extra columns the results may be ranked by
+            columns = list(PACKAGE_VALUES) + list(packages.query.extra)
+            paginator = KeysetPaginator(packages.values(*columns), limit)
+            try:
+                page = paginator.page(after=request.GET.get('after'))
+            except InvalidCursor:
+                pass
+            else:
+                container['results'] = package_records(page.object_list)
+                container['next'] = page.next_cursor
+                if request.GET.get('count'):
+                    container['count'] = paginator.count
+                    container['count_is_estimate'] = \
+                            paginator.count_is_estimate
+                container['valid'] = True
+
+    return HttpResponse(to_json(container), content_type='application/json')
+
+
+def selected(objects, names):
+    '''The objects with the given names, ignoring case, or all of them if no
+    names were given.'''
+    if not names:
+        return list(objects)
+    names = {name.lower() for name in names}
+    found = [obj for obj in objects if obj.name.lower() in names]
+    if len(found) != len(names):
+        raise Http404
+    return found
+
+
+@require_safe
+def export(request, format_name):
+    if format_name not in FORMATS:
+        raise Http404
+    repos = Repo.objects.all()
+    if not request.user.is_authenticated():
+        repos = repos.filter(staging=False)
+    repos = selected(repos, request.GET.getlist('repo'))
+    arches = selected(Arch.objects.all(), request.GET.getlist('arch'))
+
+    packages = Package.objects.filter(repo__in=repos, arch__in=arches)
+    content_type = FORMATS[format_name][0]
+    return StreamingHttpResponse(
+            export_packages(packages, format_name, repos, arches),
+            content_type=content_type)
 
 # vim: set ts=4 sw=4 et:
@@ -3,6 +3,7 @@
 
 from main.models import Arch, Repo, Package
 from main.utils import groupby_preserve_order, PackageStandin
+from packages.models import PackageBase
 
 class RecentUpdate(object):
     def __init__(self, packages):
@@ -65,16 +66,23 @@ def get_recent_updates(number=15, testing=True, staging=False):
     if not staging:
         repos = repos.exclude(staging=True)
 
-    # This is a bit of magic. We are going to show 15 on the front page, but we
-    # want to try and eliminate cross-architecture wasted space. Pull enough
-    # packages that we can later do some screening and trim out the fat.
-    pkgs = []
-    # grab a few extra so we can hopefully catch everything we need
-    fetch = number * 6
-    for arch in Arch.objects.all():
-        pkgs += list(Package.objects.normal().filter(
-            arch=arch, repo__in=repos).order_by('-last_update')[:fetch])
-    pkgs.sort(key=attrgetter('last_update'), reverse=True)
+    # We are going to show 15 on the front page, but we want to try and
+    # eliminate cross-architecture wasted space. The pkgbase index has a row
+    # for each architecture a pkgbase was built for, so this many of the most
+    # recent ones hold at least the number of updates we need.
+    fetch = number * Arch.objects.count()
+    bases = PackageBase.objects.filter(repo__in=repos).values_list(
+            'repo_id', 'pkgbase').order_by('-last_update')[:fetch]
+    wanted = set()
+    for key in bases:
+        if len(wanted) == number:
+            break
+        wanted.add(key)
+
+    pkgs = Package.objects.normal().filter(repo__in=repos,
+            pkgbase__in={pkgbase for _, pkgbase in wanted}).order_by(
+            '-last_update')
+    pkgs = [pkg for pkg in pkgs if (pkg.repo_id, pkg.pkgbase) in wanted]
 
     same_pkgbase_key = lambda x: (x.repo.name, x.pkgbase)
     grouped = groupby_preserve_order(pkgs, same_pkgbase_key)
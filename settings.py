@@ -178,6 +178,9 @@
     'US': 'United States',
 }
 
+# Where bulk package exports are kept between changes to the packages
+PACKAGE_EXPORT_DIR = os.path.join(DEPLOY_PATH, 'export_cache')
+
 ## Import local settings
 from local_settings import *
 
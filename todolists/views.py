@@ -216,7 +216,7 @@ def send_todolist_emails(todo_list, new_packages):
     orphan_packages = []
     maint_packages = {}
     for todo_package in new_packages:
-        maints = todo_package.pkg.maintainers.values_list('email', flat=True)
+        maints = [maint.email for maint in todo_package.pkg.maintainers]
         if not maints:
             orphan_packages.append(todo_package)
         else: